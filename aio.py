@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import functools
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from settings import Settings
+
+logger = logging.getLogger(__name__)
+
+_loop = None
+_loop_lock = threading.Lock()
+# Pool for the blocking python-telegram-bot calls, which have no
+# asyncio API in the version the bot runs on
+_telegram_pool = ThreadPoolExecutor(max_workers=Settings.tg_workers,
+                                    thread_name_prefix='telegram')
+
+
+# Event loop running in its own thread, started on first use.
+# All handlers, Couchpotato and page requests run on it.
+def get_loop():
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=_loop.run_forever,
+                                      name='asyncio', daemon=True)
+            thread.start()
+        return _loop
+
+
+# Run coroutine `coro` on the loop from any other thread
+def submit(coro):
+    return asyncio.run_coroutine_threadsafe(coro, get_loop())
+
+
+# Run coroutine on the loop and wait for its result, for use from threads
+def run(coro, timeout=None):
+    return submit(coro).result(timeout)
+
+
+# Await a blocking function without holding up the loop
+async def call(func, *args, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(
+        _telegram_pool, functools.partial(func, *args, **kwargs))
+
+
+# Bot proxy for coroutine handlers: every method call returns an awaitable
+# running the synchronous Bot API call on the telegram pool.
+# The wrapped bot stays available as `sync` for thread-side code such as
+# the send queue.
+class AsyncBot:
+
+    def __init__(self, bot):
+        self.sync = bot
+
+    def __getattr__(self, name):
+        attr = getattr(self.sync, name)
+        if not callable(attr):
+            return attr
+
+        def method(*args, **kwargs):
+            metrics.telegram_calls.inc(getattr(attr, '__name__', name))
+            return call(attr, *args, **kwargs)
+        return method
+
+
+# Turns a coroutine handler `func(bot, update, ...)` into a callback for the
+# dispatcher. The callback only schedules the coroutine on the loop and
+# returns at once, so dispatcher threads are never held by slow I/O.
+def handler(func):
+    name = func.__qualname__
+
+    @functools.wraps(func)
+    def wrapped(bot, update, *args, **kwargs):
+        future = submit(_timed(name, func(AsyncBot(bot), update,
+                                          *args, **kwargs)))
+        future.add_done_callback(functools.partial(_report, func, update))
+        return future
+    return wrapped
+
+
+async def _timed(name, coro):
+    with metrics.handler_seconds.time(name):
+        try:
+            return await coro
+        except Exception:
+            metrics.handler_errors.inc(name)
+            raise
+
+
+def _report(func, update, future):
+    if future.cancelled():
+        return
+    error = future.exception()
+    if error is not None:
+        logger.error('Update "%s" caused error "%s" in %s', update, error,
+                     func.__name__, exc_info=error)
+
+
+# Stop the loop after running the cleanup coroutines in `closing`
+def shutdown(*closing):
+    if _loop is None:
+        return
+    for coro in closing:
+        try:
+            run(coro, timeout=10)
+        except Exception as error:
+            logger.warning('Ошибка при остановке: %s', error)
+    _loop.call_soon_threadsafe(_loop.stop)
+    _telegram_pool.shutdown(wait=False)
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import runpy
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+import settings as settings_module
+from sender import TokenBucket
+from settings import Settings
+
+logger = logging.getLogger(__name__)
+
+# Verdicts of Auth.check()
+ALLOW = 'allow'
+# Unauthorized, tell the user once
+DENY = 'deny'
+# Drop without an answer: repeated unauthorized sender or rate limited
+DROP = 'drop'
+
+# Settings re-read when settings.py changes
+RELOADED = ('admin_ids', 'auth_rate', 'auth_burst', 'auth_deny_ttl')
+
+
+# Access control for the handlers. Admins are kept in a frozenset and
+# limited to `auth_rate` updates per second each. Other users get the
+# "access denied" reply once, then are ignored for `auth_deny_ttl`
+# seconds, so nobody can make the bot flood the API on their behalf.
+# settings.py is re-read when its mtime changes, at most every
+# `auth_reload_interval` seconds, so admins can be changed without a
+# restart. Used from the event loop only.
+class Auth:
+
+    def __init__(self, settings=Settings, path=settings_module.__file__):
+        self.settings = settings
+        self.path = path
+        self.mtime = self.stat()
+        self.checked = time.monotonic()
+        self.apply(settings)
+        self.buckets = OrderedDict()
+        self.denied = OrderedDict()
+        self.counters = {'allowed': 0, 'denied': 0, 'dropped': 0,
+                         'limited': 0, 'reloads': 0}
+
+    def stat(self):
+        try:
+            return os.stat(self.path).st_mtime
+        except OSError:
+            return None
+
+    def apply(self, source):
+        self.admins = frozenset(source.admin_ids)
+        self.rate = source.auth_rate
+        self.burst = source.auth_burst
+        self.deny_ttl = source.auth_deny_ttl
+
+    # Pick up edits of settings.py
+    def reload(self, now):
+        if now - self.checked < self.settings.auth_reload_interval:
+            return
+        self.checked = now
+        mtime = self.stat()
+        if mtime == self.mtime:
+            return
+        self.mtime = mtime
+        try:
+            fresh = runpy.run_path(self.path)['Settings']
+        except Exception as error:
+            logger.error(u'Не удалось перечитать настройки: %s', error)
+            return
+        for name in RELOADED:
+            setattr(self.settings, name, getattr(fresh, name))
+        self.apply(self.settings)
+        self.buckets.clear()
+        self.denied.clear()
+        self.counters['reloads'] += 1
+        logger.info(u'Настройки доступа перечитаны, админов: %s',
+                    len(self.admins))
+
+    # Verdict for an update from `user_id`. Updates which are throttled
+    # otherwise (inline queries are debounced) pass `limited=False` and
+    # take nothing from the admin's bucket.
+    def check(self, user_id, limited=True):
+        now = time.monotonic()
+        self.reload(now)
+        if user_id in self.admins:
+            if not limited:
+                self.counters['allowed'] += 1
+                return ALLOW
+            bucket = self.buckets.get(user_id)
+            if bucket is None:
+                bucket = self.buckets[user_id] = TokenBucket(self.rate,
+                                                             self.burst)
+            if bucket.wait(now) > 0:
+                self.counters['limited'] += 1
+                return DROP
+            bucket.take(now)
+            self.counters['allowed'] += 1
+            return ALLOW
+
+        expires = self.denied.get(user_id)
+        if expires is not None and expires > now:
+            self.counters['dropped'] += 1
+            return DROP
+        self.denied[user_id] = now + self.deny_ttl
+        self.denied.move_to_end(user_id)
+        while len(self.denied) > self.settings.auth_deny_size:
+            self.denied.popitem(last=False)
+        self.counters['denied'] += 1
+        return DENY
+
+
+_auth = None
+_auth_lock = threading.Lock()
+
+metrics.CallbackCounter('bot_auth_total', 'Access checks by outcome',
+                        'verdict', lambda: {
+                            name: value for name, value in
+                            get_auth().counters.items() if name != 'reloads'})
+
+
+# Shared access control, created on first use
+def get_auth():
+    global _auth
+    with _auth_lock:
+        if _auth is None:
+            _auth = Auth()
+        return _auth
@@ -0,0 +1,87 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Per-request latency of the old requests.get() per call versus the pooled
+# asynchronous CPClient session, both against a local stub Couchpotato.
+#
+#   python3 bench/bench_cp_client.py [requests] [stub delay, s]
+
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import requests  # noqa: E402
+
+from cp_client import CPClient  # noqa: E402
+from settings import Settings  # noqa: E402
+from stub_cp import StubCP  # noqa: E402
+
+
+def measure(call, count):
+    timings = []
+    for _ in range(count):
+        started = time.perf_counter()
+        call()
+        timings.append((time.perf_counter() - started) * 1000)
+    return timings
+
+
+async def measure_async(call, count):
+    timings = []
+    for _ in range(count):
+        started = time.perf_counter()
+        await call()
+        timings.append((time.perf_counter() - started) * 1000)
+    return timings
+
+
+def report(name, timings, connections):
+    timings = sorted(timings)
+    print('{:<14} mean {:7.3f} ms  p50 {:7.3f} ms  p99 {:7.3f} ms  '
+          'connections {}'.format(name, statistics.mean(timings),
+                                  timings[len(timings) // 2],
+                                  timings[int(len(timings) * 0.99) - 1],
+                                  connections))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    delay = float(sys.argv[2]) if len(sys.argv) > 2 else 0.0
+    stub = StubCP(movies=1, delay=delay).start()
+
+    class BenchSettings(Settings):
+        cp_hostname = '127.0.0.1'
+        cp_port = str(stub.port)
+        cp_api = 'bench'
+        cp_username = ''
+
+    client = CPClient(BenchSettings)
+    url = client.url('app.available', '')
+
+    seen = stub.connections
+    old = measure(lambda: requests.get(url, timeout=15).json(), count)
+    report('requests.get', old, stub.connections - seen)
+
+    seen = stub.connections
+    new = asyncio.run(run_client(client, count))
+    report('CPClient', new, stub.connections - seen)
+
+    print('latency drop: {:.1f}%'.format(
+        100 * (1 - statistics.mean(new) / statistics.mean(old))))
+    stub.stop()
+
+
+async def run_client(client, count):
+    try:
+        return await measure_async(lambda: client.request('app.available'),
+                                   count)
+    finally:
+        await client.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,411 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# End-to-end load test: the bot is started by home_bot.make_updater() and
+# start_bot() as main() starts it (router, handlers, job queue, send
+# queue, sampler, title index and, when their ports are set, the notify
+# and metrics servers) against the fake Telegram API and the stub
+# Couchpotato. Virtual users replay update streams concurrently, each
+# waiting for the bot's answer before the next step, and the time from
+# pushing an update to the final answer in the user's chat is reported
+# per step with p50/p99 and throughput.
+#
+# Scenarios (steps in brackets):
+#   search   /q movie, then the button adding a movie, which is not in the
+#            library yet [search, search.add]
+#   avail    /avail, then the releases of a movie [avail, avail.releases]
+#   magnet   magnet-link of a torrent sent earlier in the run [magnet]
+#   torrent  a new .torrent document [torrent]
+#   album    an album of three new .torrent documents [album]
+# Magnets resolve from the torrent index, so no DHT traffic is made.
+#
+# Every run is appended to bench/results.jsonl and compared with the last
+# run of the same configuration.
+#
+#   python3 bench/bench_load.py --users 8 --ops 25
+#   python3 bench/bench_load.py --mix search=1 --cp-delay 0.05
+#   python3 bench/bench_load.py --script stream.txt
+
+import argparse
+import datetime
+import hashlib
+import itertools
+import json
+import logging
+import os
+import queue
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import home_bot  # noqa: E402
+import torrents  # noqa: E402
+from fake_telegram import FakeTelegram  # noqa: E402
+from settings import Settings  # noqa: E402
+from stub_cp import StubCP  # noqa: E402
+
+RESULTS = os.path.join(ROOT, 'bench', 'results.jsonl')
+DEFAULT_MIX = 'search=4,avail=2,magnet=1,torrent=2,album=1'
+# Answers telling that the result of a job comes in a later message
+INTERIM = u'результат придет сообщением'
+ANSWERS = ('sendMessage', 'editMessageText')
+
+serial = itertools.count(1)
+
+
+def bencode(value):
+    if isinstance(value, int):
+        return b'i%de' % value
+    if isinstance(value, str):
+        value = value.encode('utf-8')
+    if isinstance(value, bytes):
+        return b'%d:%s' % (len(value), value)
+    if isinstance(value, dict):
+        return b'd' + b''.join(bencode(key) + bencode(value[key])
+                               for key in sorted(value)) + b'e'
+    return b'l' + b''.join(bencode(item) for item in value) + b'e'
+
+
+# A .torrent file no other call returns
+def make_torrent():
+    n = next(serial)
+    info = {'name': 'Bench Movie %d' % n, 'length': 2 ** 30 + n,
+            'piece length': 2 ** 22,
+            'pieces': hashlib.sha1(b'%d' % n).digest() * 256}
+    return n, bencode({'announce': 'http://tracker.local/announce',
+                       'info': info})
+
+
+def buttons(params, prefix):
+    markup = params.get('reply_markup') or {}
+    if isinstance(markup, str):
+        markup = json.loads(markup)
+    return [button['callback_data']
+            for row in markup.get('inline_keyboard') or ()
+            for button in row
+            if button.get('callback_data', '').startswith(prefix)]
+
+
+# Timings of all users, by step
+class Results:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timings = {}
+        self.timeouts = {}
+        self.stray = 0
+
+    def add(self, step, ms):
+        with self.lock:
+            self.timings.setdefault(step, []).append(ms)
+
+    def timeout(self, step):
+        with self.lock:
+            self.timeouts[step] = self.timeouts.get(step, 0) + 1
+
+    def summary(self, wall):
+        steps = {}
+        for step in sorted(set(self.timings) | set(self.timeouts)):
+            timings = sorted(self.timings.get(step, ()))
+            steps[step] = {
+                'count': len(timings),
+                'timeouts': self.timeouts.get(step, 0),
+                'rate': len(timings) / wall,
+                'mean': sum(timings) / len(timings) if timings else None,
+                'p50': percentile(timings, 0.5),
+                'p99': percentile(timings, 0.99)}
+        done = sum(step['count'] for step in steps.values())
+        return {'wall': wall, 'throughput': done / wall, 'stray': self.stray,
+                'steps': steps}
+
+
+def percentile(timings, fraction):
+    if not timings:
+        return None
+    return timings[min(len(timings) - 1, int(len(timings) * fraction))]
+
+
+# One chat with the bot. Answers are routed to the user by chat id; a step
+# is over at the first answer which is not an interim "result comes
+# later" one.
+class User:
+
+    def __init__(self, fake, user_id, results, timeout, known):
+        self.fake = fake
+        self.user_id = user_id
+        self.results = results
+        self.timeout = timeout
+        # info-hashes of the torrents saved so far, shared by all users
+        self.known = known
+        self.inbox = queue.Queue()
+
+    def step(self, name, push):
+        while True:
+            try:
+                self.inbox.get_nowait()
+            except queue.Empty:
+                break
+            self.results.stray += 1
+        started = time.perf_counter()
+        push()
+        deadline = started + self.timeout
+        while True:
+            try:
+                at, params = self.inbox.get(
+                    timeout=max(0, deadline - time.perf_counter()))
+            except queue.Empty:
+                self.results.timeout(name)
+                return None
+            if INTERIM not in (params.get('text') or ''):
+                self.results.add(name, (at - started) * 1000)
+                return params
+
+    def search(self, rand):
+        params = self.step('search', lambda: self.fake.push(
+            '/q movie', self.user_id))
+        found = buttons(params or {}, 'qad_')
+        if found:
+            self.step('search.add', lambda: self.fake.push_callback(
+                rand.choice(found), 1, self.user_id))
+
+    def avail(self, rand):
+        params = self.step('avail', lambda: self.fake.push(
+            '/avail', self.user_id))
+        found = buttons(params or {}, 'dow_')
+        if found:
+            self.step('avail.releases', lambda: self.fake.push_callback(
+                rand.choice(found), 1, self.user_id))
+
+    # Sends a torrent instead while none has been saved yet
+    def magnet(self, rand):
+        if not self.known:
+            return self.torrent(rand)
+        self.step('magnet', lambda: self.fake.push(
+            'magnet:?xt=urn:btih:%s&dn=bench' % rand.choice(self.known),
+            self.user_id))
+
+    def torrent(self, rand):
+        n, data = make_torrent()
+        if self.step('torrent', lambda: self.fake.push_document(
+                'bench%d' % n, 'bench %d.torrent' % n, data,
+                self.user_id)) is not None:
+            self.known.append(torrents.inspect(data)[0])
+
+    def album(self, rand):
+        files = [make_torrent() for _ in range(3)]
+
+        def push():
+            for n, data in files:
+                self.fake.push_document('bench%d' % n, 'bench %d.torrent' % n,
+                                        data, self.user_id,
+                                        media_group_id='album%d' % files[0][0])
+        if self.step('album', push) is not None:
+            self.known.extend(torrents.inspect(data)[0] for _, data in files)
+
+    def run(self, stream, rand):
+        for scenario in stream:
+            getattr(self, scenario)(rand)
+
+
+SCENARIOS = ('search', 'avail', 'magnet', 'torrent', 'album')
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if name not in SCENARIOS:
+            raise SystemExit('unknown scenario: ' + name)
+        mix[name] = float(weight or 1)
+    return mix
+
+
+# Scenario names of the users: drawn from the mix, or the lines of the
+# script handed out in turn
+def streams(args):
+    if args.script:
+        with open(args.script) as f:
+            script = [line.split('#')[0].strip() for line in f]
+        script = [line for line in script if line]
+        for name in script:
+            if name not in SCENARIOS:
+                raise SystemExit('unknown scenario: ' + name)
+        return [script[user::args.users] for user in range(args.users)]
+    mix = parse_mix(args.mix)
+    rand = random.Random(args.seed)
+    return [rand.choices(list(mix), list(mix.values()), k=args.ops)
+            for _ in range(args.users)]
+
+
+# Point the bot at the stand-ins and a scratch directory
+def configure(args, stub, scratch):
+    Settings.token = '1000:bench'
+    Settings.admin_ids = list(range(1, args.users + 1))
+    Settings.tg_webhook_url = ''
+    Settings.cp_hostname = '127.0.0.1'
+    Settings.cp_port = str(stub.port)
+    Settings.cp_api = 'bench'
+    Settings.cp_username = ''
+    Settings.torrent_path = os.path.join(scratch, 'torrents') + os.sep
+    os.makedirs(Settings.torrent_path)
+    Settings.torrent_index = os.path.join(scratch, 'torrents.sqlite3')
+    Settings.jobs_db = os.path.join(scratch, 'jobs.sqlite3')
+    Settings.cache_db = os.path.join(scratch, 'cache.sqlite3')
+    Settings.title_index_path = os.path.join(scratch, 'titles.idx')
+    # The sampler pings the first host
+    Settings.ping_hosts = ['127.0.0.1']
+    # Every movie add goes to Couchpotato, not to a finished job
+    Settings.jobs_dedup_ttl = 0
+    if not args.real_limits:
+        # Measure the handlers, not the configured rate limits
+        Settings.auth_rate = Settings.auth_burst = 10 ** 6
+        Settings.tg_global_rate = Settings.tg_chat_rate = 10 ** 6
+        Settings.tg_chat_burst = 10 ** 6
+        Settings.jobs_rate = 10 ** 6
+
+
+def run(args):
+    stub = StubCP(movies=args.movies, delay=args.cp_delay, offset=10).start()
+    fake = FakeTelegram().start()
+    scratch = tempfile.mkdtemp(prefix='bench_load_')
+    configure(args, stub, scratch)
+    results = Results()
+    known = []
+    users = {user_id: User(fake, user_id, results, args.timeout, known)
+             for user_id in Settings.admin_ids}
+
+    def listener(method, params):
+        if method in ANSWERS:
+            user = users.get(int(params.get('chat_id') or 0))
+            if user is not None:
+                user.inbox.put((time.perf_counter(), params))
+    fake.listener = listener
+
+    u = home_bot.make_updater(base_url=fake.base_url,
+                              base_file_url=fake.file_url)
+    stop = home_bot.start_bot(u)
+    # Let the first getUpdates reach the fake server
+    time.sleep(0.5)
+
+    threads = [threading.Thread(target=users[user_id].run,
+                                args=(stream, random.Random(args.seed +
+                                                            user_id)))
+               for user_id, stream in zip(users, streams(args))]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - started
+
+    stop()
+    fake.stop()
+    stub.stop()
+    shutil.rmtree(scratch, ignore_errors=True)
+    summary = results.summary(wall)
+    summary['cp_requests'] = stub.requests
+    return summary
+
+
+def revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def previous(path, config):
+    last = None
+    try:
+        with open(path) as f:
+            for line in f:
+                record = json.loads(line)
+                if record.get('config') == config:
+                    last = record
+    except (OSError, ValueError):
+        pass
+    return last
+
+
+def change(new, old):
+    if not new or not old:
+        return ''
+    return '{:+6.1f}%'.format(100 * (new - old) / old)
+
+
+def report(summary, before):
+    old_steps = before['steps'] if before else {}
+    print('{:<16}{:>7}{:>9}{:>9}{:>10}{:>10}{:>10}'.format(
+        'step', 'count', 'timeout', 'per s', 'mean ms', 'p50 ms', 'p99 ms'))
+    for name, step in summary['steps'].items():
+        old = old_steps.get(name, {})
+        print('{:<16}{:>7}{:>9}{:>9.1f}{:>10}{:>10}{:>10}'.format(
+            name, step['count'], step['timeouts'], step['rate'],
+            *('-' if step[key] is None else '%.1f' % step[key]
+              for key in ('mean', 'p50', 'p99'))))
+        if old:
+            print('{:<16}{:>7}{:>9}{:>9}{:>10}{:>10}{:>10}'.format(
+                '  vs ' + (before.get('revision') or 'last'), '', '',
+                change(step['rate'], old.get('rate')),
+                change(step['mean'], old.get('mean')),
+                change(step['p50'], old.get('p50')),
+                change(step['p99'], old.get('p99'))))
+    print('throughput {:.1f} steps/s {}, wall {:.1f} s, Couchpotato '
+          'requests {}, stray answers {}'.format(
+              summary['throughput'],
+              change(summary['throughput'],
+                     before and before.get('throughput')),
+              summary['wall'], summary['cp_requests'], summary['stray']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, default=8,
+                        help='concurrent users, each with its own chat')
+    parser.add_argument('--ops', type=int, default=25,
+                        help='scenarios per user')
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help='scenario weights, default ' + DEFAULT_MIX)
+    parser.add_argument('--script',
+                        help='file of scenario names, one per line, '
+                             'replayed instead of the mix')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--movies', type=int, default=100,
+                        help='movies in the stub Couchpotato library')
+    parser.add_argument('--cp-delay', type=float, default=0.0,
+                        help='seconds the stub takes per request')
+    parser.add_argument('--timeout', type=float, default=30,
+                        help='seconds to wait for an answer')
+    parser.add_argument('--real-limits', action='store_true',
+                        help='keep the auth, Telegram and job rate limits')
+    parser.add_argument('--results', default=RESULTS)
+    parser.add_argument('--no-save', action='store_true')
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.ERROR)
+
+    config = {'users': args.users, 'ops': args.ops, 'mix': args.mix,
+              'script': args.script, 'seed': args.seed,
+              'movies': args.movies, 'cp_delay': args.cp_delay,
+              'real_limits': args.real_limits}
+    summary = run(args)
+    before = previous(args.results, config)
+    report(summary, before)
+    if not args.no_save:
+        record = dict(summary, config=config, revision=revision(),
+                      date=datetime.datetime.now().isoformat(
+                          timespec='seconds'))
+        with open(args.results, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Size and speed of what the cache stores per movie: pickled media.list
+# records, full and trimmed as read by cp_stream, versus the packed
+# models.Movie kept by store.encode(). Also the memory held by a list of
+# each after decoding.
+#
+#   python3 bench/bench_models.py [movies]
+
+import os
+import pickle
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from stub_cp import fake_movie  # noqa: E402
+from cp_stream import trim_movie  # noqa: E402
+from models import Movie  # noqa: E402
+from store import decode, encode  # noqa: E402
+
+
+# fake_movie() with the metadata a real media.list record carries
+def full_movie(n):
+    movie = fake_movie(n)
+    movie['info'].update(plot='x' * 600, genres=['Drama'] * 4,
+                         images={'poster': ['http://img/%d.jpg' % i
+                                            for i in range(5)]},
+                         actor_roles={'A%d' % i: 'R' for i in range(20)})
+    movie['files'] = {'image_poster': ['/data/cache/poster.jpg']}
+    for release in movie['releases']:
+        release['files'] = {'movie': ['/x/y.mkv'] * 3}
+        release['info']['description'] = 'd' * 300
+    return movie
+
+
+def measure(values, dump, load):
+    started = time.perf_counter()
+    blobs = [dump(value) for value in values]
+    encoded = time.perf_counter() - started
+    started = time.perf_counter()
+    for blob in blobs:
+        load(blob)
+    decoded = time.perf_counter() - started
+    tracemalloc.start()
+    kept = [load(blob) for blob in blobs]
+    held = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del kept
+    count = len(values)
+    return (sum(map(len, blobs)) / count, encoded / count * 1e6,
+            decoded / count * 1e6, held / count)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    full = [full_movie(n) for n in range(1, count + 1)]
+    trimmed = [trim_movie(movie) for movie in full]
+    movies = [Movie.from_media(movie) for movie in full]
+    dump = lambda value: pickle.dumps(value, pickle.HIGHEST_PROTOCOL)  # noqa
+    print('{} movies, 3 releases each, per movie:'.format(count))
+    for name, values, dumps, loads in (
+            ('pickle full', full, dump, pickle.loads),
+            ('pickle trimmed', trimmed, dump, pickle.loads),
+            ('Movie.pack', movies, encode, decode)):
+        size, encoded, decoded, held = measure(values, dumps, loads)
+        print('{:<15} {:6.0f} bytes  encode {:6.1f} us  decode {:6.1f} us  '
+              'decoded {:6.0f} bytes'.format(name, size, encoded, decoded,
+                                             held))
+
+
+if __name__ == '__main__':
+    main()
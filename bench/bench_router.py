@@ -0,0 +1,122 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Per-update routing cost: the dispatcher's list of handlers, each
+# checked in turn as before the Router, versus one Router lookup, over a
+# mix of synthetic updates and with a growing number of commands.
+#
+#   python3 bench/bench_router.py [rounds]
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram import Bot, Update, User  # noqa: E402
+from telegram.ext import (BaseFilter, CallbackQueryHandler,  # noqa: E402
+                          CommandHandler, Filters, MessageHandler)
+
+from router import Router  # noqa: E402
+
+try:
+    from telegram.ext import MessageFilter
+except ImportError:
+    MessageFilter = BaseFilter
+
+COMMANDS = ['start', 'help', 'ping', 'uptime', 'free', 'systemp', 'status',
+            'stats', 'q', 'avail']
+TEXTS = ['/start', '/q matrix', '/avail', '/stats 6h', '/nosuch',
+         'magnet:?xt=urn:btih:' + '0' * 40, 'https://example.com/page',
+         'Matrix 1999', 'hello']
+
+
+def noop(bot, update):
+    pass
+
+
+def make_filter(name, func):
+    return type(name, (MessageFilter,),
+                {'filter': lambda self, message: func(message)})()
+
+
+def make_updates(bot):
+    updates = []
+    for n, text in enumerate(TEXTS * 10):
+        message = {'message_id': n, 'date': 0, 'text': text,
+                   'chat': {'id': 1, 'type': 'private'},
+                   'from': {'id': 1, 'is_bot': False, 'first_name': 'U'}}
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0,
+                                    'length': len(text.split()[0])}]
+        updates.append(Update.de_json({'update_id': n, 'message': message},
+                                      bot))
+    updates.append(Update.de_json({'update_id': 10 ** 6, 'callback_query': {
+        'id': '1', 'chat_instance': '1', 'data': 'pag_q:x::1',
+        'from': {'id': 1, 'is_bot': False, 'first_name': 'U'}}}, bot))
+    return updates
+
+
+def handler_list(extra):
+    magnet = make_filter('magnet', lambda m: bool(
+        m.text and m.text.startswith('magnet')))
+    http_link = make_filter('http_link', lambda m: bool(
+        m.text and m.text.startswith('http')))
+    torrent = make_filter('torrent_file', lambda m: bool(
+        m.document and m.document.mime_type == 'application/x-bittorrent'))
+    commands = COMMANDS[:8] + ['extra%d' % i for i in range(extra)]
+    handlers = [CommandHandler(name, noop) for name in commands]
+    handlers += [CallbackQueryHandler(noop),
+                 MessageHandler(magnet, noop),
+                 MessageHandler(http_link, noop),
+                 MessageHandler(torrent, noop),
+                 MessageHandler(Filters.text & ~Filters.command, noop),
+                 CommandHandler('q', noop),
+                 CommandHandler('avail', noop),
+                 MessageHandler(Filters.command, noop)]
+    return handlers
+
+
+def router(extra):
+    r = Router()
+    for name in COMMANDS + ['extra%d' % i for i in range(extra)]:
+        r.command(name, noop)
+    for kind in ('callback', 'magnet', 'http', 'torrent', 'text', 'unknown'):
+        r.on(kind, noop)
+    return r
+
+
+def measure(route, updates, rounds):
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for update in updates:
+            route(update)
+    return (time.perf_counter() - started) / (rounds * len(updates)) * 1e6
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    bot = Bot('1000:bench')
+    identity = User(1000, 'Bench', True, username='bench_bot')
+    # Known identity, so CommandHandler never calls getMe
+    bot._bot = identity
+    updates = make_updates(bot)
+
+    for extra in (0, 50, 500):
+        handlers = handler_list(extra)
+
+        def linear(update):
+            for handler in handlers:
+                if handler.check_update(update):
+                    return handler
+
+        r = router(extra)
+        old = measure(linear, updates, rounds)
+        new = measure(lambda update: r.classify(update, 'bench_bot'),
+                      updates, rounds)
+        print('{:>4} handlers  list {:8.2f} us/update  router {:6.2f} '
+              'us/update  x{:.0f}'.format(len(handlers), old, new, old / new))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Build time, file size and lookup latency of the title index over a
+# synthetic catalogue of `titles` random movie titles, the size of the
+# movies in an IMDB dump by default.
+#
+#   python3 bench/bench_title_index.py [titles]
+
+import itertools
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from title_index import TitleIndex, build  # noqa: E402
+
+COMMON = ('the of and a in to man night last love story day dark war house '
+          'city time life world blood king girl black return dead lost '
+          'secret red star home summer river road fire ghost money island '
+          'heat alien shadow moon winter iron brother wild').split()
+LETTERS = 'abcdefghijklmnopqrstuvwxyz'
+
+
+# Titles of 1-5 words, half of the words common ones, the rest drawn
+# with a Zipf-like bias from a vocabulary of made-up words
+def catalogue(count):
+    rand = random.Random(1)
+    vocabulary = [''.join(rand.choice(LETTERS)
+                          for _ in range(rand.randint(3, 9)))
+                  for _ in range(50000)]
+    weights = list(itertools.accumulate(
+        1.0 / rank for rank in range(1, len(vocabulary) + 1)))
+
+    for n in range(1, count + 1):
+        length = rand.randint(1, 5)
+        words = rand.choices(vocabulary, cum_weights=weights, k=length)
+        words = [rand.choice(COMMON) if rand.random() < 0.5 else word
+                 for word in words]
+        yield 'tt%07d' % n, ' '.join(words).title(), 1920 + n % 100
+
+
+def timed(func, queries, rounds=5):
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for query in queries:
+            func(query)
+    return (time.perf_counter() - started) / (rounds * len(queries)) * 1e6
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 600000
+    titles = list(catalogue(count))
+    path = os.path.join(tempfile.mkdtemp(), 'titles.idx')
+    started = time.perf_counter()
+    build(path, titles)
+    print('{} titles: built in {:.1f} s, {:.1f} MB'.format(
+        count, time.perf_counter() - started, os.path.getsize(path) / 1e6))
+
+    index = TitleIndex(path)
+    rand = random.Random(2)
+    picked = [rand.choice(titles) for _ in range(200)]
+    prefixes = [title[:rand.randint(3, 12)] for _, title, _ in picked]
+    # One letter dropped
+    typos = [title[:len(title) // 2] + title[len(title) // 2 + 1:]
+             for _, title, _ in picked]
+    labels = ['%s %s' % (title, year) for _, title, year in picked]
+    for name, func, queries in (('prefix', index.prefix, prefixes),
+                                ('fuzzy', index.search, typos),
+                                ('resolve', index.resolve, labels)):
+        print('{:<8} {:8.1f} us/lookup'.format(name, timed(func, queries)))
+    found = sum(any(title.imdb == imdb for title in index.search(typo, 5))
+                for (imdb, _, _), typo in zip(picked, typos))
+    print('misspelt titles found in the top 5: {:.0f}%'.format(
+        100.0 * found / len(picked)))
+    index.close()
+    os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Update-to-reply latency with long polling versus the webhook, against a
+# local fake Telegram API. Every update is an unknown command from a user
+# who is not an admin, so the reply involves no Couchpotato calls.
+#
+#   python3 bench/bench_updates.py [updates]
+
+import logging
+import os
+import socket
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import aio  # noqa: E402
+import home_bot  # noqa: E402
+from fake_telegram import FakeTelegram  # noqa: E402
+from settings import Settings  # noqa: E402
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def run(mode, count):
+    fake = FakeTelegram().start()
+    replied = threading.Event()
+    fake.listener = lambda method, params: \
+        method == 'sendMessage' and replied.set()
+
+    Settings.token = '1000:bench'
+    Settings.admin_ids = []
+    if mode == 'webhook':
+        port = free_port()
+        Settings.tg_webhook_url = 'http://127.0.0.1:%d/telegram' % port
+        Settings.tg_webhook_listen = '127.0.0.1'
+        Settings.tg_webhook_port = port
+    else:
+        Settings.tg_webhook_url = ''
+
+    u = home_bot.make_updater(base_url=fake.base_url)
+    home_bot.add_handlers(u.dispatcher)
+    server = home_bot.start_updates(u)
+    # Let the first getUpdates reach the fake server
+    time.sleep(0.5)
+
+    timings = []
+    for _ in range(count):
+        replied.clear()
+        started = time.perf_counter()
+        fake.push('/bench')
+        if not replied.wait(5):
+            print('no reply in', mode, 'mode')
+            break
+        timings.append((time.perf_counter() - started) * 1000)
+
+    u.stop()
+    if server is not None:
+        aio.run(server.stop())
+    fake.stop()
+    return timings
+
+
+def report(name, timings):
+    timings = sorted(timings)
+    print('{:<8} mean {:7.3f} ms  p50 {:7.3f} ms  p99 {:7.3f} ms  '
+          'updates {}'.format(name, statistics.mean(timings),
+                              timings[len(timings) // 2],
+                              timings[int(len(timings) * 0.99) - 1],
+                              len(timings)))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    logging.getLogger().setLevel(logging.ERROR)
+    for mode in ('polling', 'webhook'):
+        report(mode, run(mode, count))
+
+
+if __name__ == '__main__':
+    main()
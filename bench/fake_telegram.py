@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+
+# Local stand-in for the Telegram Bot API, used by the benchmarks.
+# Serves getMe, getUpdates (long polling), setWebhook/deleteWebhook,
+# getFile and file downloads, and records sendMessage and every other
+# method. Updates pushed with push(), push_document() and push_callback()
+# are handed out by getUpdates, or POSTed to the webhook once one is set.
+
+import itertools
+import json
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+BOT = {'id': 1000, 'is_bot': True, 'first_name': 'Bench',
+       'username': 'bench_bot'}
+
+
+class FakeTelegram:
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self.updates = []
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.webhook = None
+        self.secret = None
+        self.cond = threading.Condition()
+        self.closed = False
+        # (monotonic time, method, params) of every call but getUpdates
+        self.calls = []
+        # Called with (method, params) for every recorded call
+        self.listener = None
+        # file_id -> bytes served by getFile and the file URL
+        self.files = {}
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                if not self.path.startswith('/file/'):
+                    return self.do_POST()
+                data = fake.files.get(self.path.rsplit('/', 1)[-1])
+                if data is None:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/octet-stream')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                raw = self.rfile.read(length)
+                if self.headers.get('Content-Type', '').startswith(
+                        'application/json'):
+                    params = json.loads(raw or b'{}')
+                else:
+                    params = {k: v[0] for k, v in
+                              parse_qs(raw.decode('utf-8', 'replace')).items()}
+                method = self.path.rstrip('/').rsplit('/', 1)[-1]
+                body = json.dumps({'ok': True,
+                                   'result': fake.answer(method, params)})
+                body = body.encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True)
+
+    @property
+    def base_url(self):
+        return 'http://%s:%s/bot' % self.server.server_address
+
+    # For Updater(base_file_url=...)
+    @property
+    def file_url(self):
+        return 'http://%s:%s/file/bot' % self.server.server_address
+
+    def answer(self, method, params):
+        if method == 'getMe':
+            return BOT
+        if method == 'getUpdates':
+            return self.get_updates(int(params.get('offset') or 0),
+                                    float(params.get('timeout') or 0))
+        self.calls.append((time.monotonic(), method, params))
+        if method == 'setWebhook':
+            self.webhook = params.get('url') or None
+            self.secret = params.get('secret_token')
+        elif method == 'deleteWebhook':
+            self.webhook = None
+        elif method == 'getFile':
+            file_id = params.get('file_id', '')
+            return {'file_id': file_id, 'file_unique_id': file_id,
+                    'file_size': len(self.files.get(file_id, b'')),
+                    'file_path': 'documents/' + file_id}
+        if self.listener is not None:
+            self.listener(method, params)
+        if method in ('sendMessage', 'editMessageText'):
+            return {'message_id': next(self.message_ids),
+                    'date': int(time.time()),
+                    'chat': {'id': int(params.get('chat_id', 0)),
+                             'type': 'private'},
+                    'text': params.get('text', '')}
+        return True
+
+    def get_updates(self, offset, timeout):
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while True:
+                self.updates = [u for u in self.updates
+                                if u['update_id'] >= offset]
+                if self.updates or self.webhook or self.closed:
+                    return self.updates
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    return []
+                self.cond.wait(left)
+
+    def message(self, user_id, **fields):
+        message = {'message_id': next(self.message_ids),
+                   'date': int(time.time()),
+                   'from': {'id': user_id, 'is_bot': False,
+                            'first_name': 'User'},
+                   'chat': {'id': user_id, 'type': 'private'}}
+        message.update(fields)
+        return message
+
+    # Queue a text message from `user_id`; returns the update
+    def push(self, text, user_id=1):
+        message = self.message(user_id, text=text)
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0,
+                                    'length': len(text.split()[0])}]
+        return self.enqueue({'message': message})
+
+    # Queue a document from `user_id`, served to the bot as `data`
+    def push_document(self, file_id, name, data, user_id=1,
+                      mime_type='application/x-bittorrent',
+                      media_group_id=None):
+        self.files[file_id] = data
+        document = {'file_id': file_id, 'file_unique_id': file_id,
+                    'file_name': name, 'mime_type': mime_type,
+                    'file_size': len(data)}
+        message = self.message(user_id, document=document)
+        if media_group_id is not None:
+            message['media_group_id'] = media_group_id
+        return self.enqueue({'message': message})
+
+    # Queue a press of the inline button with `data` under the bot's
+    # message `message_id` in the chat of `user_id`
+    def push_callback(self, data, message_id, user_id=1):
+        user = {'id': user_id, 'is_bot': False, 'first_name': 'User'}
+        message = {'message_id': message_id, 'date': int(time.time()),
+                   'from': BOT, 'chat': {'id': user_id, 'type': 'private'},
+                   'text': '...'}
+        query = {'id': str(next(self.update_ids)), 'from': user,
+                 'message': message, 'chat_instance': str(user_id),
+                 'data': data}
+        return self.enqueue({'callback_query': query})
+
+    def enqueue(self, update):
+        update['update_id'] = next(self.update_ids)
+        if self.webhook:
+            self.deliver(update)
+        else:
+            with self.cond:
+                self.updates.append(update)
+                self.cond.notify_all()
+        return update
+
+    def deliver(self, update):
+        request = urllib.request.Request(
+            self.webhook, data=json.dumps(update).encode('utf-8'),
+            headers={'Content-Type': 'application/json',
+                     'X-Telegram-Bot-Api-Secret-Token': self.secret or ''})
+        urllib.request.urlopen(request, timeout=10).read()
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+# Local stand-in for the Couchpotato API, used by the benchmarks.
+# Answers /<urlbase>/api/<key>/<action>/ with canned JSON over HTTP/1.1
+# keep-alive, optionally with an artificial delay per request.
+
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+
+def fake_movie(n):
+    imdb = 'tt%07d' % n
+    media_id = '%032x' % n
+    return {
+        '_id': media_id,
+        'title': 'Movie %d' % n,
+        'identifiers': {'imdb': imdb},
+        'info': {'year': 1950 + n % 70,
+                 'titles': ['Movie %d' % n]},
+        'releases': [{
+            '_id': '%032x' % (n * 10 + r),
+            'media_id': media_id,
+            'info': {'name': 'Movie.%d.1080p.release%d' % (n, r),
+                     'protocol': 'torrent',
+                     'size': 4000 + r,
+                     'url': 'http://tracker.local/%d/%d' % (n, r),
+                     'provider': 'stub',
+                     'score': 100 - r,
+                     'leechers': r,
+                     'seeders': 10 + r}
+        } for r in range(3)]
+    }
+
+
+def fake_search_hit(n):
+    return {'imdb': 'tt%07d' % n,
+            'titles': ['Movie %d' % n],
+            'year': 1950 + n % 70,
+            'rating': {'imdb': [7.5, 1000 + n]}}
+
+
+class StubCP:
+
+    # The library holds movies offset + 1 .. offset + movies; search
+    # always finds movies 1 to 10
+    def __init__(self, movies=100, delay=0.0, host='127.0.0.1', port=0,
+                 offset=0):
+        self.movies = [fake_movie(n)
+                       for n in range(offset + 1, offset + movies + 1)]
+        self.delay = delay
+        self.requests = 0
+        self.connections = 0
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def setup(self):
+                BaseHTTPRequestHandler.setup(self)
+                stub.connections += 1
+
+            def do_GET(self):
+                stub.requests += 1
+                if stub.delay:
+                    time.sleep(stub.delay)
+                body = json.dumps(stub.answer(self.path)).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True)
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def answer(self, path):
+        url = urlparse(path)
+        parts = url.path.partition('/api/')[2].split('/')
+        action = parts[1] if len(parts) > 1 else ''
+        query = parse_qs(url.query)
+        if action == 'media.list':
+            return {'success': True, 'total': len(self.movies),
+                    'movies': self.movies}
+        if action == 'search':
+            q = query.get('q', [''])[0]
+            return {'success': True,
+                    'movies': [fake_search_hit(n) for n in range(1, 11)
+                               if q.lower() in 'movie %d' % n]}
+        return {'success': True}
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+from collections import OrderedDict
+
+
+# In-memory cache for Couchpotato media.list responses and search results.
+# Entries are keyed by the query string, expire after `ttl` seconds and the
+# least recently used one is evicted once `size` entries are stored.
+# Every invalidation bumps `generation`; a response fetched before the
+# latest invalidation is not stored, so a mutation racing with a slow
+# media.list never leaves stale data behind.
+# Cached responses are shared between callers and must not be modified.
+class MediaListCache:
+
+    def __init__(self, ttl, size):
+        self.ttl = ttl
+        self.size = size
+        self.entries = OrderedDict()
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def get(self, query):
+        with self.lock:
+            entry = self.entries.get(query)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self.entries[query]
+                return None
+            self.entries.move_to_end(query)
+            return value
+
+    def put(self, query, value, generation):
+        if self.size <= 0:
+            return
+        with self.lock:
+            if generation != self.generation:
+                return
+            self.entries[query] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(query)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    # Values of the entries which have not expired
+    def values(self):
+        now = time.monotonic()
+        with self.lock:
+            return [value for expires, value in self.entries.values()
+                    if expires >= now]
+
+    def invalidate(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+# Couchpotato media id of a media.list movie record
+def media_id_of(movie):
+    releases = movie.get('releases') or []
+    return movie.get('_id') or \
+        (releases[0]['media_id'] if releases else None)
+
+
+# Lookup table over one media.list response: IMDB id -> movie record, with
+# media id -> IMDB id for deletes. Built once per fetched response and
+# patched in place when the bot adds or deletes a movie.
+class MediaIndex:
+
+    def __init__(self, movies=()):
+        self.movies = {}
+        self.imdb_ids = {}
+        self.lock = threading.Lock()
+        for movie in movies:
+            self.add(movie)
+
+    def add(self, movie):
+        imdb = movie.get('identifiers', {}).get('imdb')
+        if not imdb:
+            return
+        media_id = media_id_of(movie)
+        with self.lock:
+            self.movies[imdb] = movie
+            if media_id:
+                self.imdb_ids[media_id] = imdb
+
+    def remove(self, media_id):
+        with self.lock:
+            imdb = self.imdb_ids.pop(media_id, None)
+            if imdb:
+                self.movies.pop(imdb, None)
+
+    def get(self, imdb):
+        return self.movies.get(imdb)
+
+    def __contains__(self, imdb):
+        return imdb in self.movies
+
+    def __len__(self):
+        return len(self.movies)
@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import logging
+import ssl
+import threading
+import time
+from urllib.parse import parse_qs
+
+import aiohttp
+
+import metrics
+from cp_cache import MediaIndex, MediaListCache
+from cp_stream import TRIMMERS, read_movies
+from models import Movie
+from settings import Settings
+
+logger = logging.getLogger(__name__)
+
+# Actions which change the Couchpotato library, so any cached
+# media.list response is stale after them
+MUTATING_ACTIONS = ('movie.add', 'movie.delete', 'release.manual_download')
+
+
+# Long-lived asynchronous CouchPotato API client.
+# One pooled aiohttp session is shared by all handlers, so consecutive
+# calls reuse keep-alive connections instead of doing a new TCP (and TLS)
+# handshake every time. Must be used from the bot's event loop.
+class CPClient:
+
+    def __init__(self, settings=Settings):
+        self.timeout = aiohttp.ClientTimeout(total=settings.cp_timeout)
+        self.bulk_workers = settings.cp_bulk_workers
+        self.base_url = '{scheme}://{host}:{port}{dir}/api/{api}/'.format(
+            scheme='https' if settings.cp_ssl else 'http',
+            host=settings.cp_hostname,
+            port=settings.cp_port,
+            dir=settings.cp_urlbase,
+            api=settings.cp_api)
+
+        self.retries = settings.cp_retries
+        self.backoff = settings.cp_backoff
+        self.pool_size = settings.cp_pool_size
+        self.stream = settings.cp_stream
+        if settings.cp_ssl_verify is True:
+            self.ssl = None
+        elif settings.cp_ssl_verify:
+            self.ssl = ssl.create_default_context(
+                cafile=settings.cp_ssl_verify)
+        else:
+            self.ssl = False
+        self.auth = None
+        if settings.cp_username:
+            self.auth = aiohttp.BasicAuth(settings.cp_username,
+                                          settings.cp_password)
+        self.session = None
+        self.media_cache = MediaListCache(settings.cp_cache_ttl,
+                                          settings.cp_cache_size)
+        # Index over the whole library, used for duplicate checks. It
+        # outlives cache invalidations because add/delete made by the bot
+        # are applied to it directly.
+        self.library = None
+        self.library_ttl = settings.cp_cache_ttl
+        self.library_expires = 0
+        # Search results by normalised text, never invalidated as they do
+        # not depend on the library
+        self.search_cache = MediaListCache(settings.search_cache_ttl,
+                                           settings.search_cache_size)
+        # Normalised text -> [task, callers waiting] of running searches
+        self.searches = {}
+
+    def url(self, action, query):
+        return self.base_url + action + '/' + query
+
+    def get_session(self):
+        if self.session is None:
+            connector = aiohttp.TCPConnector(limit=self.pool_size,
+                                             ssl=self.ssl)
+            self.session = aiohttp.ClientSession(connector=connector,
+                                                 auth=self.auth,
+                                                 timeout=self.timeout)
+        return self.session
+
+    # Returns decoded JSON of the response or None on connection errors.
+    # media.list is served from the cache while it is fresh.
+    async def request(self, action, query=''):
+        if action == 'media.list':
+            entry = await self.media_list(query)
+            return entry[0] if entry else None
+
+        result = await self.fetch(action, query)
+        if result is not None and action in MUTATING_ACTIONS:
+            self.media_cache.invalidate()
+            if result.get('success'):
+                self.update_library(action, query, result)
+        return result
+
+    # media.list response together with its MediaIndex
+    async def media_list(self, query=''):
+        entry = self.media_cache.get(query)
+        if entry is not None:
+            metrics.cache_requests.inc('media_list', 'hit')
+            logger.debug(u'media.list%s взят из кэша', query)
+            return entry
+        metrics.cache_requests.inc('media_list', 'miss')
+        generation = self.media_cache.generation
+        index = MediaIndex()
+        result = await self.fetch('media.list', query, index.add)
+        if result is None:
+            return None
+        if not self.stream:
+            index = MediaIndex(result.get('movies') or ())
+        entry = (result, index)
+        self.media_cache.put(query, entry, generation)
+        if not query:
+            self.library = entry[1]
+            self.library_expires = time.monotonic() + self.library_ttl
+        return entry
+
+    async def media_index(self, query=''):
+        entry = await self.media_list(query)
+        return entry[1] if entry else None
+
+    # Index of the whole library, refetched only after it expires
+    async def library_index(self):
+        if self.library is None or self.library_expires < time.monotonic():
+            metrics.cache_requests.inc('library', 'miss')
+            return await self.media_index('')
+        metrics.cache_requests.inc('library', 'hit')
+        return self.library
+
+    # Movies found by a search for `text`, a list of models.Movie, or None
+    # on errors. Callers asking for a text which is already being searched
+    # wait for that search instead of starting another, and the search is
+    # cancelled once every caller waiting for it is.
+    async def search(self, text):
+        key = search_key(text)
+        movies = self.search_cache.get(key)
+        if movies is not None:
+            metrics.cache_requests.inc('search', 'hit')
+            return movies
+        running = self.searches.get(key)
+        if running is None:
+            metrics.cache_requests.inc('search', 'miss')
+            running = self.searches[key] = [
+                asyncio.ensure_future(self.fetch_search(key, text)), 0]
+        else:
+            metrics.cache_requests.inc('search', 'shared')
+        running[1] += 1
+        try:
+            return await asyncio.shield(running[0])
+        finally:
+            running[1] -= 1
+            if not running[1] and not running[0].done():
+                running[0].cancel()
+                if self.searches.get(key) is running:
+                    del self.searches[key]
+
+    async def fetch_search(self, key, text):
+        generation = self.search_cache.generation
+        try:
+            result = await self.fetch('search', '?q=' + text)
+        finally:
+            running = self.searches.get(key)
+            if running is not None and running[0] is asyncio.current_task():
+                del self.searches[key]
+        if result is None:
+            return None
+        movies = []
+        for hit in result.get('movies') or ():
+            movie = Movie.from_search(hit)
+            if movie is None:
+                logger.warning("Missing fields in entry: %s" % hit)
+                continue
+            movies.append(movie)
+        self.search_cache.put(key, movies, generation)
+        return movies
+
+    # Cached results of a search for `text`, None when there are none
+    def searched(self, text):
+        return self.search_cache.get(search_key(text))
+
+    # A movie from the cached search results, None when it is not there
+    def searched_movie(self, imdb):
+        for movies in self.search_cache.values():
+            for movie in movies:
+                if movie.imdb == imdb:
+                    return movie
+        return None
+
+    def update_library(self, action, query, result):
+        library = self.library
+        if library is None:
+            return
+        params = parse_qs(query.lstrip('?'))
+        if action == 'movie.add':
+            movie = result.get('movie')
+            if not movie and 'identifier' in params:
+                movie = {'identifiers': {'imdb': params['identifier'][0]}}
+            if movie:
+                library.add(movie)
+        elif action == 'movie.delete':
+            for ids in params.get('id', ()):
+                for media_id in ids.split(','):
+                    library.remove(media_id)
+
+    # fetch_retrying() timed and failures counted per action
+    async def fetch(self, action, query, on_movie=None):
+        with metrics.cp_seconds.time(action):
+            result = await self.fetch_retrying(action, query, on_movie)
+        if result is None:
+            metrics.cp_errors.inc(action)
+        return result
+
+    # GET with retries on connection errors and 5xx responses, waiting
+    # backoff * 2 ** attempt seconds between attempts. MUTATING_ACTIONS are
+    # retried only when the connection could not be made, as the request
+    # may have been applied otherwise; the job queue retries the rest.
+    # media.list and search responses are parsed as a stream of trimmed
+    # movies when cp_stream is on, `on_movie(movie)` is called for each.
+    async def fetch_retrying(self, action, query, on_movie=None):
+        url = self.url(action, query)
+        mutating = action in MUTATING_ACTIONS
+        for attempt in range(self.retries + 1):
+            try:
+                async with self.get_session().get(url) as response:
+                    if response.status < 500 or mutating or \
+                            attempt == self.retries:
+                        response.raise_for_status()
+                        if self.stream and action in TRIMMERS:
+                            return await read_movies(response, action,
+                                                     on_movie)
+                        return await response.json(content_type=None)
+            except (aiohttp.ClientResponseError, ValueError) as error:
+                logger.error(u'Ошибка подключения к CouchPotato: {}'.
+                             format(error))
+                return None
+            except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+                if attempt == self.retries or mutating and not isinstance(
+                        error, aiohttp.ClientConnectorError):
+                    logger.error(u'Ошибка подключения к CouchPotato: {}'.
+                                 format(error))
+                    return None
+            await asyncio.sleep(self.backoff * 2 ** attempt)
+
+    # Runs many (action, query) calls concurrently, at most `workers` at a
+    # time. Returns the responses in order, None for failed calls.
+    async def bulk(self, calls, workers=None):
+        semaphore = asyncio.Semaphore(workers or self.bulk_workers)
+
+        async def limited(action, query):
+            async with semaphore:
+                return await self.request(action, query)
+        return await asyncio.gather(*(limited(*call) for call in calls))
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+
+# Texts searched for differ only in case and spacing
+def search_key(text):
+    return ' '.join(text.lower().split())
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+# Shared client, created on first use
+def get_client():
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = CPClient()
+        return _client
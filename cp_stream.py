@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+import logging
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+logger = logging.getLogger(__name__)
+
+# Fields of the info of a release shown in /avail
+RELEASE_INFO = ('name', 'protocol', 'size', 'url', 'provider', 'score',
+                'leechers', 'seeders')
+
+
+def _pick(source, names):
+    return {name: source[name] for name in names if name in source}
+
+
+# media.list movie record reduced to what the handlers read. The shape of
+# the record stays the same, so a trimmed movie can be used as a full one.
+def trim_movie(movie):
+    info = movie.get('info') or {}
+    trimmed = _pick(movie, ('_id', 'title', 'status'))
+    trimmed['identifiers'] = _pick(movie.get('identifiers') or {}, ('imdb',))
+    trimmed['info'] = _pick(info, ('year',))
+    trimmed['info']['titles'] = (info.get('titles') or [])[:1]
+    trimmed['releases'] = [
+        dict(_pick(release, ('_id', 'media_id', 'status')),
+             info=_pick(release.get('info') or {}, RELEASE_INFO))
+        for release in movie.get('releases') or ()]
+    return trimmed
+
+
+# search result reduced to what /q reads
+def trim_search_hit(hit):
+    trimmed = _pick(hit, ('imdb', 'year', 'in_library', 'in_wanted'))
+    trimmed['titles'] = (hit.get('titles') or [])[:1]
+    rating = (hit.get('rating') or {}).get('imdb')
+    if rating:
+        trimmed['rating'] = {'imdb': rating}
+    return trimmed
+
+
+TRIMMERS = {'media.list': trim_movie, 'search': trim_search_hit}
+
+
+# Reads the `movies` list of a media.list or search response from aiohttp
+# `response` one movie at a time, passing each trimmed movie to
+# `on_movie` (when given) as soon as it is parsed. Neither the raw body nor
+# the full decoded tree is held in memory. Returns the response as
+# {'success': True, 'movies': [trimmed movie]}.
+# Without ijson installed the body is decoded at once and trimmed after.
+async def read_movies(response, action, on_movie=None):
+    trim = TRIMMERS[action]
+    movies = []
+    if ijson is None:
+        result = await response.json(content_type=None)
+        if not isinstance(result, dict):
+            raise ValueError('unexpected response')
+        for movie in result.get('movies') or ():
+            movie = trim(movie)
+            movies.append(movie)
+            if on_movie is not None:
+                on_movie(movie)
+        return {'success': result.get('success', True), 'movies': movies}
+    try:
+        async for movie in ijson.items(response.content, 'movies.item',
+                                       use_float=True):
+            movie = trim(movie)
+            movies.append(movie)
+            if on_movie is not None:
+                on_movie(movie)
+    except ijson.JSONError as error:
+        raise ValueError(str(error))
+    return {'success': True, 'movies': movies}
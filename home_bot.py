@@ -1,21 +1,46 @@
 #! /usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import asyncio
+import html
 import logging
-import pickle
 import platform
 import re
-import subprocess
-from datetime import datetime, date, time
+import secrets
+import threading
+import time
+from datetime import datetime, date
 from functools import wraps
+from urllib.parse import urlparse
 
-from telegram import ChatAction, ParseMode, KeyboardButton
+from telegram import ChatAction, ParseMode
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
-from telegram import ReplyKeyboardMarkup, ReplyKeyboardRemove
-from telegram.ext import BaseFilter, Filters, CallbackQueryHandler
-from telegram.ext import Updater, CommandHandler, MessageHandler
-
+from telegram import InlineQueryResultArticle, InputTextMessageContent
+from telegram import KeyboardButton, ReplyKeyboardMarkup
+from telegram import ReplyKeyboardRemove, Update
+from telegram.ext import Updater, TypeHandler
+
+import aio
+import auth
+import jobs
+import links
+import metrics
+import pages
+import probe
+import sysinfo
+from cp_client import get_client
+from links import extract_links
+from magnet import get_resolver, info_hash, stop_resolver
+from models import Movie
+from notify import NotifyServer
+from router import Router
+from sampler import METRICS, get_sampler
+from sender import get_sender
 from settings import Settings
+from store import get_store
+from title_index import get_indexer
+from torrents import get_ingest
+from webhook import WebhookServer
 
 # Logging Configuration
 logging.basicConfig(
@@ -23,257 +48,500 @@ logging.basicConfig(
     level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+URL = re.compile(r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\(\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+',
+                 re.DOTALL)
+# media.list query behind /avail
+AVAIL_QUERY = '?release_status=available&status=active'
+# /stats windows: suffix -> seconds
+WINDOW_UNITS = {'m': 60, 'h': 3600, 'd': 86400}
+# User id -> task answering the latest inline query of the user
+inline_tasks = {}
+
 
 # Restricted access decorator
-# We are going to check user_id with allowed users from settings
-def restricted(func):
+# We are going to check user_id with allowed users from settings,
+# see auth.py for rate limits and repeated unauthorized senders.
+# @restricted(limited=False) skips the per-admin rate limit.
+def restricted(func=None, limited=True):
+    if func is None:
+        return lambda func: restricted(func, limited)
+
     @wraps(func)
-    def wrapped(bot, update, *args, **kwargs):
-        try:
-            user_id = update.message.from_user.id
-        except (NameError, AttributeError):
-            try:
-                user_id = update.inline_query.from_user.id
-            except (NameError, AttributeError):
-                try:
-                    user_id = update.chosen_inline_result.from_user.id
-                except (NameError, AttributeError):
-                    try:
-                        user_id = update.callback_query.from_user.id
-                    except (NameError, AttributeError):
-                        logger.warn("No user_id available in update.")
-                        return
-        if user_id not in Settings.admin_ids:
-            logger.warn(u"Доступ запрещен. UID: " + str(user_id))
-            bot.sendMessage(chat_id=update.message.chat_id,
-                            text=u"Доступ неавторизованным пользователям " +
-                            "запрещен!\n" +
-                            "https://www.youtube.com/watch?v=D1FWk_DP7rU")
+    async def wrapped(bot, update, *args, **kwargs):
+        user = update.effective_user
+        if user is None:
+            logger.warn("No user_id available in update.")
+            return
+        verdict = auth.get_auth().check(user.id, limited)
+        if verdict == auth.DENY:
+            logger.warn(u"Доступ запрещен. UID: " + str(user.id))
+            if update.effective_chat is not None:
+                await bot.sendMessage(chat_id=update.effective_chat.id,
+                                      text=u"Доступ неавторизованным пользователям " +
+                                      "запрещен!\n" +
+                                      "https://www.youtube.com/watch?v=D1FWk_DP7rU")
+            return
+        if verdict == auth.DROP:
+            logger.debug(u"Обновление отброшено. UID: " + str(user.id))
             return
-        return func(bot, update, *args, **kwargs)
+        return await func(bot, update, *args, **kwargs)
     return wrapped
 
 
 class CP:
 
     @restricted
-    def avail(bot, update):
-        result = CP.api_request('media.list', '?release_status=available&status=active')
+    async def avail(bot, update):
+        index = await get_client().media_index(AVAIL_QUERY)
         logger.info("Couchpotato получает список доступных к закачке фильмов")
-        if result:
-            bot.sendChatAction(chat_id=update.message.chat_id,
-                               action=ChatAction.TYPING)
-            for sublist in result['movies']:
-                logger.info('Couchpotato нашла: "' + sublist['title'] + '" ID: ' + sublist['releases'][0]['media_id'])
-                output = sublist['title'] + ' ' + \
-                    str(sublist['info']['year']) + '\n'
-                keyboard = [[InlineKeyboardButton("Скачать", callback_data='dow_' + sublist['identifiers']['imdb']),
-                             InlineKeyboardButton("Удалить", callback_data='del_' + sublist['releases'][0]['media_id'])]]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                # bot.sendPhoto(chat_id=update.message.chat_id, photo=open(sublist['files']['image_poster'][0], 'rb'))
-                bot.sendMessage(chat_id=update.message.chat_id,
-                                text=output, reply_markup=reply_markup)
-            with open('cache/cp_avail_' +
-                      str(update.message.chat_id), 'wb') as cache:
-                pickle.dump(result['movies'], cache)
+        if index is not None:
+            await bot.sendChatAction(chat_id=update.message.chat_id,
+                                     action=ChatAction.TYPING)
+            movies = [(imdb, Movie.from_media(record))
+                      for imdb, record in index.movies.items()]
+            for imdb, movie in movies:
+                logger.info('Couchpotato нашла: "' + movie.title + '" ID: ' + movie.media_id)
+            get_store().replace(update.message.chat_id, 'avail', movies)
+            get_store().delete(update.message.chat_id, 'sel')
+            set_id = pages.new_set(update.message.chat_id, 'a')
+            output, reply_markup = CP.avail_page(update.message.chat_id, set_id, 0)
+            # bot.sendPhoto(chat_id=update.message.chat_id, photo=open(sublist['files']['image_poster'][0], 'rb'))
+            get_sender().send(bot.sync.sendMessage, update.message.chat_id,
+                              text=output, parse_mode=ParseMode.HTML,
+                              reply_markup=reply_markup)
         else:
             logger.error(u"Не получена информация от media.list")
 
     @restricted
-    def button(bot, update):
+    async def button(bot, update):
         q = update.callback_query
         action = q.data[:4]
         movie_id = q.data[4:]
-        button_list = []
-        output = ''
-        max_entries = 5
-
-        with open('cache/cp_avail_' + str(q.message.chat_id), 'rb') as cache:
-            movies = pickle.load(cache)
 
         if (action == 'dow_'):
-            if movies:
-                logger.info(
-                    'Пытаемся найти в кэше доступные релизы для фильма с ID: ' +
-                    movie_id)
-                for entry in movies:
-                    if movie_id == entry['identifiers']['imdb']:
-                        movie_title = entry['info']['titles'][0] + ' ' + \
-                            str(entry['info']['year'])
-                        logger.info('Фильм ' + movie_id +
-                                    ' найден в кэше, получаем доступные релизы')
-                        i = 1
-                        output = output + '<b>' + movie_title + '</b>\n'
-                        for release in entry['releases']:
-                            output = output + \
-                                '<b>' + str(i) + '. 💿' + \
-                                release['info']['name'] + \
-                                release['info']['protocol'] + '</b>\n' + \
-                                str(release['info']['size']) + 'Mb | ' + \
-                                '<a href="' + release['info']['url'] + '">' + \
-                                release['info']['provider'] + '</a>' + \
-                                ' |score: ' + \
-                                str(release['info']['score']) + '|⇩' + \
-                                str(release['info']['leechers']) + '|⇧' + \
-                                str(release['info']['seeders']) + \
-                                '\n'
-                            button_list.append(InlineKeyboardButton(str(i), callback_data='add_' + release['_id']))
-                            reply_markup = InlineKeyboardMarkup(build_menu(button_list, n_cols=max_entries))
-                            logger.info('Найден релиз: ' + release['info']['name'])
-                            if i >= max_entries:
-                                break
-                            else:
-                                i = i + 1
-            else:
-                error = u"Нет доступа к закэшированным результатам cp_avail"
-                logger.error(error)
-                output = error
-            bot.editMessageText(text=output,
-                                chat_id=q.message.chat_id,
-                                message_id=q.message.message_id,
-                                parse_mode=ParseMode.HTML,
-                                reply_markup=reply_markup)
+            logger.info(
+                'Пытаемся найти в кэше доступные релизы для фильма с ID: ' +
+                movie_id)
+            set_id = pages.current_set(q.message.chat_id, 'a')
+            output, reply_markup = CP.release_page(q.message.chat_id, set_id, movie_id, 0)
+            await bot.sendMessage(chat_id=q.message.chat_id,
+                                  text=output,
+                                  parse_mode=ParseMode.HTML,
+                                  reply_markup=reply_markup)
         elif (action == 'del_'):
             logger.info('Удаляем релиз: ' + movie_id)
-            if (CP.api_request('movie.delete', '?id=' + movie_id)):
+            if (await CP.api_request('movie.delete', '?id=' + movie_id)):
                 logger.info('Релиз успешно удален')
-                bot.editMessageText(text='Удалено',
-                                chat_id=q.message.chat_id,
-                                message_id=q.message.message_id)
+                # Buttons carry the media id, the store is keyed by IMDB id
+                store = get_store()
+                for imdb, movie in store.items(q.message.chat_id, 'avail'):
+                    if movie.media_id == movie_id:
+                        store.delete(q.message.chat_id, 'avail', imdb)
+                        store.delete(q.message.chat_id, 'sel', imdb)
+                keyboard = [row for row in q.message.reply_markup.inline_keyboard
+                            if not any(b.callback_data == q.data for b in row)]
+                await bot.editMessageReplyMarkup(chat_id=q.message.chat_id,
+                                                 message_id=q.message.message_id,
+                                                 reply_markup=InlineKeyboardMarkup(keyboard))
+                await bot.answerCallbackQuery(q.id, text='Удалено')
             else:
                 logger.error('Релиз не удален из CP: ' + movie_id)
         elif (action == 'add_'):
             logger.info('Добавляем принудительно на закачку релиз: ' + movie_id)
-            if (CP.api_request('release.manual_download', '?id=' + movie_id)):
+            if (await CP.api_request('release.manual_download', '?id=' + movie_id)):
                 logger.info('Успешно добавлен на закачку')
-                bot.editMessageText(text='Релиз добавлен на закачку',
-                                chat_id=q.message.chat_id,
-                                message_id=q.message.message_id)
+                await bot.editMessageText(text='Релиз добавлен на закачку',
+                                      chat_id=q.message.chat_id,
+                                      message_id=q.message.message_id)
             else:
                 logger.error('Релиз не добавлен на закачку: ' + movie_id)
+        elif (action == 'qad_'):
+            entry = get_store().get(q.message.chat_id, 'query', movie_id)
+            if entry:
+                output = await movie_job(q.message.chat_id, entry.title,
+                                         movie_id)
+            else:
+                output = "Нет закэшированных результатов поиска"
+            await bot.sendMessage(chat_id=q.message.chat_id,
+                                  text=output if output else "None",
+                                  parse_mode=ParseMode.HTML)
+        elif (action == 'sel_'):
+            store = get_store()
+            entry = store.get(q.message.chat_id, 'avail', movie_id)
+            if entry:
+                selected = store.get(q.message.chat_id, 'sel', movie_id) is None
+                if selected:
+                    store.put(q.message.chat_id, 'sel', movie_id, True)
+                else:
+                    store.delete(q.message.chat_id, 'sel', movie_id)
+                mark = "✅" if selected else "☐"
+                keyboard = [[InlineKeyboardButton(mark if b.callback_data == q.data else b.text,
+                                                  callback_data=b.callback_data) for b in row]
+                            for row in q.message.reply_markup.inline_keyboard]
+                await bot.editMessageReplyMarkup(chat_id=q.message.chat_id,
+                                                 message_id=q.message.message_id,
+                                                 reply_markup=InlineKeyboardMarkup(keyboard))
+        elif (action == 'bul_'):
+            await CP.bulk(bot, q, movie_id[:2], movie_id[2:])
+        elif (action == pages.ACTION):
+            await CP.turn_page(bot, q)
+        elif (action == pages.NOOP):
+            await bot.answerCallbackQuery(q.id)
+
+    # Edit the message to show the page from a prev/next button.
+    # Release pages belong to the /avail result set they were opened from.
+    async def turn_page(bot, q):
+        kind, set_id, key, page = pages.parse(q.data)
+        owner = 'a' if kind == 'r' else kind
+        if set_id != pages.current_set(q.message.chat_id, owner):
+            await bot.answerCallbackQuery(q.id, text='Результаты устарели, повторите запрос')
+            return
+        if kind == 'q':
+            output, reply_markup = CP.query_page(q.message.chat_id, set_id, page)
+        elif kind == 'a':
+            output, reply_markup = CP.avail_page(q.message.chat_id, set_id, page)
+        else:
+            output, reply_markup = CP.release_page(q.message.chat_id, set_id, key, page)
+        await bot.editMessageText(text=output,
+                                  chat_id=q.message.chat_id,
+                                  message_id=q.message.message_id,
+                                  parse_mode=ParseMode.HTML,
+                                  disable_web_page_preview=True,
+                                  reply_markup=reply_markup)
+        await bot.answerCallbackQuery(q.id)
+
+    # Page of /q results with numbered buttons adding the movie
+    def query_page(chat_id, set_id, page):
+        size = Settings.page_size
+        rows, total = get_store().page(chat_id, 'query', page * size, size)
+        film_list = ""
+        button_list = []
+        for number, (imdb, entry) in enumerate(rows, page * size + 1):
+            year = entry.year if entry.year else "Unknown year"
+            imdb_rating = "\n"
+            if entry.rating is not None:
+                imdb_rating = "<i>%s/%s</i>\n" % (entry.rating, entry.votes)
+
+            href = "<a href=\"http://imdb.com/title/%s/\">" % imdb
+
+            film_list += str(number) + ". "
+            film_list += href + html.escape(entry.title) + "</a> " + \
+                str(year) + " "
+            film_list += imdb_rating
+            button_list.append(InlineKeyboardButton(str(number), callback_data='qad_' + imdb))
+        keyboard = build_menu(button_list, n_cols=5)
+        nav = pages.nav_row('q', set_id, page, pages.count(total, size))
+        if nav:
+            keyboard.append(nav)
+        output = "<b>Найдены следующие фильмы:</b>\n" + film_list
+        return output, InlineKeyboardMarkup(keyboard)
+
+    # Page of /avail movies, a row of buttons per movie and bulk actions
+    def avail_page(chat_id, set_id, page):
+        store = get_store()
+        size = Settings.page_size
+        rows, total = store.page(chat_id, 'avail', page * size, size)
+        selected = set(key for key, _ in store.items(chat_id, 'sel'))
+        output = u"Доступно фильмов: " + str(total) + '\n'
+        keyboard = []
+        for number, (imdb, movie) in enumerate(rows, page * size + 1):
+            output += str(number) + '. ' + html.escape(movie.title) + \
+                ' ' + str(movie.year) + '\n'
+            keyboard.append([InlineKeyboardButton(str(number) + ". Скачать", callback_data='dow_' + imdb),
+                             InlineKeyboardButton("Удалить", callback_data='del_' + movie.media_id),
+                             InlineKeyboardButton("✅" if imdb in selected else "☐", callback_data='sel_' + imdb)])
+        nav = pages.nav_row('a', set_id, page, pages.count(total, size))
+        if nav:
+            keyboard.append(nav)
+        if total:
+            keyboard += [[InlineKeyboardButton("Скачать все", callback_data='bul_dla'),
+                          InlineKeyboardButton("Удалить все", callback_data='bul_rma')],
+                         [InlineKeyboardButton("Скачать выбранные", callback_data='bul_dls'),
+                          InlineKeyboardButton("Удалить выбранные", callback_data='bul_rms')]]
+        return output, InlineKeyboardMarkup(keyboard)
+
+    # Page of releases for /avail movie `imdb`
+    def release_page(chat_id, set_id, imdb, page):
+        max_entries = 5
+        entry = get_store().get(chat_id, 'avail', imdb)
+        if not entry:
+            error = u"Нет доступа к закэшированным результатам cp_avail"
+            logger.error(error)
+            return error, None
+        movie_title = entry.title + ' ' + str(entry.year)
+        logger.info('Фильм ' + imdb +
+                    ' найден в кэше, получаем доступные релизы')
+        releases = entry.releases
+        output = '<b>' + html.escape(movie_title) + '</b>\n'
+        button_list = []
+        for i, release in enumerate(releases[page * max_entries:(page + 1) * max_entries],
+                                    page * max_entries + 1):
+            output = output + \
+                '<b>' + str(i) + '. 💿' + \
+                html.escape(release.name) + \
+                html.escape(release.protocol) + '</b>\n' + \
+                '{:g}'.format(release.size) + 'Mb | ' + \
+                '<a href="' + html.escape(release.url) + '">' + \
+                html.escape(release.provider) + '</a>' + \
+                ' |score: ' + \
+                '{:g}'.format(release.score) + '|⇩' + \
+                str(release.leechers) + '|⇧' + \
+                str(release.seeders) + \
+                '\n'
+            button_list.append(InlineKeyboardButton(str(i), callback_data='add_' + release.id))
+            logger.info('Найден релиз: ' + release.name)
+        keyboard = build_menu(button_list, n_cols=max_entries)
+        nav = pages.nav_row('r', set_id, page, pages.count(len(releases), max_entries), imdb)
+        if nav:
+            keyboard.append(nav)
+        return output, InlineKeyboardMarkup(keyboard)
+
+    # Bulk action over /avail results: 'dl' downloads the best scored
+    # release of every movie, 'rm' deletes the movies. `scope` is 'a' for
+    # all movies and 's' for the selected ones; 'rm' asks first and runs
+    # with the scope in upper case once confirmed, 'no' cancels it. Calls
+    # to Couchpotato run in parallel and one summary message is sent back.
+    async def bulk(bot, q, mode, scope):
+        store = get_store()
+        chat_id = q.message.chat_id
+        if mode == 'no':
+            await bot.editMessageText(text=u"Удаление отменено",
+                                      chat_id=chat_id,
+                                      message_id=q.message.message_id)
+            await bot.answerCallbackQuery(q.id)
+            return
+        movies = store.items(chat_id, 'avail')
+        if scope.lower() == 's':
+            selected = set(key for key, _ in store.items(chat_id, 'sel'))
+            movies = [(imdb, movie) for imdb, movie in movies if imdb in selected]
+        if not movies:
+            await bot.answerCallbackQuery(q.id, text=u"Нет фильмов для обработки")
+            return
+        if mode == 'rm' and scope.islower():
+            keyboard = [[InlineKeyboardButton(u"Да, удалить", callback_data='bul_rm' + scope.upper()),
+                         InlineKeyboardButton(u"Отмена", callback_data='bul_no')]]
+            await bot.answerCallbackQuery(q.id)
+            await bot.sendMessage(chat_id=chat_id,
+                                  text=u"Точно удалить " + str(len(movies)) + u" фильмов?",
+                                  reply_markup=InlineKeyboardMarkup(keyboard))
+            return
+        if mode == 'rm':
+            # Drop the buttons, so the deletion cannot be confirmed twice
+            await bot.editMessageText(text=u"Удаляем фильмов: " + str(len(movies)),
+                                      chat_id=chat_id,
+                                      message_id=q.message.message_id)
+
+        calls = []
+        titles = []
+        skipped = []
+        for imdb, movie in movies:
+            if mode == 'dl':
+                best = movie.best_release()
+                if best is None:
+                    skipped.append(movie.title)
+                    continue
+                calls.append(('release.manual_download', '?id=' + best.id))
+            else:
+                calls.append(('movie.delete', '?id=' + movie.media_id))
+            titles.append((imdb, movie.title))
+        logger.info('Массовое действие %s для %s фильмов', mode, len(calls))
+        await bot.answerCallbackQuery(q.id, text=u"Обрабатываем фильмов: " + str(len(calls)) + u"…")
+
+        results = await get_client().bulk(calls)
+        failed = []
+        for (imdb, title), result in zip(titles, results):
+            if result and result.get('success'):
+                store.delete(chat_id, 'avail', imdb)
+                store.delete(chat_id, 'sel', imdb)
+            else:
+                logger.error('Массовое действие %s не выполнено для %s', mode, imdb)
+                failed.append(title)
+
+        done = u"добавлено на закачку" if mode == 'dl' else u"удалено"
+        output = u"Успешно " + done + ": " + str(len(calls) - len(failed)) + \
+            u" из " + str(len(calls))
+        if failed:
+            output += u"\nОшибки:\n" + "\n".join(failed)
+        if skipped:
+            output += u"\nНет релизов:\n" + "\n".join(skipped)
+        await bot.sendMessage(chat_id=chat_id, text=output)
 
     @restricted
-    def query(bot, update):
+    async def query(bot, update):
 
-        bot.sendChatAction(chat_id=update.message.chat_id,
-                           action=ChatAction.TYPING)
-        result = CP.api_request("search", "?q=" + update.message.text[3:])
+        await bot.sendChatAction(chat_id=update.message.chat_id,
+                                 action=ChatAction.TYPING)
+        movies = await get_client().search(update.message.text[3:])
         logger.info("Couchpotato получает список фильмов по запросу: " + update.message.text[3:])
 
-        if "movies" in result:
-            button_list = []
-            film_list = ""
-            number = 1
-            for entry in result['movies']:
-                try:
-                    year = entry["year"] if "year" in entry else "Unknown year"
-                    imdb_rating = "\n"
-                    if "rating" in entry:
-                        imdb_rating = "<i>%s/%s</i>\n" % (entry['rating']['imdb'][0],
-                                                          entry['rating']['imdb'][1])
-
-                    href = "<a href=\"http://imdb.com/title/%s/\">" % entry["imdb"]
-
-                    film_list += str(number) + ". "
-                    film_list += href + entry["titles"][0] + "</a> " + str(year) + " "
-                    film_list += imdb_rating
-                    button_text = entry["titles"][0] + " " + str(year)
-                    button_list.append(KeyboardButton(text=button_text))
-                    number += 1
-                    logger.info("CouchPotato нашла кандидата: " +
-                                entry['titles'][0] + " IMDB ID: " + entry['imdb'])
-                except KeyError:
-                    logger.warning("Missing fields in entry: %s" % entry)
-
-            with open("cache/cp_" + str(update.message.chat_id), "wb") as cache:
-                pickle.dump(result['movies'], cache)
-            output = "<b>Найдены следующие фильмы:</b>\n" + film_list
-            reply_markup = ReplyKeyboardMarkup(build_menu(button_list, n_cols=1))
-
-            bot.sendMessage(chat_id=update.message.chat_id,
-                            text=output,
-                            reply_markup=reply_markup,
-                            parse_mode=ParseMode.HTML)
+        if movies:
+            cached = []
+            for movie in movies:
+                cached.append((movie.imdb, movie))
+                logger.info("CouchPotato нашла кандидата: " +
+                            movie.title + " IMDB ID: " + movie.imdb)
+
+            get_store().replace(update.message.chat_id, 'query', cached)
+            set_id = pages.new_set(update.message.chat_id, 'q')
+            output, reply_markup = CP.query_page(update.message.chat_id, set_id, 0)
+
+            await bot.sendMessage(chat_id=update.message.chat_id,
+                                  text=output,
+                                  reply_markup=reply_markup,
+                                  parse_mode=ParseMode.HTML)
         else:
             output = "Ничего не нашлось. Попробуйте другой вариант названия."
-            bot.sendMessage(chat_id=update.message.chat_id, text=output)
-
-    def api_request(action, query):
-        import requests
-        cp_url = 'http://{host}:{port}{dir}/api/{api}/{action}/{query}'.format(
-            host=Settings.cp_hostname,
-            port=Settings.cp_port,
-            dir=Settings.cp_urlbase,
-            api=Settings.cp_api,
-            action=action,
-            query=query)
+            await bot.sendMessage(chat_id=update.message.chat_id, text=output)
+
+    # @bot <title> in any chat: movies found for the text typed so far.
+    # Telegram sends a query on every keystroke; a query waits
+    # inline_debounce seconds and is cancelled, with its Couchpotato search,
+    # when a newer one from the same user arrives. Searches are shared with
+    # /q through the client's search cache. Every keystroke is a query, so
+    # they do not count against the admin's rate limit.
+    @restricted(limited=False)
+    async def inline(bot, update):
+        q = update.inline_query
+        user_id = q.from_user.id
+        previous = inline_tasks.get(user_id)
+        if previous is not None:
+            previous.cancel()
+        task = inline_tasks[user_id] = asyncio.current_task()
         try:
-            request = requests.get(cp_url, timeout=Settings.cp_timeout)
-            # For test purposes only:
-            # request = requests.get('http://pastebin.com/raw/FdRQb92H',
-            # timeout=Settings.cp_timeout)
-            if action == 'search' or action == 'media.list':
-                return request.json()
-            else:
-                return request.json()['success']
-        except requests.RequestException as error:
-            logger.error(u'Ошибка подключения к CouchPotato: {}'.
-                         format(error))
+            text = q.query.strip()
+            movies = get_client().searched(text)
+            if len(text) < Settings.inline_min_length:
+                movies = []
+            elif movies is None:
+                await asyncio.sleep(Settings.inline_debounce)
+                movies = await get_client().search(text)
+        except asyncio.CancelledError:
+            logger.debug(u"Inline-запрос %r заменен следующим", q.query)
+            raise
+        finally:
+            if inline_tasks.get(user_id) is task:
+                del inline_tasks[user_id]
+        if movies is None:
+            # Couchpotato is unreachable, offer what the title index knows.
+            # It lists a movie once per title, original and translated ones.
+            movies = get_indexer().lookup(text,
+                                          2 * Settings.inline_max_results)
+        # Result ids are IMDB ids and Telegram rejects repeated ones
+        results = []
+        seen = set()
+        for movie in movies:
+            if len(results) >= Settings.inline_max_results:
+                break
+            if movie.imdb not in seen:
+                seen.add(movie.imdb)
+                results.append(CP.inline_result(movie))
+        await bot.answerInlineQuery(q.id, results,
+                                    cache_time=Settings.inline_cache_time,
+                                    is_personal=True)
+
+    # Inline result for a models.Movie or title_index.Title
+    def inline_result(movie):
+        rating = getattr(movie, 'rating', None)
+        description = u"IMDB %s/%s" % (rating, movie.votes) \
+            if rating is not None else None
+        return InlineQueryResultArticle(
+            id=movie.imdb, title=movie.label(), description=description,
+            url='http://imdb.com/title/%s/' % movie.imdb,
+            input_message_content=InputTextMessageContent(
+                u'<a href="http://imdb.com/title/%s/">%s</a> %s' % (
+                    movie.imdb, html.escape(movie.title),
+                    movie.year or "Unknown year"),
+                parse_mode=ParseMode.HTML))
+
+    # A result picked from the inline results: add the movie. Telegram
+    # sends these only with inline feedback enabled in BotFather.
+    @restricted
+    async def chosen(bot, update):
+        result = update.chosen_inline_result
+        movie = get_client().searched_movie(result.result_id) or \
+            get_indexer().resolve(result.query)
+        title = movie.title if movie is not None else result.query
+        logger.info(u"Выбран inline-результат %s: %s", result.result_id, title)
+        output = await movie_job(result.from_user.id, title, result.result_id)
+        await bot.sendMessage(chat_id=result.from_user.id,
+                              text=output if output else "None",
+                              parse_mode=ParseMode.HTML)
+
+    async def api_request(action, query):
+        result = await get_client().request(action, query)
+        if result is None:
             return None
+        if action == 'search' or action == 'media.list':
+            return result
+        else:
+            return result.get('success')
 
 
 @restricted
-def plain_text(bot, update):
-    bot.sendChatAction(chat_id=update.message.chat_id,
-                       action=ChatAction.TYPING)
-    output = ""
-    try:
-        with open('cache/cp_' + str(update.message.chat_id), 'rb') as cache:
-            movies = pickle.load(cache)
-    except OSError:
-        output = "Нет закэшированных результатов поиска"
-        movies = ()
-    if movies:
-        movie_title = update.message.text[:-5]
-        movie_year = int(update.message.text[-4:])
-        for entry in movies:
-            if movie_title in entry['titles'] and movie_year == entry['year']:
-                logger.info("Фильм %s: %s найден, пробуем добавить в CouchPotato" %
-                            (movie_title, str(movie_year)))
-                output = add_movie(movie_title, entry['imdb'])
+async def plain_text(bot, update):
+    await bot.sendChatAction(chat_id=update.message.chat_id,
+                             action=ChatAction.TYPING)
+    # A title typed as "<title> <year>" from the last /q results, else
+    # looked up in the title index without asking Couchpotato. Anything
+    # else only gets suggestions, a tap on one adds the movie.
+    entry = None
+    for imdb, cached in get_store().items(update.message.chat_id, 'query'):
+        if update.message.text == cached.label():
+            entry = cached
+            break
+    if entry is None:
+        entry = get_indexer().resolve(update.message.text)
+    reply_markup = ReplyKeyboardRemove()
+    if entry:
+        movie_title = entry.title
+        logger.info("Фильм %s: %s найден, пробуем добавить в CouchPotato" %
+                    (movie_title, str(entry.year)))
+        output = await movie_job(update.message.chat_id, movie_title,
+                                 entry.imdb)
+    else:
+        # Offer close titles as a keyboard, a tap comes back here
+        found = get_indexer().lookup(update.message.text, 5)
+        if found:
+            output = "Возможно, вы имели в виду:"
+            reply_markup = ReplyKeyboardMarkup(
+                [[KeyboardButton(title.label())] for title in found],
+                one_time_keyboard=True, resize_keyboard=True)
+        else:
+            output = "Нет закэшированных результатов поиска"
 
     # FIXME: output still can be None. "" also isn't good for send_message's text parameter.
-    bot.send_message(chat_id=update.message.chat_id,
-                     text=output if output else "None",
-                     parse_mode=ParseMode.HTML,
-                     reply_markup=ReplyKeyboardRemove())
+    await bot.send_message(chat_id=update.message.chat_id,
+                           text=output if output else "None",
+                           parse_mode=ParseMode.HTML,
+                           reply_markup=reply_markup)
 
 
-def add_movie(movie_title, movie_id):
-    media_list = CP.api_request('media.list', '')
+# Adds the movie to Couchpotato and returns the text for the chat. Raises
+# RuntimeError when Couchpotato could not be asked or refused, so the
+# movie job is retried instead of keeping the error as its result.
+async def add_movie(movie_title, movie_id):
+    library = await get_client().library_index()
     logger.info("Couchpotato проверяет, есть ли такой фильм уже в ее базе: " +
                 movie_title + " IMDB ID:" + movie_id)
-    if media_list:
-        for sublist in media_list['movies']:
-            if movie_id == sublist['identifiers']['imdb']:
-                error = u"Couchpotato нашла этот фильм в своей базе. " + \
-                        u"Задание на поиск не добавлено."
-                logger.warn(error)
-                return error
-        else:
-            if CP.api_request('movie.add', '?identifier=' +
-                              movie_id + '&amp;title=' + movie_title):
-                output = u"Фильм добавлен в очередь на закачку " + \
-                         u"<a href=\"http://imdb.com/title/" + \
-                         movie_id + "\">" + movie_title + \
-                         "</a>\nCouchpotato попробует найти его и скачает," + \
-                         " а по завершении пришлет сообщение."
-            else:
-                output = u"Ошибка при добавлении фильма в CP (movie.add)"
-            logger.info(output)
-            return output
-    else:
+    if library is None:
         logger.error(u"Не получена информация от media.list")
+        raise RuntimeError(u"Не получена информация от media.list")
+    if movie_id in library:
+        error = u"Couchpotato нашла этот фильм в своей базе. " + \
+                u"Задание на поиск не добавлено."
+        logger.warn(error)
+        return error
+    if not await CP.api_request('movie.add', '?identifier=' +
+                                movie_id + '&amp;title=' + movie_title):
+        logger.error(u"Ошибка при добавлении фильма в CP (movie.add)")
+        raise RuntimeError(u"Ошибка при добавлении фильма в CP (movie.add)")
+    output = u"Фильм добавлен в очередь на закачку " + \
+             u"<a href=\"http://imdb.com/title/" + \
+             movie_id + "\">" + movie_title + \
+             "</a>\nCouchpotato попробует найти его и скачает," + \
+             " а по завершении пришлет сообщение."
+    logger.info(output)
+    return output
 
 
 # If we encounter updater's error we will log it
@@ -283,195 +551,317 @@ def error(bot, update, error):
 
 # /start command
 @restricted
-def start(bot, update):
-    bot.sendChatAction(chat_id=update.message.chat_id,
-                       action=ChatAction.TYPING)
-    bot.sendMessage(chat_id=update.message.chat_id,
-                    text="Привет, я " + bot.username +
-                    "! Набери /help для получения помощи")
+async def start(bot, update):
+    await bot.sendChatAction(chat_id=update.message.chat_id,
+                             action=ChatAction.TYPING)
+    await bot.sendMessage(chat_id=update.message.chat_id,
+                          text="Привет, я " + bot.username +
+                          "! Набери /help для получения помощи")
     logger.info(u"Пользователь ID:" +
                 str(update.message.chat_id) + " отправил команду /start")
 
 
 # /help command
 @restricted
-def help(bot, update):
+async def help(bot, update):
     help = """<b>/help</b> - Помощь
 <b>/q название фильма</b> - Поиск фильма и добавление в очередь на скачивание
-<b>/ping</b> - Пинг до гугла
+<b>@имя_бота название</b> - Поиск фильма в любом чате (inline-режим)
+<b>/ping</b> - Пинг до гугла, <b>/ping host1 host2</b> - до указанных хостов
 <b>/uptime</b> - Аптайм сервера
 <b>/free</b> - Свободная память
 <b>/systemp</b> - Температура сервера
+<b>/status</b> - Аптайм, память, диски и температура
+<b>/stats 6h</b> - Мин/средн/макс за период (m, h, d; по умолчанию 1h)
+<b>/metrics</b> - Время обработчиков, вызовы CouchPotato и Telegram
+<b>/jobs</b> - Очередь заданий: torrent-файлы, magnet-ссылки, фильмы
 
 Бот также принимает ссылки на страницы, где есть magnet-ссылки,
 а также сами magnet-ссылки и torrent-файлы
 ©2017, by @photopiter"""
-    bot.sendChatAction(chat_id=update.message.chat_id,
-                       action=ChatAction.TYPING)
-    bot.sendMessage(chat_id=update.message.chat_id,
-                    text=help, parse_mode=ParseMode.HTML)
+    await bot.sendChatAction(chat_id=update.message.chat_id,
+                             action=ChatAction.TYPING)
+    await bot.sendMessage(chat_id=update.message.chat_id,
+                          text=help, parse_mode=ParseMode.HTML)
     logger.info(u"Пользователь ID:" +
                 str(update.message.chat_id) + " отправил команду /help")
 
 
-# /ping command
+# /ping command, optionally with a list of hosts
 # This command is win/*nix compatible
 @restricted
-def ping(bot, update):
-    bot.sendChatAction(chat_id=update.message.chat_id,
-                       action=ChatAction.TYPING)
-    output = u"Пинг до гугла: " + str(do_ping("8.8.4.4", 2)) + u"мс."
-    bot.sendMessage(chat_id=update.message.chat_id, text=output)
+async def ping(bot, update):
+    await bot.sendChatAction(chat_id=update.message.chat_id,
+                             action=ChatAction.TYPING)
+    hosts = update.message.text.split()[1:] or Settings.ping_hosts
+    results = await do_ping(hosts[:Settings.ping_max_hosts],
+                            Settings.ping_count)
+    output = "\n".join(ping_text(result) for result in results)
+    await bot.sendMessage(chat_id=update.message.chat_id, text=output)
     logger.info(u"Пользователь ID:" +
                 str(update.message.chat_id) + " отправил команду /ping")
 
 
 # /uptime command
 # This command is win/*nix compatible
-# 'net stats srv' used @ windows systems
+# 'net stats srv' used @ windows systems, /proc/uptime elsewhere
 @restricted
-def uptime(bot, update):
-    bot.sendChatAction(chat_id=update.message.chat_id,
-                       action=ChatAction.TYPING)
-    if platform.system() == "Windows":
-        uptime = subprocess.check_output('net stats srv', shell=True)
+async def uptime(bot, update):
+    await bot.sendChatAction(chat_id=update.message.chat_id,
+                             action=ChatAction.TYPING)
+    output = sysinfo.uptime_text()
+    if output is None and platform.system() == "Windows":
+        uptime = await shell('net stats srv')
         matches = re.match('.*(\d{2}.\d{2}.\d{4}).*',
                            str(uptime), re.DOTALL)
         uptime = matches.group(1)
         start_date = datetime.date(datetime.strptime(uptime, '%d.%m.%Y'))
         current_date = date.today()
-        uptime = str(current_date - start_date)
-    else:
-        uptime = subprocess.check_output('uptime -p', shell=True)
-    bot.sendMessage(chat_id=update.message.chat_id,
-                    text=u'Аптайм: ' + uptime.decode('utf-8'))
+        output = u'Аптайм: ' + str(current_date - start_date)
+    await bot.sendMessage(chat_id=update.message.chat_id,
+                          text=output or u'Аптайм неизвестен')
     logger.info(u"Пользователь ID:" + str(update.message.chat_id) +
                 " отправил команду /uptime")
 
 
 @restricted
-def free(bot, update):
-    bot.sendChatAction(chat_id=update.message.chat_id,
-                       action=ChatAction.TYPING)
-    if platform.system() == "Windows":
+async def free(bot, update):
+    await bot.sendChatAction(chat_id=update.message.chat_id,
+                             action=ChatAction.TYPING)
+    mem = sysinfo.memory_text()
+    if mem is None and platform.system() == "Windows":
         # TODO: Format output
-        mem = subprocess.check_output('wmic OS get FreePhysicalMemory /Value',
-                                      shell=True)
-        hdd = subprocess.check_output('wmic /node:"%COMPUTERNAME%" LogicalDisk Where DriveType="3" Get DeviceID,FreeSpace',
-                                      shell=True)
+        mem = await shell('wmic OS get FreePhysicalMemory /Value')
+        hdd = await shell('wmic /node:"%COMPUTERNAME%" LogicalDisk Where DriveType="3" Get DeviceID,FreeSpace')
+        output = "Free RAM, Mb: " + str(mem) + "Free Disk: " + str(hdd)
     else:
-        mem = subprocess.check_output(r'free -m | sed -n "s/^Mem:\s\+[0-9]\+\s\+\([0-9]\+\)\s.\+/\1/p"',
-                                      shell=True).decode('utf-8')
-        hdd = subprocess.check_output(r"df -h | sed -n 4p | awk '{ print $4 }'",
-                                      shell=True).decode('utf-8')
-    output = "Free RAM, Mb: " + str(mem) + "Free Disk: " + str(hdd)
-    bot.sendMessage(chat_id=update.message.chat_id, text=output)
+        output = '\n'.join(part for part in (mem, sysinfo.disks_text()) if part) or \
+            u'Нет данных о памяти и дисках'
+    await bot.sendMessage(chat_id=update.message.chat_id, text=output)
     logger.info(u"Пользователь ID:" +
                 str(update.message.chat_id) + " отправил команду /free")
 
 
 @restricted
-def systemp(bot, update):
-    bot.sendChatAction(chat_id=update.message.chat_id,
-                       action=ChatAction.TYPING)
+async def systemp(bot, update):
+    await bot.sendChatAction(chat_id=update.message.chat_id,
+                             action=ChatAction.TYPING)
     if platform.system() == "Windows":
         output = u"Команда не доступна, потому что бот " + \
                  u"запущен на платформе " + platform.system()
     else:
-        output = subprocess.check_output(r'sensors | sed -ne "s/ Temp: \+[-+]\([0-9]\+\).*/: \1°C/p"',
-                                         shell=True).decode('utf-8')
-    bot.sendMessage(chat_id=update.message.chat_id, text=output)
+        output = sysinfo.temperatures_text() or \
+            u"Датчики температуры не найдены"
+    await bot.sendMessage(chat_id=update.message.chat_id, text=output)
     logger.info(u"Пользователь ID:" + str(update.message.chat_id) +
                 " отправил команду /systemp")
 
 
+# /status command: uptime, memory, disks and temperatures at once,
+# read from /proc, /sys and statvfs without running any commands
+@restricted
+async def status(bot, update):
+    output = sysinfo.status_text() + "\n" + \
+        u"Доступ: разрешено {allowed}, отказано {denied}, " \
+        u"отброшено {dropped}, лимит {limited}".format(
+            **auth.get_auth().counters)
+    await bot.sendMessage(chat_id=update.message.chat_id, text=output)
+    logger.info(u"Пользователь ID:" + str(update.message.chat_id) +
+                " отправил команду /status")
+
+
 @restricted
-def http_parse(bot, update, direct=True):
-    import requests
+async def http_parse(bot, update, direct=True):
     t = update.message.text
-    matches = re.match('http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\(\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+',
-                       t, re.DOTALL)
+    matches = URL.match(t)
     url = matches.group(0)
     logger.info(u"Пользователь ID:" + str(update.message.chat_id) +
                 " отправил команду ссылку на страницу " + url)
-    logger.info('Ищем magnet-ссылку по URL: ' + url)
-    r = requests.get(url)
-    magnet = re.search('href=[\'"]?(magnet[^\'" >]+)', r.text, re.DOTALL)
-    if magnet.group(1):
-        logger.info(u"Magnet-ссылка найдена на странице")
-        output = magnet_save(magnet.group(1))
-        if not output:
-            output = u"Magnet-ссылка не сохранена, потому что " + \
-                     u"бот запущен на платформе Windows"
-            logger.warn(output)
-        else:
-            logger.info(u"Magnet-ссылка сохранена")
-    else:
-        output = u'Magnet-ссылка не найдена на странице по ссылке.'
-        logger.warn(u"Magnet-ссылка не найдена на странице:" + url)
-    bot.sendMessage(chat_id=update.message.chat_id, text=output)
+    output = await run_job(update.message.chat_id, 'page', {'url': url},
+                           key=url)
+    await bot.sendMessage(chat_id=update.message.chat_id, text=output)
 
 
 @restricted
-def magnet_parse(bot, update, direct=True):
-    bot.sendChatAction(chat_id=update.message.chat_id,
-                       action=ChatAction.TYPING)
+async def magnet_parse(bot, update, direct=True):
+    await bot.sendChatAction(chat_id=update.message.chat_id,
+                             action=ChatAction.TYPING)
     logger.info(u"Пользователь ID:" +
                 str(update.message.chat_id) + " отправил Magnet-ссылку")
-    output = magnet_save(update.message.text)
-    bot.sendMessage(chat_id=update.message.chat_id, text=output)
+    magnet = update.message.text
+    output = await run_job(update.message.chat_id, 'magnet',
+                           {'magnet': magnet}, key=info_hash(magnet))
+    await bot.sendMessage(chat_id=update.message.chat_id, text=output)
 
 
-@restricted
-def torrent_save(bot, update, direct=True):
-    bot.sendChatAction(chat_id=update.message.chat_id,
-                       action=ChatAction.TYPING)
-    logger.info(u"Пользователь ID:" +
-                str(update.message.chat_id) + " отправил torrent-файл")
-    f = update.message.document
-    torrent_file = bot.getFile(f.file_id)
-    if torrent_file.download(Settings.torrent_path + f.file_name):
-        output = f.file_name + u' успешно загружен и передан на закачку.'
-        logger.info(output)
-    else:
-        output = u'Ошибка при сохранении torrent-файла.'
-        logger.warn(output)
-    bot.sendMessage(chat_id=update.message.chat_id, text=output)
+# Documents of albums being collected, (chat_id, media_group_id) -> list
+albums = {}
 
 
-def magnet_save(magnet):
+# A .torrent document, or an album of them: Telegram sends every file of
+# an album as an update of its own, so the first one waits
+# torrent_album_wait seconds for the rest and queues one job for all.
+@restricted
+async def torrent_save(bot, update, direct=True):
+    message = update.message
+    group = message.media_group_id
+    if group is not None:
+        files = albums.get((message.chat_id, group))
+        if files is not None:
+            files.append(message.document)
+            return
+        files = albums[message.chat_id, group] = [message.document]
+    await bot.sendChatAction(chat_id=message.chat_id,
+                             action=ChatAction.TYPING)
+    if group is not None:
+        await asyncio.sleep(Settings.torrent_album_wait)
+        del albums[message.chat_id, group]
+        key = 'album:%s' % group
+    else:
+        files = [message.document]
+        key = message.document.file_unique_id
+    logger.info(u"Пользователь ID:" + str(message.chat_id) +
+                " отправил torrent-файлы: %s" % len(files))
+    output = await run_job(message.chat_id, 'torrent', {'files': [
+        {'file_id': f.file_id, 'file_name': f.file_name} for f in files]},
+        key=key)
+    await bot.sendMessage(chat_id=message.chat_id, text=output)
+
+
+# Queues a job for the chat and waits up to `wait` seconds (jobs_wait by
+# default) for it to finish. Returns the text to answer with: the result,
+# or `queued` with the job number when the result comes later in a
+# message of its own.
+async def run_job(chat_id, kind, payload, key=None, wait=None, queued=None):
+    queue = jobs.get_jobs()
+    job, created = queue.submit(kind, payload, key, chat_id)
+    if not created and job.state not in (jobs.DONE, jobs.FAILED):
+        return u'Такое задание уже в очереди: ' + job.describe()
+    finished = await queue.wait(job.id, Settings.jobs_wait
+                                if wait is None else wait)
+    if finished is not None:
+        return finished.report()
+    return (queued or u'Задание поставлено в очередь.') + u'\n' + \
+        u'Задание ' + job.describe() + u', результат придет сообщением.'
+
+
+# Adds a movie to Couchpotato through the job queue, once per IMDB id
+async def movie_job(chat_id, movie_title, movie_id):
+    return await run_job(chat_id, 'movie', {'title': movie_title,
+                                            'imdb': movie_id}, key=movie_id)
+
+
+# Job functions, see jobs.py. Each gets the job and returns the text for
+# the chat; it raises JobFailed when retrying cannot help.
+def register_jobs(bot):
+    queue = jobs.get_jobs()
+
+    async def movie(job):
+        return await add_movie(job.payload['title'], job.payload['imdb'])
+
+    # Files saved before a retry come out as duplicates the next time
+    async def torrent(job):
+        files = job.payload.get('files') or [job.payload]
+        fetched = await asyncio.gather(*(bot.getFile(f['file_id'])
+                                         for f in files))
+        results = await get_ingest().fetch_all(
+            [(torrent_file, f['file_name'])
+             for torrent_file, f in zip(fetched, files)],
+            Settings.torrent_concurrency)
+        output = u'\n'.join(text for _, text in results)
+        outcomes = [outcome for outcome, _ in results]
+        if 'error' in outcomes:
+            raise RuntimeError(output)
+        if all(outcome == 'failed' for outcome in outcomes):
+            raise jobs.JobFailed(output)
+        return output
+
+    # Done once the resolver has the link: metadata may take minutes to
+    # come from the DHT, so the result is sent by the resolver's callback
+    # and no worker waits for it. A timeout there is not retried.
+    async def magnet(job):
+        saved = get_ingest().index.get(job.key) if job.key else None
+        if saved is not None:
+            return u'%s уже был добавлен раньше.' % saved
+        chat_id = job.chat_id
+
+        def done(text, ok):
+            if chat_id is not None:
+                get_sender().send(bot.sync.sendMessage, chat_id, text=text)
+        output = magnet_save(job.payload['magnet'], done)
+        if not output:
+            raise jobs.JobFailed(u"Magnet-ссылка не сохранена, потому что "
+                                 u"бот запущен на платформе Windows")
+        return output
+
+    async def page(job):
+        url = job.payload['url']
+        logger.info('Ищем magnet-ссылку по URL: ' + url)
+        found = await extract_links(url)
+        magnets = [link for kind, link in found if kind == 'magnet']
+        if not magnets:
+            logger.warn(u"Magnet-ссылка не найдена на странице:" + url)
+            raise jobs.JobFailed(
+                u'Magnet-ссылка не найдена на странице по ссылке.')
+        logger.info(u"Magnet-ссылка найдена на странице")
+        found, created = queue.submit('magnet', {'magnet': magnets[0]},
+                                      info_hash(magnets[0]), job.chat_id)
+        # The resolver reports to the chat of the magnet job only
+        if not created and found.chat_id != job.chat_id and \
+                found.state != jobs.FAILED:
+            saved = get_ingest().index.get(found.key) if found.key else None
+            if saved is not None:
+                return u'%s уже был добавлен раньше.' % saved
+            return u'Magnet-ссылка найдена на странице, такое задание ' + \
+                u'уже в очереди: ' + found.describe()
+        if found.state in (jobs.DONE, jobs.FAILED):
+            return found.report()
+        return u'Magnet-ссылка найдена на странице, получаем данные ' + \
+            u'торрента: задание ' + found.describe()
+
+    queue.register('movie', movie)
+    queue.register('torrent', torrent)
+    queue.register('magnet', magnet)
+    queue.register('page', page)
+
+
+# Callback for Couchpotato notifications: tells the admins and refreshes
+# the cached library and /avail results, so nobody has to poll /avail
+def cp_notification(bot):
+    prefetch = []
+
+    async def notify(event):
+        client = get_client()
+        client.media_cache.invalidate()
+        for chat_id in Settings.admin_ids:
+            if event['imdb'] and event['kind'] in ('snatched', 'downloaded'):
+                get_store().delete(chat_id, 'avail', event['imdb'])
+            get_sender().send(bot.sendMessage, chat_id,
+                              text=u'CouchPotato: ' + event['message'])
+        # Warm the cache for the next /avail, one refresh at a time
+        if not prefetch or prefetch[0].done():
+            prefetch[:] = [asyncio.ensure_future(
+                client.media_index(AVAIL_QUERY))]
+    return notify
+
+
+# Hands the magnet-link to the shared resolver. Returns the acknowledgement
+# text, `callback(text, ok)` gets the result once the .torrent is written.
+def magnet_save(magnet, callback):
     if platform.system() == "Windows":
         return False
-    import libtorrent
-    timeout = 30
-    params = libtorrent.parse_magnet_uri(magnet)
-    session = libtorrent.session()
-    handle = session.add_torrent(params)
-    timeout_value = timeout
-
-    while not handle.has_metadata():
-        time.sleep(0.1)
-        timeout_value -= 0.1
-        if timeout_value <= 0:
-            logger.error(u'Таймаут после %s секунд при получении \
-                         данных торрента с DHT/трекеров.',
-                         timeout)
-            return u'Таймаут после {} секунд при получении \
-                         данных торрента с DHT/трекеров.'.format(timeout)
-        else:
-            return u'Magnet-ссылка успешно передана на закачку'
-
-    torrent_info = handle.get_torrent_info()
-    torrent_file = libtorrent.create_torrent(torrent_info)
-    with open(Settings.torrent_path + torrent_info.name() +
-              ".torrent", "wb") as f:
-        f.write(libtorrent.bencode(torrent_file.generate()))
-    f.close()
+    try:
+        get_resolver().resolve(magnet, callback)
+    except (ImportError, RuntimeError, ValueError) as error:
+        logger.error(u'Ошибка при разборе magnet-ссылки: %s', error)
+        raise jobs.JobFailed(u'Ошибка при разборе magnet-ссылки.')
+    return u'Magnet-ссылка принята, получаем данные торрента ' + \
+        u'с DHT/трекеров, результат придет сообщением.'
 
 
-def unknown(bot, update):
-    bot.sendMessage(chat_id=update.message.chat_id,
-                    text='Извините, я не понимаю этой команды. Помощь: /help')
+async def unknown(bot, update):
+    await bot.sendMessage(chat_id=update.message.chat_id,
+                          text='Извините, я не понимаю этой команды. Помощь: /help')
 
 
 # Build Menu Helper
@@ -493,103 +883,257 @@ def build_menu(buttons: list,
     return menu
 
 
-# Internal function to do ping
-def do_ping(hostname, timeout):
-    if platform.system() == "Windows":
-        command = "ping " + hostname + " -n 1 -w " + str(timeout * 1000)
-        pattern = '.*xef=([0-9]+).*'
-    else:
-        command = "ping -i " + str(timeout) + " -c 1 " + hostname
-        pattern = '.*time=([0-9]+\.[0-9]+) ms.*'
-    proccess = subprocess.Popen(command, stdout=subprocess.PIPE, shell=True)
-    matches = re.match(pattern,
-                       str(proccess.stdout.read().decode('utf-8')), re.DOTALL)
-    if matches:
-        return matches.group(1)
-    else:
-        return False
+# /stats command: trends of the background samples over a window
+# such as 30m, 6h or 2d
+@restricted
+async def stats(bot, update):
+    args = update.message.text.split()[1:]
+    window = parse_window(args[0]) if args else 3600
+    if window is None:
+        await bot.sendMessage(chat_id=update.message.chat_id,
+                              text=u"Период задается как 30m, 6h или 2d")
+        return
+    lines = [u"За " + (args[0] if args else '1h') + ":"]
+    for name, summary in get_sampler().stats(window).items():
+        title, unit = METRICS[name]
+        if summary is None:
+            lines.append(title + u": нет данных")
+            continue
+        lines.append(u"{}, {}: мин {:.1f} / средн {:.1f} / макс {:.1f}, "
+                     u"p50 {:.1f}, p95 {:.1f} ({} замеров)".format(
+                         title, unit, summary['min'], summary['avg'],
+                         summary['max'], summary['p50'], summary['p95'],
+                         summary['count']))
+    await bot.sendMessage(chat_id=update.message.chat_id,
+                          text="\n".join(lines))
+    logger.info(u"Пользователь ID:" + str(update.message.chat_id) +
+                " отправил команду /stats")
 
 
-def Filter(f):
-    def filter_wrapper(self, message):
-        return f(self, message)
-    return type(f.__name__, (BaseFilter,), {'__call__': filter_wrapper})()
+# /metrics command: summary of the handler, Couchpotato and Telegram
+# metrics also served by the metrics endpoint
+@restricted
+async def metrics_command(bot, update):
+    await bot.sendMessage(chat_id=update.message.chat_id,
+                          text=metrics.summary_text()[:4000])
+    logger.info(u"Пользователь ID:" + str(update.message.chat_id) +
+                " отправил команду /metrics")
 
 
-@Filter
-def torrent_file(self, message):
-    t = message.document
-    return bool(t and t.mime_type == 'application/x-bittorrent')
+# /jobs command: jobs by state and the latest ones
+@restricted
+async def jobs_command(bot, update):
+    queue = jobs.get_jobs()
+    counts = queue.counts()
+    lines = [u'Заданий: ' + u', '.join(
+        u'%s %s' % (state, counts.get(state, 0))
+        for state in (jobs.QUEUED, jobs.RUNNING, jobs.DONE, jobs.FAILED))]
+    now = time.time()
+    for job in queue.recent():
+        lines.append(u'%s: %s, попыток %s, %s назад' % (
+            job.describe(), job.state, job.attempts,
+            sysinfo.format_uptime(now - job.created)))
+    await bot.sendMessage(chat_id=update.message.chat_id,
+                          text=u'\n'.join(lines)[:4000])
+    logger.info(u"Пользователь ID:" + str(update.message.chat_id) +
+                " отправил команду /jobs")
+
+
+# Seconds in a window like "30m", "6h", "2d" or a bare number of minutes
+def parse_window(text):
+    unit = WINDOW_UNITS.get(text[-1:].lower())
+    number = text[:-1] if unit else text
+    try:
+        value = float(number)
+    except ValueError:
+        return None
+    return value * (unit or 60) if value > 0 else None
+
+
+# Ping latency of the first host in ping_hosts for the sampler thread,
+# in ms or None
+def ping_probe():
+    result, = aio.run(do_ping(Settings.ping_hosts[:1], 1), timeout=10)
+    return result.avg
+
+
+# Internal function to do ping: `count` probes to every host at once
+async def do_ping(hosts, count):
+    return await probe.ping_many(hosts, count,
+                                 timeout=Settings.ping_timeout,
+                                 port=Settings.ping_tcp_port)
+
+
+def ping_text(result):
+    if result.error:
+        return u"{}: {}".format(result.host, result.error)
+    if not result.received:
+        return u"{}: нет ответа".format(result.host)
+    return u"{}: {:.1f} мс (мин {:.1f}, макс {:.1f}, джиттер {:.1f}), " \
+        u"потери {:.0f}%, {}".format(result.host, result.avg, result.min,
+                                    result.max, result.jitter, result.loss,
+                                    result.method.upper())
+
+
+# Output of a shell command, run without blocking the event loop
+async def shell(command):
+    process = await asyncio.create_subprocess_shell(
+        command, stdout=asyncio.subprocess.PIPE)
+    output, _ = await process.communicate()
+    return output
+
+
+# Routes every update through one Router, see router.py
+def add_handlers(dp):
+    router = Router()
+    # Commands
+    router.command('start', aio.handler(start))
+    router.command('help', aio.handler(help))
+    router.command('ping', aio.handler(ping))
+    router.command('uptime', aio.handler(uptime))
+    router.command('free', aio.handler(free))
+    router.command('systemp', aio.handler(systemp))
+    router.command('status', aio.handler(status))
+    router.command('stats', aio.handler(stats))
+    router.command('metrics', aio.handler(metrics_command))
+    router.command('jobs', aio.handler(jobs_command))
+
+    # Commands for couchpotato
+    router.command('q', aio.handler(CP.query))
+    router.command('avail', aio.handler(CP.avail))
+    router.on('callback', aio.handler(CP.button))
+    router.on('inline', aio.handler(CP.inline))
+    router.on('chosen', aio.handler(CP.chosen))
+
+    # Text without /: http and magnet: links, also text for couchpotato
+    # finder, and torrent files
+    router.on('magnet', aio.handler(magnet_parse))
+    router.on('http', aio.handler(http_parse))
+    router.on('torrent', aio.handler(torrent_save))
+    router.on('text', aio.handler(plain_text))
+
+    # Also for unknown command
+    router.on('unknown', aio.handler(unknown))
 
+    logger.info(u"Инициализация диспатчеров")
+    dp.add_handler(TypeHandler(Update, router.dispatch))
 
-@Filter
-def magnet(self, message):
-    return bool(message.text and message.text.startswith('magnet'))
+    # Log errors
+    dp.add_error_handler(error)
+    return router
+
+
+# Start receiving updates: by webhook when tg_webhook_url is set, by
+# polling otherwise. Returns the webhook server or None.
+def start_updates(u):
+    if not Settings.tg_webhook_url:
+        # start_polling() also deletes a webhook left by an earlier run
+        u.start_polling()
+        return None
+    secret = Settings.tg_webhook_secret or secrets.token_urlsafe(32)
+    server = WebhookServer(u.bot, u.update_queue,
+                           Settings.tg_webhook_listen,
+                           Settings.tg_webhook_port,
+                           urlparse(Settings.tg_webhook_url).path or '/',
+                           secret,
+                           Settings.tg_webhook_cert or None,
+                           Settings.tg_webhook_key or None)
+    aio.run(server.start())
+    threading.Thread(target=u.dispatcher.start, name='dispatcher',
+                     daemon=True).start()
+    # u.idle() stops the dispatcher on a signal only while running is set
+    u.running = True
+    if Settings.tg_webhook_self_signed:
+        with open(Settings.tg_webhook_cert, 'rb') as certificate:
+            u.bot.set_webhook(url=Settings.tg_webhook_url,
+                              certificate=certificate, secret_token=secret)
+    else:
+        u.bot.set_webhook(url=Settings.tg_webhook_url, secret_token=secret)
+    logger.info(u"Обновления приходят на вебхук " + Settings.tg_webhook_url)
+    return server
 
 
-@Filter
-def http_link(self, message):
-    return bool(message.text and message.text.startswith('http'))
+# Updater for the handlers above, which take (bot, update): python-telegram-bot
+# 13 passes (update, context) unless use_context is off. `kwargs` go to
+# Updater, e.g. base_url of a local Bot API server.
+def make_updater(**kwargs):
+    return Updater(token=Settings.token, use_context=False, **kwargs)
 
 
-# Start point. Here we go
-def main():
-    # Updater Initialization
-    logger.info(u"Инициализация")
-    u = Updater(token=Settings.token)
-    logger.info(u"Апдейтер запущен")
+# Starts everything the bot runs around Updater `u`: the sampler, the
+# notify and metrics servers, the title index, the handlers, the job queue
+# and receiving updates. Returns a function stopping all of it. main() and
+# the load test in bench/ start the bot through here.
+def start_bot(u):
     dp = u.dispatcher
+    aio.get_loop()
+    get_sampler().probe('ping', ping_probe)
+    get_sampler().start()
+    notify_server = None
+    if Settings.notify_port:
+        notify_server = NotifyServer(Settings.notify_host,
+                                     Settings.notify_port,
+                                     Settings.notify_path,
+                                     Settings.notify_token,
+                                     cp_notification(u.bot))
+        try:
+            aio.run(notify_server.start())
+        except OSError as error:
+            logger.error(u"Не удалось открыть порт для уведомлений: %s", error)
+            notify_server = None
+
+    metrics_server = None
+    if Settings.metrics_port:
+        metrics_server = metrics.MetricsServer(Settings.metrics_host,
+                                               Settings.metrics_port)
+        try:
+            aio.run(metrics_server.start())
+        except OSError as error:
+            logger.error(u"Не удалось открыть порт для метрик: %s", error)
+            metrics_server = None
 
-    # Initialize handlers
-    start_handler = CommandHandler('start', start)
-    help_handler = CommandHandler('help', help)
-    ping_handler = CommandHandler('ping', ping)
-    uptime_handler = CommandHandler('uptime', uptime)
-    free_handler = CommandHandler('free', free)
-    systemp_handler = CommandHandler('systemp', systemp)
-    cp_query_handler = CommandHandler('q', CP.query)
-    cp_avail_handler = CommandHandler('avail', CP.avail)
-    magnet_handler = MessageHandler(magnet, magnet_parse)
-    http_handler = MessageHandler(http_link, http_parse)
-    torrent_file_handler = MessageHandler(torrent_file, torrent_save)
-    plaintext_handler = MessageHandler(Filters.text, plain_text)
-    unknown_handler = MessageHandler(Filters.command, unknown)
-    button_handler = CallbackQueryHandler(CP.button)
+    titles = aio.submit(get_indexer().run(get_client()))
 
-    logger.info(u"Инициализация диспатчеров")
-    # Initialize dispatchers for commands
-    dp.add_handler(start_handler)
-    dp.add_handler(help_handler)
-    dp.add_handler(ping_handler)
-    dp.add_handler(uptime_handler)
-    dp.add_handler(systemp_handler)
-    dp.add_handler(free_handler)
-    dp.add_handler(button_handler)
-
-    # Dispatchers for text commands without /
-    # This is http and magnet: links, also text for couchpotato finder
-    dp.add_handler(magnet_handler)
-    dp.add_handler(http_handler)
-    dp.add_handler(torrent_file_handler)
-    dp.add_handler(plaintext_handler)
-
-    # Dispatchers for couchpotato
-    dp.add_handler(cp_query_handler)
-    dp.add_handler(cp_avail_handler)
+    add_handlers(dp)
+    register_jobs(aio.AsyncBot(u.bot))
+    aio.run(jobs.get_jobs().start(
+        lambda chat_id, text: get_sender().send(u.bot.sendMessage, chat_id,
+                                                text=text)))
 
-    # Also for unknown command
-    dp.add_handler(unknown_handler)
+    logger.info(u"Запуск очереди сообщений === Конец инициализации")
+    # Start polling or the webhook
+    webhook_server = start_updates(u)
+
+    def stop():
+        u.stop()
+        get_sampler().stop()
+        titles.cancel()
+        closing = [jobs.get_jobs().stop(), get_client().close(),
+                   links.close()]
+        if webhook_server is not None:
+            closing.insert(0, webhook_server.stop())
+        if notify_server is not None:
+            closing.insert(0, notify_server.stop())
+        if metrics_server is not None:
+            closing.insert(0, metrics_server.stop())
+        aio.shutdown(*closing)
+        # After the job queue, so no magnet job starts on a closed session
+        stop_resolver()
+    return stop
 
-    # Log errors
-    dp.add_error_handler(error)
 
-    logger.info(u"Запуск очереди сообщений === Конец инициализации")
-    # Start polling
-    u.start_polling()
+# Start point. Here we go
+def main():
+    # Updater Initialization
+    logger.info(u"Инициализация")
+    u = make_updater()
+    logger.info(u"Апдейтер запущен")
+    stop = start_bot(u)
     # Run the bot until the you presses Ctrl-C or the process receives SIGINT,
     # SIGTERM or SIGABRT. This should be used most of the time, since
     # start_polling() is non-blocking and will stop the bot gracefully.
     u.idle()
+    stop()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import metrics
+from sender import TokenBucket
+from settings import Settings
+
+logger = logging.getLogger(__name__)
+
+# Job states
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    key TEXT,
+    payload TEXT NOT NULL,
+    chat_id INTEGER,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    run_at REAL NOT NULL,
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    result TEXT
+);
+CREATE UNIQUE INDEX IF NOT EXISTS jobs_live_key ON jobs (kind, key)
+    WHERE key IS NOT NULL AND state IN ('queued', 'running');
+CREATE INDEX IF NOT EXISTS jobs_ready ON jobs (state, run_at);
+CREATE INDEX IF NOT EXISTS jobs_updated ON jobs (updated);
+'''
+COLUMNS = ('id', 'kind', 'key', 'payload', 'chat_id', 'state', 'attempts',
+           'run_at', 'created', 'updated', 'result')
+SELECT = 'SELECT ' + ', '.join(COLUMNS) + ' FROM jobs '
+# Longest sleep of an idle worker, finished jobs are purged as often
+IDLE = 60
+
+jobs_total = metrics.Counter('bot_jobs_total', 'Finished jobs by outcome',
+                             ('kind', 'outcome'))
+
+
+# Raised by a job function for failures which a retry cannot fix
+class JobFailed(Exception):
+    pass
+
+
+# One row of the jobs table
+class Job:
+
+    __slots__ = COLUMNS
+
+    def __init__(self, *values):
+        for name, value in zip(COLUMNS, values):
+            setattr(self, name, value)
+        self.payload = json.loads(self.payload)
+
+    # "#12 magnet 1f0e…" for messages and /jobs
+    def describe(self):
+        key = self.key or ''
+        if len(key) > 40:
+            key = key[:39] + u'…'
+        return (u'#%d %s %s' % (self.id, self.kind, key)).rstrip()
+
+    # What the chat is told once the job has finished
+    def report(self):
+        if self.state == FAILED:
+            return u'Задание %s не выполнено: %s' % (self.describe(),
+                                                      self.result)
+        return self.result or u'Задание %s выполнено' % self.describe()
+
+
+# Durable queue of slow jobs: torrent files, magnet and page links and
+# movie adds. Jobs are rows of an SQLite table, so a restart loses none;
+# jobs left running by a restart are queued again. `workers` coroutines
+# on the bot's loop run them, starting at most `rate` jobs per second, so
+# a burst of links is worked off at a steady pace. A job which raises is
+# retried `retries` times, waiting backoff * 2 ** attempt seconds; one
+# raising JobFailed fails at once.
+# Jobs may carry an idempotency key (info-hash, IMDB id, URL): while a
+# job with the key is queued or running, or finished less than
+# `dedup_ttl` seconds ago, submitting it again returns that job.
+# Used from the event loop only.
+class JobQueue:
+
+    def __init__(self, path, workers, retries, backoff, rate, timeout,
+                 dedup_ttl, keep):
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.dedup_ttl = dedup_ttl
+        self.keep = keep
+        self.bucket = TokenBucket(rate, 1)
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(SCHEMA)
+        with self.db:
+            recovered = self.db.execute(
+                'UPDATE jobs SET state = ? WHERE state = ?',
+                (QUEUED, RUNNING)).rowcount
+        if recovered:
+            logger.info(u'Задания, прерванные перезапуском, снова в '
+                        u'очереди: %s', recovered)
+        # kind -> coroutine function(job) returning the result text
+        self.kinds = {}
+        # job id -> futures of callers waiting for the job
+        self.waiters = {}
+        self.tasks = []
+        self.wakeup = None
+        self.notify = None
+
+    # Jobs of `kind` are run by `await func(job)`
+    def register(self, kind, func):
+        self.kinds[kind] = func
+
+    def get(self, job_id):
+        row = self.db.execute(SELECT + 'WHERE id = ?', (job_id,)).fetchone()
+        return Job(*row) if row else None
+
+    # Queue a job. Returns (job, True) or, when a job with the same `key`
+    # is live or finished recently, (that job, False).
+    def submit(self, kind, payload, key=None, chat_id=None):
+        now = time.time()
+        if key is not None:
+            row = self.db.execute(
+                SELECT + 'WHERE kind = ? AND key = ? AND (state IN (?, ?) '
+                'OR state = ? AND updated > ?) ORDER BY id DESC LIMIT 1',
+                (kind, key, QUEUED, RUNNING, DONE,
+                 now - self.dedup_ttl)).fetchone()
+            if row:
+                return Job(*row), False
+        with self.db:
+            cursor = self.db.execute(
+                'INSERT INTO jobs (kind, key, payload, chat_id, state, '
+                'run_at, created, updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (kind, key, json.dumps(payload), chat_id, QUEUED, now, now,
+                 now))
+        if self.wakeup is not None:
+            self.wakeup.set()
+        job = self.get(cursor.lastrowid)
+        logger.info(u'Задание %s поставлено в очередь', job.describe())
+        return job, True
+
+    # The job once it has finished, None when it is still queued or
+    # running after `timeout` seconds
+    async def wait(self, job_id, timeout):
+        job = self.get(job_id)
+        if job is None or job.state in (DONE, FAILED):
+            return job
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.setdefault(job_id, []).append(future)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            futures = self.waiters.get(job_id)
+            if futures and future in futures:
+                futures.remove(future)
+                if not futures:
+                    del self.waiters[job_id]
+
+    # Start the workers. `notify(chat_id, text)` reports finished jobs
+    # nobody waits for.
+    async def start(self, notify):
+        self.notify = notify
+        self.wakeup = asyncio.Event()
+        self.tasks = [asyncio.ensure_future(self.worker())
+                      for _ in range(self.workers)]
+
+    # Jobs being run stay in the running state and are run again after
+    # the restart
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.db.close()
+
+    async def worker(self):
+        while True:
+            wait = self.bucket.wait(time.monotonic())
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            job, delay = self.claim()
+            if job is None:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    self.purge()
+                continue
+            self.bucket.take(time.monotonic())
+            await self.execute(job)
+
+    # The next due job, marked running, or (None, seconds until one is due)
+    def claim(self):
+        now = time.time()
+        row = self.db.execute(
+            SELECT + 'WHERE state = ? ORDER BY run_at, id LIMIT 1',
+            (QUEUED,)).fetchone()
+        if row is None:
+            return None, IDLE
+        job = Job(*row)
+        if job.run_at > now:
+            return None, min(IDLE, job.run_at - now)
+        job.state = RUNNING
+        job.attempts += 1
+        with self.db:
+            self.db.execute(
+                'UPDATE jobs SET state = ?, attempts = ?, updated = ? '
+                'WHERE id = ?', (RUNNING, job.attempts, now, job.id))
+        return job, 0
+
+    async def execute(self, job):
+        func = self.kinds.get(job.kind)
+        try:
+            if func is None:
+                raise JobFailed(u'неизвестный тип задания')
+            result = await asyncio.wait_for(func(job), self.timeout or None)
+        except JobFailed as error:
+            self.finish(job, FAILED, str(error))
+        except Exception as error:
+            text = str(error) or type(error).__name__
+            if job.attempts > self.retries:
+                logger.error(u'Задание %s не выполнено после %s попыток: %s',
+                             job.describe(), job.attempts, text)
+                self.finish(job, FAILED, text)
+                return
+            delay = self.backoff * 2 ** (job.attempts - 1)
+            logger.warning(u'Задание %s: %s, повтор через %s с',
+                           job.describe(), text, delay)
+            now = time.time()
+            with self.db:
+                self.db.execute(
+                    'UPDATE jobs SET state = ?, run_at = ?, updated = ?, '
+                    'result = ? WHERE id = ?',
+                    (QUEUED, now + delay, now, text, job.id))
+            jobs_total.inc(job.kind, 'retried')
+        else:
+            self.finish(job, DONE, result)
+
+    def finish(self, job, state, result):
+        job.state = state
+        job.result = result
+        job.updated = time.time()
+        with self.db:
+            self.db.execute(
+                'UPDATE jobs SET state = ?, result = ?, updated = ? '
+                'WHERE id = ?', (state, result, job.updated, job.id))
+        jobs_total.inc(job.kind, state)
+        logger.info(u'Задание %s: %s', job.describe(), state)
+        waiting = [future for future in self.waiters.pop(job.id, ())
+                   if not future.done()]
+        for future in waiting:
+            future.set_result(job)
+        if not waiting and job.chat_id is not None and self.notify:
+            self.notify(job.chat_id, job.report())
+
+    def purge(self):
+        with self.db:
+            self.db.execute('DELETE FROM jobs WHERE state IN (?, ?) AND '
+                            'updated < ?',
+                            (DONE, FAILED, time.time() - self.keep))
+
+    # {state: number of jobs}
+    def counts(self):
+        return dict(self.db.execute(
+            'SELECT state, COUNT(*) FROM jobs GROUP BY state'))
+
+    # Latest jobs, newest first
+    def recent(self, limit=10):
+        return [Job(*row) for row in self.db.execute(
+            SELECT + 'ORDER BY id DESC LIMIT ?', (limit,))]
+
+
+_jobs = None
+_jobs_lock = threading.Lock()
+
+
+# Shared queue, created on first use and started by the bot
+def get_jobs():
+    global _jobs
+    with _jobs_lock:
+        if _jobs is None:
+            _jobs = JobQueue(Settings.jobs_db, Settings.jobs_workers,
+                             Settings.jobs_retries, Settings.jobs_backoff,
+                             Settings.jobs_rate, Settings.jobs_timeout,
+                             Settings.jobs_dedup_ttl, Settings.jobs_keep)
+        return _jobs
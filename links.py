@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import re
+from urllib.parse import urljoin
+
+import aiohttp
+
+from settings import Settings
+
+logger = logging.getLogger(__name__)
+
+MAGNET = re.compile(rb'href=[\'"]?(magnet:[^\'" >]+)', re.IGNORECASE)
+TORRENT = re.compile(rb'href=[\'"]?([^\'" >]+?\.torrent)(?=[?#\'" >])',
+                     re.IGNORECASE)
+CHUNK_SIZE = 16384
+# Longest link we are able to find across chunk boundaries
+MAX_LINK = 8192
+
+_session = None
+
+
+# Incremental link scanner, fed with page chunks as they arrive.
+# A match running up to the end of the buffer may continue in the next
+# chunk, so it is kept back until more data (or the end of page) is seen.
+class LinkScanner:
+
+    def __init__(self, base_url, torrents=False):
+        self.base_url = base_url
+        self.patterns = [('magnet', MAGNET)]
+        if torrents:
+            self.patterns.append(('torrent', TORRENT))
+        self.buffer = b''
+        self.seen = set()
+
+    # Returns (kind, link) pairs completed by `chunk`
+    def feed(self, chunk, final=False):
+        buffer = self.buffer + chunk
+        scanned = len(buffer)
+        hits = []
+        for kind, pattern in self.patterns:
+            for match in pattern.finditer(buffer):
+                if match.end() == len(buffer) and not final:
+                    scanned = min(scanned, match.start())
+                    continue
+                hits.append((match.start(), kind, match.group(1)))
+
+        found = []
+        for start, kind, link in sorted(hits):
+            if start >= scanned or link in self.seen:
+                continue
+            self.seen.add(link)
+            link = link.decode('utf-8', 'replace')
+            if kind == 'torrent':
+                link = urljoin(self.base_url, link)
+            found.append((kind, link))
+
+        if scanned == len(buffer):
+            self.buffer = buffer[-MAX_LINK:]
+        else:
+            self.buffer = buffer[scanned:]
+        return found
+
+
+def get_session():
+    global _session
+    if _session is None:
+        _session = aiohttp.ClientSession()
+    return _session
+
+
+# Streams the page at `url` and collects magnet (and, if `torrents` is set,
+# .torrent) links while reading. Stops at the first magnet when `first` is
+# set or after `max_bytes` bytes. The whole request is limited to `timeout`
+# seconds; aiohttp raises asyncio.TimeoutError when it runs out.
+# Returns a list of (kind, link) pairs in page order.
+async def extract_links(url, first=True, torrents=False,
+                        max_bytes=None, timeout=None):
+    max_bytes = max_bytes or Settings.page_max_bytes
+    timeout = aiohttp.ClientTimeout(total=timeout or Settings.page_timeout)
+    found = []
+    read = 0
+    async with get_session().get(url, timeout=timeout) as response:
+        response.raise_for_status()
+        scanner = LinkScanner(str(response.url), torrents)
+        async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+            read += len(chunk)
+            found += scanner.feed(chunk)
+            if first and any(kind == 'magnet' for kind, _ in found):
+                break
+            if read >= max_bytes:
+                logger.warning(u'Страница %s больше %s байт, дальше не '
+                               u'читаем', url, max_bytes)
+                break
+        else:
+            found += scanner.feed(b'', final=True)
+    if first:
+        magnets = [link for link in found if link[0] == 'magnet']
+        return found[:found.index(magnets[0]) + 1] if magnets else found
+    return found
+
+
+async def close():
+    if _session is not None:
+        await _session.close()
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+
+import base64
+import binascii
+import logging
+import re
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from settings import Settings
+from torrents import BadTorrent, get_ingest
+
+logger = logging.getLogger(__name__)
+
+DHT_ROUTERS = (('router.bittorrent.com', 6881),
+               ('router.utorrent.com', 6881),
+               ('dht.transmissionbt.com', 6881))
+BTIH = re.compile(r'xt=urn:btih:([0-9a-fA-F]{40}|[A-Za-z2-7]{32})')
+
+
+# Hex info-hash of a magnet-link, None when it has none
+def info_hash(magnet):
+    match = BTIH.search(magnet)
+    if match is None:
+        return None
+    value = match.group(1)
+    if len(value) == 32:
+        try:
+            return binascii.hexlify(base64.b32decode(value.upper())).decode()
+        except binascii.Error:
+            return None
+    return value.lower()
+
+
+# Long-lived magnet metadata resolver.
+# Keeps one libtorrent session with DHT running, so routing tables stay warm
+# between links. Magnets are added to the session and a single thread waits
+# for libtorrent alerts; once metadata arrives the .torrent file is saved
+# through torrents.get_ingest() by a writer pool and the caller's callback
+# gets the result text and whether it succeeded.
+class MagnetResolver:
+
+    def __init__(self, timeout):
+        import libtorrent
+        self.lt = libtorrent
+        self.timeout = timeout
+        self.save_path = tempfile.mkdtemp(prefix='magnet_')
+        self.session = libtorrent.session({
+            'enable_dht': True,
+            'alert_mask': libtorrent.alert.category_t.status_notification |
+            libtorrent.alert.category_t.error_notification})
+        for router in DHT_ROUTERS:
+            self.session.add_dht_router(*router)
+        # info-hash -> [handle, deadline, callbacks]
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.writer = ThreadPoolExecutor(max_workers=2)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='magnet',
+                                       daemon=True)
+        self.thread.start()
+
+    # Start resolving `magnet`; `callback(text, ok)` is called from a worker
+    # thread once the .torrent is written (ok is True) or resolving failed
+    def resolve(self, magnet, callback):
+        lt = self.lt
+        params = lt.parse_magnet_uri(magnet)
+        params.save_path = self.save_path
+        if hasattr(lt, 'torrent_flags'):
+            # Only metadata is needed, do not download the payload. Not
+            # auto-managed, so the session queue never holds back a magnet.
+            params.flags |= lt.torrent_flags.upload_mode
+            params.flags &= ~(lt.torrent_flags.auto_managed |
+                              lt.torrent_flags.paused)
+        with self.lock:
+            handle = self.session.add_torrent(params)
+            key = str(handle.info_hash())
+            if key in self.pending:
+                self.pending[key][2].append(callback)
+            else:
+                self.pending[key] = [handle, time.monotonic() + self.timeout,
+                                     [callback]]
+        logger.info(u'Magnet-ссылка %s передана в сессию libtorrent', key)
+
+    def run(self):
+        lt = self.lt
+        while not self.stopped.is_set():
+            self.session.wait_for_alert(500)
+            for alert in self.session.pop_alerts():
+                if isinstance(alert, lt.metadata_received_alert):
+                    self.received(alert.handle)
+                elif isinstance(alert, lt.metadata_failed_alert):
+                    self.finish(str(alert.handle.info_hash()),
+                                u'Ошибка при получении данных торрента: ' +
+                                alert.message())
+            self.expire()
+
+    def received(self, handle):
+        key = str(handle.info_hash())
+        with self.lock:
+            if key not in self.pending:
+                return
+            info = handle.torrent_file() if hasattr(handle, 'torrent_file') \
+                else handle.get_torrent_info()
+        data = self.lt.bencode(self.lt.create_torrent(info).generate())
+        self.writer.submit(self.write, key, info.name(), data)
+
+    def write(self, key, name, data):
+        try:
+            _, text = get_ingest().save(data, name)
+        except (OSError, BadTorrent) as error:
+            logger.error(u'Ошибка при сохранении torrent-файла: %s', error)
+            self.finish(key, u'Ошибка при сохранении torrent-файла.')
+            return
+        self.finish(key, text, True)
+
+    def expire(self):
+        now = time.monotonic()
+        with self.lock:
+            expired = [key for key, entry in self.pending.items()
+                       if entry[1] <= now]
+        for key in expired:
+            logger.error(u'Таймаут после %s секунд при получении '
+                         u'данных торрента с DHT/трекеров.', self.timeout)
+            self.finish(key, u'Таймаут после {} секунд при получении '
+                             u'данных торрента с DHT/трекеров.'
+                        .format(self.timeout))
+
+    # Drop the torrent from the session and report `text` to its callers
+    def finish(self, key, text, ok=False):
+        with self.lock:
+            entry = self.pending.pop(key, None)
+            if entry is None:
+                return
+            self.session.remove_torrent(entry[0])
+        for callback in entry[2]:
+            self.writer.submit(self.notify, callback, text, ok)
+
+    def notify(self, callback, text, ok):
+        try:
+            callback(text, ok)
+        except Exception:
+            logger.exception(u'Ошибка в обработчике результата magnet')
+
+    # Stop the alert thread, let the writers finish and close the session.
+    # The session is destroyed here, not at interpreter exit, where
+    # libtorrent aborts the process.
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.writer.shutdown(wait=True)
+        with self.lock:
+            if self.pending:
+                logger.warning(u'Не получены данные %d торрентов',
+                               len(self.pending))
+            self.pending.clear()
+            self.session.pause()
+            self.session = None
+
+
+_resolver = None
+_resolver_lock = threading.Lock()
+
+
+# Shared resolver, started on first use
+def get_resolver():
+    global _resolver
+    with _resolver_lock:
+        if _resolver is None:
+            _resolver = MagnetResolver(Settings.magnet_timeout)
+        return _resolver
+
+
+# Stop the shared resolver if it was started
+def stop_resolver():
+    global _resolver
+    with _resolver_lock:
+        if _resolver is not None:
+            _resolver.stop()
+            _resolver = None
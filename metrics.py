@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of latency histogram buckets, seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+_registry = []
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\')
+                                       .replace('"', '\\"'))
+                          for name, value in zip(names, values)) + '}'
+
+
+# Monotonic counter, one series per combination of label values
+class Counter:
+
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def series(self):
+        with self.lock:
+            return dict(self.values)
+
+    def render(self):
+        yield '# HELP %s %s' % (self.name, self.doc)
+        yield '# TYPE %s counter' % self.name
+        for labels, value in sorted(self.series().items()):
+            yield '%s%s %s' % (self.name, _labels(self.labels, labels), value)
+
+
+# Counter whose values are read from `collect()` -> {label value: number}
+# at render time, for counts kept elsewhere
+class CallbackCounter(Counter):
+
+    def __init__(self, name, doc, label, collect):
+        Counter.__init__(self, name, doc, (label,))
+        self.collect = collect
+
+    def series(self):
+        return {(key,): value for key, value in self.collect().items()}
+
+
+# Histogram with fixed buckets, one series per combination of label values
+class Histogram:
+
+    def __init__(self, name, doc, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        self.buckets = buckets
+        # labels -> [counts per bucket + overflow, sum]
+        self.values = {}
+        self.lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                entry = self.values[labels] = [[0] * (len(self.buckets) + 1),
+                                               0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    # labels -> (count, sum, counts per bucket)
+    def series(self):
+        with self.lock:
+            return {labels: (sum(counts), total, list(counts))
+                    for labels, (counts, total) in self.values.items()}
+
+    # Upper bound of the bucket holding the `fraction` quantile, None when
+    # it is beyond the last bucket
+    def quantile(self, counts, fraction):
+        rank = fraction * sum(counts)
+        seen = 0
+        for bound, count in zip(self.buckets, counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return None
+
+    def render(self):
+        yield '# HELP %s %s' % (self.name, self.doc)
+        yield '# TYPE %s histogram' % self.name
+        for labels, (count, total, counts) in sorted(self.series().items()):
+            seen = 0
+            for bound, bucket in zip(self.buckets, counts):
+                seen += bucket
+                yield '%s_bucket%s %s' % (
+                    self.name,
+                    _labels(self.labels + ('le',), labels + (bound,)), seen)
+            yield '%s_bucket%s %s' % (
+                self.name, _labels(self.labels + ('le',), labels + ('+Inf',)),
+                count)
+            yield '%s_sum%s %s' % (self.name, _labels(self.labels, labels),
+                                   total)
+            yield '%s_count%s %s' % (self.name, _labels(self.labels, labels),
+                                     count)
+
+
+# Every registered metric in the Prometheus text format
+def render():
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+handler_seconds = Histogram('bot_handler_seconds',
+                            'Time spent in update handlers', ('handler',))
+handler_errors = Counter('bot_handler_errors_total',
+                         'Handlers which raised an exception', ('handler',))
+cp_seconds = Histogram('bot_cp_request_seconds',
+                       'CouchPotato API call latency', ('action',))
+cp_errors = Counter('bot_cp_errors_total',
+                    'CouchPotato API calls which failed', ('action',))
+cache_requests = Counter('bot_cache_requests_total',
+                         'Cache lookups by result', ('cache', 'result'))
+telegram_calls = Counter('bot_telegram_calls_total',
+                         'Telegram Bot API calls made', ('method',))
+telegram_retries = Counter('bot_telegram_retries_total',
+                           'Telegram calls retried after RetryAfter',
+                           ('method',))
+
+
+# Short report for the /metrics command
+def summary_text():
+    lines = []
+    for title, histogram, errors in (
+            (u'Обработчики', handler_seconds, handler_errors),
+            (u'CouchPotato API', cp_seconds, cp_errors)):
+        failed = errors.series()
+        rows = []
+        for labels, (count, total, counts) in sorted(histogram.series().items()):
+            p95 = histogram.quantile(counts, 0.95)
+            rows.append(u'{}: {} шт., средн {:.3f} с, p95 {}, ошибок {}'.format(
+                labels[0], count, total / count,
+                u'≤{} с'.format(p95) if p95 is not None else u'>10 с',
+                failed.get(labels, 0)))
+        if rows:
+            lines.append(title + ':')
+            lines.extend(rows)
+    caches = {}
+    for (cache, result), value in cache_requests.series().items():
+        caches.setdefault(cache, {})[result] = value
+    for cache, results in sorted(caches.items()):
+        total = sum(results.values())
+        lines.append(u'Кэш {}: попаданий {:.0f}% из {}'.format(
+            cache, 100 * results.get('hit', 0) / total, total))
+    calls = telegram_calls.series()
+    if calls:
+        lines.append(u'Вызовов Telegram: {}, повторов после RetryAfter: {}'.format(
+            sum(calls.values()), sum(telegram_retries.series().values())))
+    return '\n'.join(lines) or u'Метрик пока нет'
+
+
+# Plain HTTP endpoint serving render() at `path` on the bot's event loop
+class MetricsServer:
+
+    def __init__(self, host, port, path='/metrics'):
+        self.host = host
+        self.port = port
+        self.path = path
+        self.runner = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get(self.path, self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+        logger.info(u'Метрики доступны на %s:%s%s', self.host, self.port,
+                    self.path)
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+    async def handle(self, request):
+        return web.Response(body=render().encode('utf-8'),
+                            headers={'Content-Type': CONTENT_TYPE})
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+
+import math
+import struct
+
+# Binary layout, little-endian. Strings are a uint16 byte length followed
+# by UTF-8. A movie is
+#   year uint16 (0 = unknown), rating float32 (NaN = none), votes uint32,
+#   release count uint16, imdb, media_id, title
+# followed by its releases, each
+#   size float64, score float64, leechers int32, seeders int32,
+#   id, media_id, name, protocol, url, provider
+MOVIE = struct.Struct('<HfIH')
+RELEASE = struct.Struct('<ddii')
+LENGTH = struct.Struct('<H')
+NAN = float('nan')
+
+
+def _pack_str(parts, value):
+    data = (value or '').encode('utf-8')[:0xffff]
+    parts.append(LENGTH.pack(len(data)))
+    parts.append(data)
+
+
+def _unpack_str(buffer, offset):
+    length, = LENGTH.unpack_from(buffer, offset)
+    offset += LENGTH.size
+    return str(buffer[offset:offset + length], 'utf-8'), offset + length
+
+
+def _number(value, default=0):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+
+# One release of a movie found by Couchpotato
+class Release:
+
+    __slots__ = ('id', 'media_id', 'name', 'protocol', 'size', 'url',
+                 'provider', 'score', 'leechers', 'seeders')
+
+    def __init__(self, id='', media_id='', name='', protocol='', size=0.0,
+                 url='', provider='', score=0.0, leechers=0, seeders=0):
+        self.id = id
+        self.media_id = media_id
+        self.name = name
+        self.protocol = protocol
+        self.size = size
+        self.url = url
+        self.provider = provider
+        self.score = score
+        self.leechers = leechers
+        self.seeders = seeders
+
+    # From a release of a media.list movie record
+    @classmethod
+    def from_media(cls, record):
+        info = record.get('info') or {}
+        return cls(record.get('_id') or '', record.get('media_id') or '',
+                   info.get('name') or '', info.get('protocol') or '',
+                   _number(info.get('size')), info.get('url') or '',
+                   info.get('provider') or '', _number(info.get('score')),
+                   int(_number(info.get('leechers'))),
+                   int(_number(info.get('seeders'))))
+
+    def pack(self, parts):
+        parts.append(RELEASE.pack(self.size, self.score, self.leechers,
+                                  self.seeders))
+        for value in (self.id, self.media_id, self.name, self.protocol,
+                      self.url, self.provider):
+            _pack_str(parts, value)
+
+    @classmethod
+    def unpack_from(cls, buffer, offset):
+        size, score, leechers, seeders = RELEASE.unpack_from(buffer, offset)
+        offset += RELEASE.size
+        strings = []
+        for _ in range(6):
+            value, offset = _unpack_str(buffer, offset)
+            strings.append(value)
+        release_id, media_id, name, protocol, url, provider = strings
+        return cls(release_id, media_id, name, protocol, size, url,
+                   provider, score, leechers, seeders), offset
+
+    def __repr__(self):
+        return 'Release(%r, %r)' % (self.id, self.name)
+
+
+# A movie from Couchpotato: a media.list record with its releases or a
+# search result with its IMDB rating
+class Movie:
+
+    __slots__ = ('imdb', 'media_id', 'title', 'year', 'rating', 'votes',
+                 'releases')
+
+    def __init__(self, imdb, media_id='', title='', year=None, rating=None,
+                 votes=0, releases=()):
+        self.imdb = imdb
+        self.media_id = media_id
+        self.title = title
+        self.year = year
+        self.rating = rating
+        self.votes = votes
+        self.releases = list(releases)
+
+    # From a media.list movie record
+    @classmethod
+    def from_media(cls, record):
+        info = record.get('info') or {}
+        releases = [Release.from_media(release)
+                    for release in record.get('releases') or ()]
+        title = record.get('title') or (info.get('titles') or [''])[0]
+        media_id = record.get('_id') or \
+            (releases[0].media_id if releases else '')
+        return cls((record.get('identifiers') or {}).get('imdb') or '',
+                   media_id, title, info.get('year'), releases=releases)
+
+    # From a search result; None when it has no IMDB id or title
+    @classmethod
+    def from_search(cls, hit):
+        titles = hit.get('titles') or []
+        if not hit.get('imdb') or not titles:
+            return None
+        rating = (hit.get('rating') or {}).get('imdb') or []
+        return cls(hit['imdb'], title=titles[0], year=hit.get('year'),
+                   rating=_number(rating[0], None) if rating else None,
+                   votes=int(_number(rating[1])) if len(rating) > 1 else 0)
+
+    # "<title> <year>" as offered to pick a search result by text
+    def label(self):
+        return self.title + ' ' + str(self.year or 'Unknown year')
+
+    def best_release(self):
+        return max(self.releases, key=lambda release: release.score,
+                   default=None)
+
+    def pack(self):
+        year = self.year if isinstance(self.year, int) and \
+            0 < self.year < 0x10000 else 0
+        rating = NAN if self.rating is None else self.rating
+        parts = [MOVIE.pack(year, rating, self.votes, len(self.releases))]
+        for value in (self.imdb, self.media_id, self.title):
+            _pack_str(parts, value)
+        for release in self.releases:
+            release.pack(parts)
+        return b''.join(parts)
+
+    @classmethod
+    def unpack(cls, data):
+        buffer = memoryview(data)
+        year, rating, votes, count = MOVIE.unpack_from(buffer, 0)
+        offset = MOVIE.size
+        imdb, offset = _unpack_str(buffer, offset)
+        media_id, offset = _unpack_str(buffer, offset)
+        title, offset = _unpack_str(buffer, offset)
+        releases = []
+        for _ in range(count):
+            release, offset = Release.unpack_from(buffer, offset)
+            releases.append(release)
+        return cls(imdb, media_id, title, year or None,
+                   None if math.isnan(rating) else round(rating, 1),
+                   votes, releases)
+
+    def __repr__(self):
+        return 'Movie(%r, %r, %r)' % (self.imdb, self.title, self.year)
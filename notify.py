@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+import hmac
+import logging
+import re
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# Couchpotato notification texts -> event kind
+KINDS = (('snatched', re.compile(r'^snatched', re.I)),
+         ('downloaded', re.compile(r'^(downloaded|renamed)', re.I)),
+         ('available', re.compile(r'available|release found', re.I)))
+
+
+def classify(message):
+    for kind, pattern in KINDS:
+        if pattern.search(message):
+            return kind
+    return 'other'
+
+
+# Embedded HTTP endpoint for the Couchpotato "Webhook" notifier, which
+# POSTs form fields `message` and `imdb_id` to the configured URL.
+# Every notification is handed to `callback(event)` as
+# {'kind', 'message', 'imdb'}. Runs on the bot's event loop.
+class NotifyServer:
+
+    def __init__(self, host, port, path, token, callback):
+        self.host = host
+        self.port = port
+        self.path = path
+        self.token = token
+        self.callback = callback
+        self.runner = None
+
+    async def start(self):
+        app = web.Application(client_max_size=64 * 1024)
+        app.router.add_post(self.path, self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, self.host, self.port)
+        await site.start()
+        logger.info(u'Ждем уведомления CouchPotato на %s:%s%s',
+                    self.host, self.port, self.path)
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+    async def handle(self, request):
+        token = request.query.get('token') or \
+            request.headers.get('X-Token', '')
+        if self.token and not hmac.compare_digest(token, self.token):
+            logger.warning(u'Уведомление с неверным токеном от %s',
+                           request.remote)
+            return web.Response(status=403)
+        if request.content_type == 'application/json':
+            try:
+                data = await request.json()
+            except ValueError:
+                return web.Response(status=400)
+            if not isinstance(data, dict):
+                return web.Response(status=400)
+        else:
+            data = await request.post()
+        message = str(data.get('message') or '').strip()
+        if not message:
+            return web.Response(status=400)
+        event = {'kind': classify(message),
+                 'message': message,
+                 'imdb': str(data.get('imdb_id') or '') or None}
+        logger.info(u'Уведомление CouchPotato (%s): %s', event['kind'],
+                    message)
+        try:
+            await self.callback(event)
+        except Exception:
+            logger.exception(u'Ошибка при обработке уведомления')
+        return web.Response(text='ok')
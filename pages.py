@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+import secrets
+
+from telegram import InlineKeyboardButton
+
+from store import get_store
+
+ACTION = 'pag_'
+# Callback of the page position button, does nothing
+NOOP = 'nop_'
+
+
+# Cursor pagination over result sets cached in the store.
+# Every cached result set (search results, /avail movies) gets a short id.
+# Prev/next buttons carry 'pag_<kind>:<set id>:<key>:<page>', so a page is
+# rendered straight from the store, and a button left over from an older
+# result set is detected instead of showing unrelated rows.
+
+# Random, so two sets made at the same moment never share an id
+def new_set(chat_id, kind):
+    set_id = secrets.token_hex(3)
+    get_store().put(chat_id, 'set', kind, set_id)
+    return set_id
+
+
+def current_set(chat_id, kind):
+    return get_store().get(chat_id, 'set', kind)
+
+
+def token(kind, set_id, page, key=''):
+    return '{}{}:{}:{}:{}'.format(ACTION, kind, set_id, key, page)
+
+
+# (kind, set id, key, page) from callback data
+def parse(data):
+    kind, set_id, key, page = data[len(ACTION):].split(':')
+    return kind, set_id, key, int(page)
+
+
+def count(total, size):
+    return max(1, (total + size - 1) // size)
+
+
+# Row of prev / position / next buttons, empty for a single page
+def nav_row(kind, set_id, page, pages, key=''):
+    if pages <= 1:
+        return []
+    row = []
+    if page > 0:
+        row.append(InlineKeyboardButton(
+            '«', callback_data=token(kind, set_id, page - 1, key)))
+    row.append(InlineKeyboardButton('{}/{}'.format(page + 1, pages),
+                                    callback_data=NOOP))
+    if page < pages - 1:
+        row.append(InlineKeyboardButton(
+            '»', callback_data=token(kind, set_id, page + 1, key)))
+    return row
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import itertools
+import logging
+import os
+import socket
+import struct
+import time
+
+logger = logging.getLogger(__name__)
+
+ICMP_ECHO = {socket.AF_INET: (8, 0), socket.AF_INET6: (128, 129)}
+ICMP_PROTO = {socket.AF_INET: socket.IPPROTO_ICMP,
+              socket.AF_INET6: getattr(socket, 'IPPROTO_ICMPV6', 58)}
+PAYLOAD = b'couchpotato-telegram'
+
+_sequence = itertools.count(1)
+
+
+# Outcome of probing one host: round trip times of the answered probes
+class Result:
+
+    def __init__(self, host, method, sent, rtts, error=None):
+        self.host = host
+        self.method = method
+        self.sent = sent
+        self.rtts = rtts
+        self.error = error
+
+    @property
+    def received(self):
+        return len(self.rtts)
+
+    @property
+    def loss(self):
+        return 100 * (1 - self.received / self.sent) if self.sent else 100
+
+    @property
+    def min(self):
+        return min(self.rtts) if self.rtts else None
+
+    @property
+    def avg(self):
+        return sum(self.rtts) / len(self.rtts) if self.rtts else None
+
+    @property
+    def max(self):
+        return max(self.rtts) if self.rtts else None
+
+    # Mean difference between consecutive round trips, ms
+    @property
+    def jitter(self):
+        if len(self.rtts) < 2:
+            return 0.0 if self.rtts else None
+        return sum(abs(b - a) for a, b in zip(self.rtts, self.rtts[1:])) / \
+            (len(self.rtts) - 1)
+
+
+def checksum(data):
+    if len(data) % 2:
+        data += b'\0'
+    total = sum(struct.unpack('!%dH' % (len(data) // 2), data))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
+
+
+def echo_request(family, sequence):
+    kind = ICMP_ECHO[family][0]
+    # The kernel fills in the identifier of datagram ICMP sockets
+    header = struct.pack('!BBHHH', kind, 0, 0, 0, sequence)
+    if family == socket.AF_INET:
+        header = struct.pack('!BBHHH', kind, 0,
+                             checksum(header + PAYLOAD), 0, sequence)
+    return header + PAYLOAD
+
+
+# Unprivileged ICMP echo through a SOCK_DGRAM socket. Raises OSError when
+# the system does not allow them (see net.ipv4.ping_group_range).
+async def icmp_probe(family, address, count, timeout, interval):
+    loop = asyncio.get_running_loop()
+    sock = socket.socket(family, socket.SOCK_DGRAM, ICMP_PROTO[family])
+    sock.setblocking(False)
+    reply = ICMP_ECHO[family][1]
+    rtts = []
+    try:
+        for i in range(count):
+            if i:
+                await asyncio.sleep(interval)
+            sequence = next(_sequence) & 0xffff
+            started = time.perf_counter()
+            await loop.sock_sendto(sock, echo_request(family, sequence),
+                                   address)
+            deadline = started + timeout
+            while True:
+                left = deadline - time.perf_counter()
+                if left <= 0:
+                    break
+                try:
+                    data = await asyncio.wait_for(loop.sock_recv(sock, 2048),
+                                                  left)
+                except asyncio.TimeoutError:
+                    break
+                if len(data) >= 8 and data[0] == reply and \
+                        struct.unpack('!H', data[6:8])[0] == sequence:
+                    rtts.append((time.perf_counter() - started) * 1000)
+                    break
+    finally:
+        sock.close()
+    return rtts
+
+
+# Time of TCP handshakes with `port`, for hosts or systems where ICMP is
+# not available. A refused connection still measures a round trip.
+async def tcp_probe(family, address, count, timeout, interval):
+    loop = asyncio.get_running_loop()
+    rtts = []
+    for i in range(count):
+        if i:
+            await asyncio.sleep(interval)
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(loop.sock_connect(sock, address), timeout)
+            rtts.append((time.perf_counter() - started) * 1000)
+        except ConnectionRefusedError:
+            rtts.append((time.perf_counter() - started) * 1000)
+        except (OSError, asyncio.TimeoutError):
+            pass
+        finally:
+            sock.close()
+    return rtts
+
+
+# Probe `host` with `count` echo requests, falling back to TCP connects
+# to `port` when ICMP sockets are not permitted
+async def ping(host, count=1, timeout=2, interval=0.2, port=443):
+    loop = asyncio.get_running_loop()
+    try:
+        infos = await loop.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    except OSError as error:
+        return Result(host, None, count, [], error=str(error))
+    family, _, _, _, address = infos[0]
+    if family in ICMP_ECHO and os.name != 'nt':
+        try:
+            rtts = await icmp_probe(family, address, count, timeout,
+                                    interval)
+            return Result(host, 'icmp', count, rtts)
+        except OSError as error:
+            logger.debug(u'ICMP недоступен (%s), пингуем через TCP', error)
+    rtts = await tcp_probe(family, address, count, timeout, interval)
+    return Result(host, 'tcp', count, rtts)
+
+
+# Probe all `hosts` concurrently. Returns Results in the order of `hosts`.
+async def ping_many(hosts, count=1, timeout=2, interval=0.2, port=443):
+    return await asyncio.gather(*(ping(host, count, timeout, interval, port)
+                                  for host in hosts))
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+# What a message text starts with, tried in one pass
+TEXT_KINDS = re.compile(r'(?P<command>/(?P<name>\w+)(?:@(?P<target>\w+))?)|'
+                        r'(?P<magnet>magnet)|'
+                        r'(?P<http>http)')
+TORRENT_MIME = 'application/x-bittorrent'
+
+
+# Single entry point for updates in place of a list of handlers which the
+# dispatcher would try one by one. Every update is classified once:
+# a callback query, an inline query or chosen inline result, a command
+# looked up by name in a dict, a magnet or http link, a .torrent document
+# or plain text. The cost does not depend on the number of commands.
+# Messages posted through the bot's own inline mode are ignored.
+class Router:
+
+    def __init__(self):
+        self.commands = {}
+        # kind -> callback for 'callback', 'inline', 'chosen', 'magnet',
+        # 'http', 'torrent', 'text' and 'unknown' (commands without a
+        # callback)
+        self.routes = {}
+
+    def command(self, name, callback):
+        self.commands[name.lower()] = callback
+
+    def on(self, kind, callback):
+        self.routes[kind] = callback
+
+    # Callback for `update` or None when nothing handles it
+    def classify(self, update, username=None):
+        if update.callback_query is not None:
+            return self.routes.get('callback')
+        if update.inline_query is not None:
+            return self.routes.get('inline')
+        if update.chosen_inline_result is not None:
+            return self.routes.get('chosen')
+        message = update.message
+        if message is None:
+            return None
+        via_bot = message.via_bot
+        if via_bot is not None and username and via_bot.username and \
+                via_bot.username.lower() == username.lower():
+            return None
+        text = message.text
+        if text:
+            match = TEXT_KINDS.match(text)
+            kind = match.lastgroup if match else 'text'
+            if kind == 'command':
+                target = match.group('target')
+                if target and username and target.lower() != username.lower():
+                    return None
+                return self.commands.get(match.group('name').lower(),
+                                         self.routes.get('unknown'))
+            return self.routes.get(kind)
+        document = message.document
+        if document is not None and document.mime_type == TORRENT_MIME:
+            return self.routes.get('torrent')
+        return None
+
+    # Callback for the dispatcher, as in TypeHandler(Update, router.dispatch)
+    def dispatch(self, bot, update):
+        callback = self.classify(update, bot.username)
+        if callback is not None:
+            return callback(bot, update)
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import math
+import threading
+import time
+from array import array
+
+import sysinfo
+from settings import Settings
+
+logger = logging.getLogger(__name__)
+
+# Sampled metrics: name -> (title, unit)
+METRICS = {'ram': (u'Свободная RAM', u'МБ'),
+           'disk': (u'Свободно на диске', u'ГБ'),
+           'temp': (u'Температура', u'°C'),
+           'ping': (u'Пинг', u'мс')}
+FIELDS = tuple(METRICS)
+
+
+# Fixed-size history of samples. Every field is a flat array of doubles
+# and a sample is one slot across them, so memory stays at
+# 8 * (fields + 1) bytes per sample however long the bot runs.
+# Missing readings are stored as NaN.
+class RingBuffer:
+
+    def __init__(self, capacity, fields=FIELDS):
+        self.capacity = capacity
+        self.fields = fields
+        self.times = array('d', bytes(8 * capacity))
+        self.values = {name: array('d', bytes(8 * capacity))
+                       for name in fields}
+        self.head = 0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def append(self, timestamp, sample):
+        with self.lock:
+            self.times[self.head] = timestamp
+            for name in self.fields:
+                value = sample.get(name)
+                self.values[name][self.head] = \
+                    float('nan') if value is None else value
+            self.head = (self.head + 1) % self.capacity
+            self.count = min(self.count + 1, self.capacity)
+
+    # Readings of every field taken at or after `since`, oldest first,
+    # missing ones left out: {name: [value]}
+    def since(self, since):
+        result = {name: [] for name in self.fields}
+        with self.lock:
+            start = (self.head - self.count) % self.capacity
+            for i in range(self.count):
+                slot = (start + i) % self.capacity
+                if self.times[slot] < since:
+                    continue
+                for name in self.fields:
+                    value = self.values[name][slot]
+                    if not math.isnan(value):
+                        result[name].append(value)
+        return result
+
+    def __len__(self):
+        return self.count
+
+
+def percentile(ordered, fraction):
+    index = max(0, math.ceil(fraction * len(ordered)) - 1)
+    return ordered[index]
+
+
+# {'count', 'min', 'avg', 'max', 'p50', 'p95'} for a list of readings or
+# None
+def summary(values):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return {'count': len(ordered),
+            'min': ordered[0],
+            'avg': sum(ordered) / len(ordered),
+            'max': ordered[-1],
+            'p50': percentile(ordered, 0.5),
+            'p95': percentile(ordered, 0.95)}
+
+
+def ram_probe():
+    mem = sysinfo.memory()
+    return mem['available'] if mem else None
+
+
+def disk_probe():
+    found = sysinfo.disks(tuple(Settings.disk_paths[:1]))
+    return found[0][2] / 1024 ** 3 if found else None
+
+
+def temp_probe():
+    readings = sysinfo.temperatures()
+    return max(celsius for _, celsius in readings) if readings else None
+
+
+# Background thread taking a sample of every metric each `interval`
+# seconds into a RingBuffer of `capacity` samples. The ping probe is given
+# by the bot, as it needs the event loop.
+class Sampler:
+
+    def __init__(self, interval, capacity):
+        self.interval = interval
+        self.history = RingBuffer(capacity)
+        self.probes = {'ram': ram_probe,
+                       'disk': disk_probe,
+                       'temp': temp_probe}
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def probe(self, name, func):
+        self.probes[name] = func
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name='sampler',
+                                           daemon=True)
+            self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        while not self.stopped.is_set():
+            started = time.monotonic()
+            self.history.append(started, self.sample())
+            self.stopped.wait(max(0, self.interval -
+                                  (time.monotonic() - started)))
+
+    def sample(self):
+        sample = {}
+        for name, func in self.probes.items():
+            try:
+                sample[name] = func()
+            except Exception as error:
+                logger.warning(u'Ошибка при замере %s: %s', name, error)
+        return sample
+
+    # Summaries of the last `seconds` seconds: {name: summary or None}
+    def stats(self, seconds):
+        found = self.history.since(time.monotonic() - seconds)
+        return {name: summary(values) for name, values in found.items()}
+
+
+_sampler = None
+_sampler_lock = threading.Lock()
+
+
+# Shared sampler, created on first use and started by the bot
+def get_sampler():
+    global _sampler
+    with _sampler_lock:
+        if _sampler is None:
+            _sampler = Sampler(Settings.sample_interval,
+                               Settings.sample_history)
+        return _sampler
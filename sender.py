@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from telegram.error import RetryAfter
+
+import metrics
+from settings import Settings
+
+logger = logging.getLogger(__name__)
+
+
+# Classic token bucket: `rate` tokens per second, at most `capacity` stored
+class TokenBucket:
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+
+    def refill(self, now):
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Seconds until a token is available
+    def wait(self, now):
+        self.refill(now)
+        wait = 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(wait, self.blocked_until - now)
+
+    def take(self, now):
+        self.refill(now)
+        self.tokens -= 1
+
+    # Telegram asked us to back off
+    def block(self, seconds):
+        self.blocked_until = time.monotonic() + seconds
+
+
+# Outgoing message scheduler.
+# Calls to the Bot API are queued per chat and released by one scheduler
+# thread as the global and per-chat token buckets allow (Telegram permits
+# about 30 messages per second overall and one per second per chat).
+# At most one call per chat is in flight, so messages keep their order.
+# A RetryAfter error puts the call back at the head of its chat queue and
+# blocks that chat for the time Telegram asked for.
+class SendQueue:
+
+    def __init__(self, global_rate, chat_rate, chat_burst, workers=8):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.buckets = {}
+        self.queues = OrderedDict()
+        self.busy = set()
+        self.condition = threading.Condition()
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.thread = threading.Thread(target=self.run, name='sender',
+                                       daemon=True)
+        self.thread.start()
+
+    # Queue `method(chat_id=chat_id, **kwargs)`, e.g. bot.sendMessage.
+    # Returns a Future with the call result.
+    def send(self, method, chat_id, **kwargs):
+        future = Future()
+        with self.condition:
+            if chat_id not in self.queues:
+                self.queues[chat_id] = deque()
+                if chat_id not in self.buckets:
+                    self.buckets[chat_id] = TokenBucket(self.chat_rate,
+                                                        self.chat_burst)
+            self.queues[chat_id].append((method, kwargs, future))
+            self.condition.notify()
+        return future
+
+    def run(self):
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                wait = None
+                for chat_id, queue in self.queues.items():
+                    if chat_id in self.busy:
+                        continue
+                    chat_wait = max(self.buckets[chat_id].wait(now),
+                                    self.global_bucket.wait(now))
+                    if chat_wait <= 0:
+                        self.dispatch(chat_id, now)
+                        break
+                    wait = chat_wait if wait is None else min(wait, chat_wait)
+                else:
+                    self.condition.wait(wait)
+
+    # Called with the condition held
+    def dispatch(self, chat_id, now):
+        queue = self.queues.pop(chat_id)
+        method, kwargs, future = queue.popleft()
+        if queue:
+            # Round robin: the chat goes to the back of the line
+            self.queues[chat_id] = queue
+        self.global_bucket.take(now)
+        self.buckets[chat_id].take(now)
+        self.busy.add(chat_id)
+        self.pool.submit(self.call, chat_id, method, kwargs, future)
+
+    def call(self, chat_id, method, kwargs, future):
+        name = getattr(method, '__name__', 'call')
+        metrics.telegram_calls.inc(name)
+        try:
+            result = method(chat_id=chat_id, **kwargs)
+        except RetryAfter as error:
+            metrics.telegram_retries.inc(name)
+            logger.warning(u'Telegram просит подождать %s с. (chat %s)',
+                           error.retry_after, chat_id)
+            with self.condition:
+                self.buckets[chat_id].block(error.retry_after)
+                self.queues.setdefault(chat_id, deque()).appendleft(
+                    (method, kwargs, future))
+                self.busy.discard(chat_id)
+                self.condition.notify()
+            return
+        except Exception as error:
+            logger.error(u'Ошибка при отправке сообщения в чат %s: %s',
+                         chat_id, error)
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+        with self.condition:
+            self.busy.discard(chat_id)
+            self.condition.notify()
+
+
+_sender = None
+_sender_lock = threading.Lock()
+
+
+# Shared send queue, started on first use
+def get_sender():
+    global _sender
+    with _sender_lock:
+        if _sender is None:
+            _sender = SendQueue(Settings.tg_global_rate, Settings.tg_chat_rate,
+                                Settings.tg_chat_burst)
+        return _sender
@@ -6,11 +6,34 @@ class Settings:
     # Admin IDs who has access to bot commands
     # admin_ids = [194764515, 273428117]
     admin_ids = []
+    # Updates per second and burst allowed for each admin
+    auth_rate = 2
+    auth_burst = 10
+    # Seconds to ignore a user after telling them access is denied, and how
+    # many such users to remember
+    auth_deny_ttl = 3600
+    auth_deny_size = 10000
+    # Seconds between checks of this file for changed admin_ids and auth_*
+    auth_reload_interval = 5
     # Telegram autorisation token
     token = ''
     # Path to store torrent files
     # torrent_path = '/mnt/archive2/onedrive/.torrents/video/films/'
     torrent_path = ''
+    # Info-hashes of the torrents saved to torrent_path, so the same
+    # torrent is not handed to the client twice
+    torrent_index = 'cache/torrents.sqlite3'
+    # Largest .torrent file accepted, bytes
+    torrent_max_size = 10 * 1024 * 1024
+    # Files of an album are collected for torrent_album_wait seconds and
+    # saved torrent_concurrency at a time
+    torrent_album_wait = 1
+    torrent_concurrency = 4
+    # Seconds to wait for magnet-link metadata from DHT/trackers
+    magnet_timeout = 120
+    # Max bytes and seconds spent reading a page when looking for magnet-links
+    page_max_bytes = 2 * 1024 * 1024
+    page_timeout = 15
 
     # Couchpotato related settings:
     # Hostname
@@ -23,9 +46,132 @@ class Settings:
     cp_urlbase = '/couchpotato'
     # SSL
     cp_ssl = False
+    # Verify SSL certificate (True, False or path to CA bundle)
+    cp_ssl_verify = True
     # Username
     cp_username = 'admin'
     # Password
     cp_password = 'admin'
     # Timeout
     cp_timeout = 15
+    # Max keep-alive connections kept open to Couchpotato
+    cp_pool_size = 10
+    # Retries on connection errors and 5xx responses
+    cp_retries = 3
+    # Backoff factor between retries, seconds
+    cp_backoff = 0.3
+    # Parallel Couchpotato calls for bulk actions in /avail
+    cp_bulk_workers = 4
+    # Seconds to keep media.list responses in memory
+    cp_cache_ttl = 300
+    # Max number of distinct media.list queries kept in memory
+    cp_cache_size = 16
+    # Parse media.list and search responses movie by movie and keep only
+    # the fields the bot shows (uses ijson when installed)
+    cp_stream = True
+    # Seconds to keep search results, shared by /q and inline queries, and
+    # the number of distinct searches kept
+    search_cache_ttl = 600
+    search_cache_size = 256
+
+    # Inline mode, @bot <title> in any chat. Enable it with /setinline in
+    # BotFather, and /setinlinefeedback for the chosen movie to be added.
+    # Seconds to wait for the user to stop typing before searching
+    inline_debounce = 0.4
+    # Shortest text searched, most results shown
+    inline_min_length = 3
+    inline_max_results = 20
+    # Seconds Telegram may reuse an answer for the same user and text
+    inline_cache_time = 30
+
+    # Per-chat cache of search and /avail results (SQLite database)
+    cache_db = 'cache/bot_cache.sqlite3'
+    # Seconds to keep cached results
+    cache_ttl = 86400
+    # Max number of cached rows for all chats
+    cache_max_rows = 50000
+
+    # Outgoing Telegram messages per second, for all chats and per chat
+    tg_global_rate = 30
+    tg_chat_rate = 1
+    # Messages a chat may get in a burst before tg_chat_rate applies
+    tg_chat_burst = 3
+    # Threads for the blocking Telegram Bot API calls of the handlers
+    tg_workers = 16
+    # Receive updates by webhook instead of polling when set, e.g.
+    # 'https://example.com:8443/telegram'. Telegram accepts ports 443, 80,
+    # 88 and 8443.
+    tg_webhook_url = ''
+    # Address and port the webhook server listens on
+    tg_webhook_listen = '0.0.0.0'
+    tg_webhook_port = 8443
+    # Telegram sends it with every update, a random one is made per run
+    # when empty
+    tg_webhook_secret = ''
+    # PEM certificate and key to serve HTTPS directly, leave empty behind a
+    # TLS-terminating proxy. A self-signed certificate is uploaded to
+    # Telegram.
+    tg_webhook_cert = ''
+    tg_webhook_key = ''
+    tg_webhook_self_signed = False
+    # Entries on one page of /q and /avail results
+    page_size = 10
+
+    # Seconds to reuse memory, disk and sensor readings of /status
+    metrics_ttl = 5
+    # Mount points reported by /free and /status
+    disk_paths = ['/']
+    # Seconds between background samples for /stats
+    sample_interval = 60
+    # Samples kept for /stats, a day at the default interval
+    sample_history = 1440
+
+    # Hosts for /ping without arguments, the first one is also sampled
+    ping_hosts = ['8.8.4.4']
+    # Echo requests per host, seconds to wait for each reply
+    ping_count = 3
+    ping_timeout = 2
+    # Most hosts /ping takes at once
+    ping_max_hosts = 10
+    # Port timed with TCP connects where ICMP sockets are not permitted
+    ping_tcp_port = 443
+
+    # Endpoint for the Couchpotato "Webhook" notifier, set its URL to
+    # http://<notify_host>:<notify_port><notify_path>?token=<notify_token>
+    # notify_port = 0 disables it
+    notify_host = '127.0.0.1'
+    notify_port = 0
+    notify_path = '/couchpotato'
+    notify_token = ''
+
+    # Prometheus metrics on http://<metrics_host>:<metrics_port>/metrics,
+    # metrics_port = 0 disables the endpoint (the /metrics command stays)
+    metrics_host = '127.0.0.1'
+    metrics_port = 0
+
+    # On-disk index of movie titles for fuzzy lookups of typed titles,
+    # rebuilt from the Couchpotato library every title_index_refresh
+    # seconds
+    title_index_path = 'cache/titles.idx'
+    title_index_refresh = 3600
+    # IMDB title.basics.tsv.gz dump (https://datasets.imdbws.com/) added to
+    # the index when set
+    title_index_imdb = ''
+
+    # Durable queue of torrent files, magnet and page links and movie adds.
+    # Workers run at most jobs_rate jobs per second, a failed job is retried
+    # jobs_retries times after jobs_backoff * 2 ** attempt seconds
+    jobs_db = 'cache/jobs.sqlite3'
+    jobs_workers = 2
+    jobs_rate = 1
+    jobs_retries = 3
+    jobs_backoff = 5
+    # Seconds one attempt may take
+    jobs_timeout = 300
+    # Seconds a handler waits for the result before answering that it
+    # comes later
+    jobs_wait = 10
+    # The same torrent, link or movie sent again within jobs_dedup_ttl
+    # seconds is not queued twice; finished jobs are kept for jobs_keep
+    jobs_dedup_ttl = 600
+    jobs_keep = 86400
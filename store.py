@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+from models import Movie
+from settings import Settings
+
+# Bumped when stored values change format; older rows are dropped
+VERSION = 2
+# Seconds between checks of the row count against `max_rows`
+CAP_INTERVAL = 60
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS entries (
+    chat_id INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    pos INTEGER NOT NULL,
+    expires REAL NOT NULL,
+    value BLOB NOT NULL,
+    PRIMARY KEY (chat_id, kind, key)
+);
+CREATE INDEX IF NOT EXISTS entries_expires ON entries (expires);
+CREATE INDEX IF NOT EXISTS entries_pos ON entries (chat_id, kind, pos);
+'''
+
+
+# Per-chat result cache in one SQLite database (WAL mode).
+# Rows are keyed by (chat_id, kind, key): kind is 'query' for /q results
+# and 'avail' for /avail movies, both keyed by IMDB id. Movies are stored
+# in the packed format of models.Movie, other values pickled. Rows expire after
+# `ttl` seconds and the oldest rows are dropped once the table holds more
+# than `max_rows`; expired rows are purged on every write, the row count is
+# checked at most once in CAP_INTERVAL seconds.
+# Each thread uses its own connection, so dispatcher workers can read and
+# write concurrently.
+class CacheStore:
+
+    def __init__(self, path, ttl, max_rows):
+        self.path = path
+        self.ttl = ttl
+        self.max_rows = max_rows
+        self.next_cap = 0
+        self.local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self.connection() as db:
+            if db.execute('PRAGMA user_version').fetchone()[0] != VERSION:
+                db.execute('DROP TABLE IF EXISTS entries')
+                db.execute('PRAGMA user_version = %d' % VERSION)
+            db.executescript(SCHEMA)
+
+    def connection(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self.local.db = db
+        return db
+
+    # Replace all rows of given kind for the chat with `items`,
+    # an iterable of (key, value) pairs, keeping their order
+    def replace(self, chat_id, kind, items):
+        expires = time.time() + self.ttl
+        rows = [(chat_id, kind, key, pos, expires, encode(value))
+                for pos, (key, value) in enumerate(items)]
+        with self.connection() as db:
+            db.execute('DELETE FROM entries WHERE chat_id = ? AND kind = ?',
+                       (chat_id, kind))
+            db.executemany('INSERT OR IGNORE INTO entries '
+                           'VALUES (?, ?, ?, ?, ?, ?)', rows)
+            self.purge(db)
+
+    # Add or overwrite a single row, placed after the existing ones
+    def put(self, chat_id, kind, key, value):
+        with self.connection() as db:
+            db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, '
+                       '(SELECT COALESCE(MAX(pos), -1) + 1 FROM entries '
+                       'WHERE chat_id = ? AND kind = ?), ?, ?)',
+                       (chat_id, kind, key, chat_id, kind,
+                        time.time() + self.ttl, encode(value)))
+            self.purge(db)
+
+    # All (key, value) rows of given kind for the chat, in stored order
+    def items(self, chat_id, kind):
+        rows = self.connection().execute(
+            'SELECT key, value FROM entries WHERE chat_id = ? AND kind = ? '
+            'AND expires > ? ORDER BY pos', (chat_id, kind, time.time()))
+        return [(key, decode(value)) for key, value in rows]
+
+    # Rows `offset`..`offset + limit` of given kind and the total row count
+    def page(self, chat_id, kind, offset, limit):
+        db = self.connection()
+        now = time.time()
+        total = db.execute(
+            'SELECT COUNT(*) FROM entries WHERE chat_id = ? AND kind = ? '
+            'AND expires > ?', (chat_id, kind, now)).fetchone()[0]
+        rows = db.execute(
+            'SELECT key, value FROM entries WHERE chat_id = ? AND kind = ? '
+            'AND expires > ? ORDER BY pos LIMIT ? OFFSET ?',
+            (chat_id, kind, now, limit, offset))
+        return [(key, decode(value)) for key, value in rows], total
+
+    def get(self, chat_id, kind, key):
+        row = self.connection().execute(
+            'SELECT value FROM entries WHERE chat_id = ? AND kind = ? '
+            'AND key = ? AND expires > ?',
+            (chat_id, kind, key, time.time())).fetchone()
+        return decode(row[0]) if row else None
+
+    def delete(self, chat_id, kind, key=None):
+        with self.connection() as db:
+            if key is None:
+                db.execute('DELETE FROM entries WHERE chat_id = ? '
+                           'AND kind = ?', (chat_id, kind))
+            else:
+                db.execute('DELETE FROM entries WHERE chat_id = ? '
+                           'AND kind = ? AND key = ?', (chat_id, kind, key))
+
+    # Both deletes walk the `expires` index, never the whole table
+    def purge(self, db):
+        db.execute('DELETE FROM entries WHERE expires <= ?', (time.time(),))
+        now = time.monotonic()
+        if now < self.next_cap:
+            return
+        self.next_cap = now + CAP_INTERVAL
+        excess = db.execute('SELECT COUNT(*) FROM entries').fetchone()[0] - \
+            self.max_rows
+        if excess > 0:
+            db.execute('DELETE FROM entries WHERE rowid IN (SELECT rowid '
+                       'FROM entries ORDER BY expires LIMIT ?)', (excess,))
+
+
+def encode(value):
+    if isinstance(value, Movie):
+        return b'M' + value.pack()
+    return b'P' + pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+
+def decode(data):
+    if data[:1] == b'M':
+        return Movie.unpack(memoryview(data)[1:])
+    return pickle.loads(data[1:])
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+# Shared store, created on first use
+def get_store():
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = CacheStore(Settings.cache_db, Settings.cache_ttl,
+                                Settings.cache_max_rows)
+        return _store
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+
+import glob
+import os
+import threading
+import time
+from functools import wraps
+
+from settings import Settings
+
+HWMON = '/sys/class/hwmon'
+
+
+# Keeps the result of a reading for `ttl` seconds, so commands asked in a
+# row (or the /status command asking everything) do not reread the files
+def cached(ttl):
+    def decorator(func):
+        lock = threading.Lock()
+        entries = {}
+
+        @wraps(func)
+        def wrapped(*args):
+            now = time.monotonic()
+            with lock:
+                entry = entries.get(args)
+                if entry is not None and entry[0] > now:
+                    return entry[1]
+            value = func(*args)
+            with lock:
+                entries[args] = (now + ttl, value)
+            return value
+        return wrapped
+    return decorator
+
+
+# Memory in MB: {'total', 'available', 'swap_total', 'swap_free'}.
+# None where /proc is not available.
+@cached(Settings.metrics_ttl)
+def memory():
+    try:
+        with open('/proc/meminfo') as f:
+            info = {}
+            for line in f:
+                name, _, value = line.partition(':')
+                info[name] = int(value.split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+    available = info.get('MemAvailable')
+    if available is None:
+        # Kernels before 3.14
+        available = info.get('MemFree', 0) + info.get('Buffers', 0) + \
+            info.get('Cached', 0)
+    return {'total': info.get('MemTotal', 0) // 1024,
+            'available': available // 1024,
+            'swap_total': info.get('SwapTotal', 0) // 1024,
+            'swap_free': info.get('SwapFree', 0) // 1024}
+
+
+# Seconds since boot or None
+@cached(Settings.metrics_ttl)
+def uptime():
+    try:
+        with open('/proc/uptime') as f:
+            return float(f.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+# Disk usage in bytes for every path of `paths`:
+# [(path, total, free)], free is the space available to the bot's user
+@cached(Settings.metrics_ttl)
+def disks(paths):
+    result = []
+    for path in paths:
+        try:
+            st = os.statvfs(path)
+        except (OSError, AttributeError):
+            continue
+        result.append((path, st.f_blocks * st.f_frsize,
+                       st.f_bavail * st.f_frsize))
+    return result
+
+
+# Sensor temperatures in °C: [(label, celsius)]
+@cached(Settings.metrics_ttl)
+def temperatures():
+    result = []
+    for chip in sorted(glob.glob(os.path.join(HWMON, 'hwmon*'))):
+        name = _read(os.path.join(chip, 'name')) or os.path.basename(chip)
+        for sensor in sorted(glob.glob(os.path.join(chip, 'temp*_input'))):
+            value = _read(sensor)
+            if value is None:
+                continue
+            try:
+                celsius = int(value) / 1000
+            except ValueError:
+                continue
+            label = _read(sensor[:-len('input')] + 'label') or \
+                os.path.basename(sensor)[:-len('_input')]
+            result.append((name + ' ' + label, celsius))
+    return result
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def format_uptime(seconds):
+    minutes = int(seconds) // 60
+    days, minutes = divmod(minutes, 24 * 60)
+    hours, minutes = divmod(minutes, 60)
+    parts = []
+    if days:
+        parts.append(str(days) + u' дн.')
+    if days or hours:
+        parts.append(str(hours) + u' ч.')
+    parts.append(str(minutes) + u' мин.')
+    return ' '.join(parts)
+
+
+def format_size(size):
+    for unit in (u'Б', u'КБ', u'МБ', u'ГБ'):
+        if size < 1024:
+            return '{:.1f} {}'.format(size, unit)
+        size /= 1024
+    return '{:.1f} ТБ'.format(size)
+
+
+def memory_text():
+    mem = memory()
+    if mem is None:
+        return None
+    return u'RAM: свободно {} из {} МБ'.format(mem['available'], mem['total'])
+
+
+def uptime_text():
+    seconds = uptime()
+    if seconds is None:
+        return None
+    return u'Аптайм: ' + format_uptime(seconds)
+
+
+def disks_text():
+    lines = [u'Диск {}: свободно {} из {}'.format(path, format_size(free),
+                                                  format_size(total))
+             for path, total, free in disks(tuple(Settings.disk_paths))]
+    return '\n'.join(lines) or None
+
+
+def temperatures_text():
+    lines = [u'{}: {:.0f}°C'.format(label, celsius)
+             for label, celsius in temperatures()]
+    return '\n'.join(lines) or None
+
+
+# Everything for the /status command
+def status_text():
+    parts = [uptime_text(), memory_text(), disks_text(), temperatures_text()]
+    return '\n'.join(part for part in parts if part) or \
+        u'Нет данных о системе'
@@ -0,0 +1,416 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import bisect
+import gzip
+import heapq
+import logging
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+import unicodedata
+import zlib
+from array import array
+from collections import Counter
+
+from settings import Settings
+
+logger = logging.getLogger(__name__)
+
+# File layout, native byte order as the index is built on the host which
+# reads it:
+#   header: magic, version, entry count, trigram count, posting count
+#   entries sorted by key: strings offset, IMDB number, year (0 = unknown),
+#     key length, title length
+#   trigram count of every entry, uint16 each, padded to 4 bytes
+#   crc32 of every trigram, sorted, uint32 each
+#   first posting of every trigram and one past the last, uint32 each
+#   postings: entry numbers, uint32 each
+#   strings: normalised key then title of every entry, UTF-8
+MAGIC = b'CPTI'
+VERSION = 1
+HEADER = struct.Struct('=4sHxxIII')
+ENTRY = struct.Struct('=IIHHH')
+# Postings counted per fuzzy lookup. Trigrams of a query are counted from
+# the rarest, common ones ("the", " th") past this budget only count for
+# the candidates scored in full.
+MAX_COUNTED = 5000
+# Candidates of a fuzzy lookup scored in full, per result
+CHECKED = 10
+# Longer titles are not indexed, lengths are stored as uint16
+MAX_TITLE = 1000
+WORD = re.compile(r'\w+')
+# "<title> <year>" as on the reply keyboard, see models.Movie.label()
+LABEL = re.compile(r'^(.*\S)\s+(\d{4}|Unknown year)$')
+# IMDB dump title types kept in the index
+IMDB_TYPES = ('movie', 'tvMovie', 'video')
+
+
+# Lower case, without accents, punctuation and repeated spaces
+def normalize(text):
+    text = unicodedata.normalize('NFKD', text.casefold().replace(u'ё', u'е'))
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    return ' '.join(WORD.findall(text))
+
+
+# Hashes of the distinct trigrams of normalised `key`, padded so that
+# word starts weigh more
+def trigrams(key):
+    padded = '  ' + key + ' '
+    return {zlib.crc32(padded[i:i + 3].encode('utf-8'))
+            for i in range(len(padded) - 2)}
+
+
+# One indexed title; `score` is the similarity to the query, 0..1
+class Title:
+
+    __slots__ = ('imdb', 'title', 'year', 'score')
+
+    def __init__(self, imdb, title, year, score=1.0):
+        self.imdb = imdb
+        self.title = title
+        self.year = year
+        self.score = score
+
+    # Same text as models.Movie.label()
+    def label(self):
+        return self.title + ' ' + str(self.year or 'Unknown year')
+
+    def __repr__(self):
+        return 'Title(%r, %r, %r)' % (self.imdb, self.title, self.year)
+
+
+# Writes the index of `titles`, an iterable of (imdb, title, year), to
+# `path`. The file is replaced atomically, so readers keep the old index
+# until they reopen. A title repeated for one IMDB id is kept once.
+def build(path, titles):
+    entries = {}
+    for imdb, title, year in titles:
+        if not imdb or not imdb.startswith('tt') or not imdb[2:].isdigit() \
+                or not title or len(title) > MAX_TITLE:
+            continue
+        key = normalize(title)
+        number = int(imdb[2:])
+        if key and (number, key) not in entries:
+            year = year if isinstance(year, int) and 0 < year < 0x10000 else 0
+            entries[number, key] = (key.encode('utf-8'),
+                                    title.encode('utf-8'), year)
+    ordered = sorted((key, number, title, year)
+                     for (number, _), (key, title, year) in entries.items())
+
+    postings = {}
+    records = []
+    sizes = array('H')
+    strings = []
+    offset = 0
+    for i, (key, number, title, year) in enumerate(ordered):
+        grams = trigrams(key.decode('utf-8'))
+        for gram in grams:
+            found = postings.get(gram)
+            if found is None:
+                found = postings[gram] = array('I')
+            found.append(i)
+        records.append(ENTRY.pack(offset, number, year, len(key), len(title)))
+        sizes.append(min(len(grams), 0xffff))
+        strings.append(key)
+        strings.append(title)
+        offset += len(key) + len(title)
+
+    grams = array('I', sorted(postings))
+    starts = array('I')
+    flat = array('I')
+    for gram in grams:
+        starts.append(len(flat))
+        flat.extend(postings[gram])
+    starts.append(len(flat))
+
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temporary = path + '.tmp'
+    with open(temporary, 'wb') as index:
+        index.write(HEADER.pack(MAGIC, VERSION, len(records), len(grams),
+                                len(flat)))
+        index.writelines(records)
+        if len(sizes) % 2:
+            sizes.append(0)
+        index.write(sizes.tobytes())
+        index.write(grams.tobytes())
+        index.write(starts.tobytes())
+        index.write(flat.tobytes())
+        index.writelines(strings)
+    os.replace(temporary, path)
+    return len(records)
+
+
+# (imdb, title, year) of the movies of a media.list MediaIndex
+def library_titles(library):
+    for imdb, movie in list(library.movies.items()):
+        info = movie.get('info') or {}
+        titles = [movie.get('title')] + list(info.get('titles') or ())
+        for title in titles:
+            if title:
+                yield imdb, title, info.get('year')
+
+
+# (imdb, title, year) from an IMDB title.basics.tsv.gz dump, primary and
+# original titles of movies only
+def imdb_titles(path):
+    with gzip.open(path, 'rt', encoding='utf-8') as dump:
+        next(dump, None)
+        for line in dump:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) < 6 or fields[1] not in IMDB_TYPES or \
+                    fields[4] == '1':
+                continue
+            year = int(fields[5]) if fields[5].isdigit() else None
+            yield fields[0], fields[2], year
+            if fields[3] != fields[2]:
+                yield fields[0], fields[3], year
+
+
+# Read-only view of an index file, memory-mapped so lookups touch only the
+# pages they need and the index costs no heap. Entries are sorted by
+# normalised title for prefix lookups by binary search; a trigram inverted
+# index gives fuzzy matches ranked by Dice similarity.
+class TitleIndex:
+
+    def __init__(self, path):
+        with open(path, 'rb') as index:
+            self.map = mmap.mmap(index.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.count, self.grams, postings = \
+            HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or version != VERSION:
+            self.map.close()
+            raise ValueError('not a title index: ' + path)
+        self.entries_at = HEADER.size
+        sizes_at = self.entries_at + self.count * ENTRY.size
+        grams_at = sizes_at + (self.count + 1) // 2 * 4
+        starts_at = grams_at + self.grams * 4
+        postings_at = starts_at + (self.grams + 1) * 4
+        self.strings_at = postings_at + postings * 4
+        view = memoryview(self.map)
+        self.sizes = view[sizes_at:grams_at].cast('H')
+        self.hashes = view[grams_at:starts_at].cast('I')
+        self.starts = view[starts_at:postings_at].cast('I')
+        self.postings = view[postings_at:self.strings_at].cast('I')
+        view.release()
+
+    def close(self):
+        for view in (self.sizes, self.hashes, self.starts, self.postings):
+            view.release()
+        self.map.close()
+
+    def __len__(self):
+        return self.count
+
+    def key(self, i):
+        offset, _, _, length, _ = ENTRY.unpack_from(
+            self.map, self.entries_at + i * ENTRY.size)
+        start = self.strings_at + offset
+        return self.map[start:start + length]
+
+    def entry(self, i, score=1.0):
+        offset, number, year, key_length, title_length = \
+            ENTRY.unpack_from(self.map, self.entries_at + i * ENTRY.size)
+        start = self.strings_at + offset + key_length
+        return Title('tt%07d' % number,
+                     str(self.map[start:start + title_length], 'utf-8'),
+                     year or None, score)
+
+    # Number of the first entry with key >= `key`
+    def find(self, key):
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.key(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    # Postings of the trigram `gram`, empty when it is not indexed
+    def postings_of(self, gram):
+        at = bisect.bisect_left(self.hashes, gram)
+        if at == self.grams or self.hashes[at] != gram:
+            return self.postings[0:0]
+        return self.postings[self.starts[at]:self.starts[at + 1]]
+
+    # Titles starting with `text`, in key order
+    def prefix(self, text, limit=10):
+        key = normalize(text).encode('utf-8')
+        if not key:
+            return []
+        found = []
+        i = self.find(key)
+        while i < self.count and len(found) < limit and \
+                self.key(i).startswith(key):
+            found.append(self.entry(i))
+            i += 1
+        return found
+
+    # Titles similar to `text`, best first, at least `cutoff` similar.
+    # Candidates come from the postings of the rarest trigrams of the
+    # query. The ones with the best Dice score over those trigrams are
+    # looked up in the postings of the common ones and scored in full.
+    def search(self, text, limit=10, cutoff=0.3):
+        grams = trigrams(normalize(text))
+        lists = sorted(filter(None, map(self.postings_of, grams)), key=len)
+        common = Counter()
+        counted = 0
+        for n, found in enumerate(lists):
+            if n and counted + len(found) > MAX_COUNTED:
+                break
+            common.update(found.tolist())
+            counted += len(found)
+        else:
+            n = len(lists)
+        rest = lists[n:]
+        if not common:
+            return []
+        floor = (max(common.values()) + 1) // 2
+        sizes = self.sizes
+        total = len(grams)
+        best = heapq.nlargest(
+            limit * CHECKED,
+            [i for i, shared in common.items() if shared >= floor],
+            key=lambda i: common[i] / (total + sizes[i]))
+        scored = []
+        for i in best:
+            shared = common[i]
+            for found in rest:
+                at = bisect.bisect_left(found, i)
+                if at < len(found) and found[at] == i:
+                    shared += 1
+            score = 2.0 * shared / (total + sizes[i])
+            if score >= cutoff:
+                scored.append((score, i))
+        return [self.entry(i, round(score, 3))
+                for score, i in heapq.nlargest(limit, scored)]
+
+    # Prefix matches then fuzzy ones, for suggestions while typing
+    def lookup(self, text, limit=10):
+        found = self.prefix(text, limit)
+        seen = set((title.imdb, title.title) for title in found)
+        for title in self.search(text, limit):
+            if len(found) >= limit:
+                break
+            if (title.imdb, title.title) not in seen:
+                found.append(title)
+        return found
+
+    # Title of a reply keyboard label "<title> <year>", None when `label`
+    # is not one or the index has no such title and year. A bare title is
+    # never resolved: it may name several movies, and the caller adds the
+    # resolved one without asking.
+    def resolve(self, label):
+        match = LABEL.match(label.strip())
+        if match is None:
+            return None
+        title, year = match.groups()
+        key = normalize(title).encode('utf-8')
+        if not key:
+            return None
+        year = int(year) if year.isdigit() else None
+        i = self.find(key)
+        while i < self.count and self.key(i) == key:
+            entry = self.entry(i)
+            if entry.year == year:
+                return entry
+            i += 1
+        return None
+
+
+# Keeps the title index of the bot: opens the last built file on start and
+# rebuilds it from the Couchpotato library (and the IMDB dump when set)
+# in a worker thread when they change, checking every `refresh` seconds.
+# Lookups run on the event loop and never wait for a rebuild.
+class TitleIndexer:
+
+    def __init__(self, path, refresh, imdb_dump=''):
+        self.path = path
+        self.refresh = refresh
+        self.imdb_dump = imdb_dump
+        self.index = None
+        # What the index was last built from
+        self.source = None
+        try:
+            self.index = TitleIndex(path)
+        except (OSError, ValueError) as error:
+            logger.info(u'Индекс названий ещё не построен: %s', error)
+
+    # Rebuild from `library`, a MediaIndex of the whole library
+    async def rebuild(self, library):
+        titles = sorted(library_titles(library))
+        source = (titles, self.dump_mtime())
+        if source == self.source and self.index is not None:
+            return
+        started = time.monotonic()
+        count = await asyncio.get_running_loop().run_in_executor(
+            None, self.write, titles)
+        old, self.index = self.index, TitleIndex(self.path)
+        self.source = source
+        if old is not None:
+            old.close()
+        logger.info(u'Индекс названий построен: %s названий за %.1f с',
+                    count, time.monotonic() - started)
+
+    def dump_mtime(self):
+        try:
+            return os.stat(self.imdb_dump).st_mtime if self.imdb_dump else None
+        except OSError:
+            return None
+
+    def write(self, titles):
+        if self.imdb_dump:
+            return build(self.path, self.with_dump(titles))
+        return build(self.path, titles)
+
+    def with_dump(self, titles):
+        yield from titles
+        try:
+            yield from imdb_titles(self.imdb_dump)
+        except (OSError, EOFError, UnicodeDecodeError) as error:
+            logger.error(u'Не удалось прочитать дамп IMDB %s: %s',
+                         self.imdb_dump, error)
+
+    # Rebuilds forever, run it as a task on the bot's loop. `client` is the
+    # CPClient the library is fetched with.
+    async def run(self, client):
+        while True:
+            library = await client.library_index()
+            if library is not None:
+                try:
+                    await self.rebuild(library)
+                except (OSError, ValueError) as error:
+                    logger.error(u'Не удалось построить индекс названий: %s',
+                                 error)
+            await asyncio.sleep(self.refresh)
+
+    def lookup(self, text, limit=10):
+        if self.index is None:
+            return []
+        return self.index.lookup(text, limit)
+
+    def resolve(self, label):
+        if self.index is None:
+            return None
+        return self.index.resolve(label)
+
+
+_indexer = None
+_indexer_lock = threading.Lock()
+
+
+# Shared title index, created on first use
+def get_indexer():
+    global _indexer
+    with _indexer_lock:
+        if _indexer is None:
+            _indexer = TitleIndexer(Settings.title_index_path,
+                                    Settings.title_index_refresh,
+                                    Settings.title_index_imdb)
+        return _indexer
@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import hashlib
+import logging
+import mmap
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+
+import aiohttp
+
+import aio
+import links
+import metrics
+from settings import Settings
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 65536
+# Characters kept in file names from users and torrents
+UNSAFE = re.compile(r'[^\w .()\[\]+,&!-]+')
+MAX_NAME = 120
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS torrents (
+    info_hash TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    added REAL NOT NULL
+);
+'''
+
+torrents_total = metrics.Counter('bot_torrents_total',
+                                 'Ingested .torrent files by outcome',
+                                 ('outcome',))
+
+
+# Raised for files which are not a torrent or are too big
+class BadTorrent(ValueError):
+    pass
+
+
+# Length prefix of a bencoded string, the digits in buffer[offset:colon]
+def _length(buffer, offset, colon):
+    digits = buffer[offset:colon]
+    if not digits.isdigit():
+        raise BadTorrent('bad string length')
+    return int(digits)
+
+
+# End offset of the bencoded value starting at `offset` of `buffer`.
+# Walks the tokens without decoding them, so nested dicts and lists cost
+# no allocations and no recursion.
+def skip(buffer, offset):
+    end = len(buffer)
+    depth = 0
+    while True:
+        if offset >= end:
+            raise BadTorrent('truncated bencode')
+        token = buffer[offset]
+        if token in b'dl':
+            depth += 1
+            offset += 1
+        elif token == ord('e'):
+            if depth == 0:
+                raise BadTorrent('unexpected end marker')
+            depth -= 1
+            offset += 1
+        elif token == ord('i'):
+            close = buffer.find(b'e', offset)
+            if close < 0:
+                raise BadTorrent('truncated integer')
+            offset = close + 1
+        elif 0x30 <= token <= 0x39:
+            colon = buffer.find(b':', offset)
+            if colon < 0 or colon - offset > 10:
+                raise BadTorrent('bad string length')
+            offset = colon + 1 + _length(buffer, offset, colon)
+            if offset > end:
+                raise BadTorrent('truncated string')
+        else:
+            raise BadTorrent('bad token at %d' % offset)
+        if depth == 0:
+            return offset
+
+
+# (key, value start, value end) of the bencoded dict at `offset`
+def dict_items(buffer, offset):
+    if buffer[offset:offset + 1] != b'd':
+        raise BadTorrent('not a dictionary')
+    offset += 1
+    while buffer[offset:offset + 1] != b'e':
+        if not buffer[offset:offset + 1].isdigit():
+            raise BadTorrent('bad dictionary key')
+        colon = buffer.find(b':', offset)
+        if colon < 0:
+            raise BadTorrent('truncated dictionary')
+        start = colon + 1 + _length(buffer, offset, colon)
+        key = buffer[colon + 1:start]
+        end = skip(buffer, start)
+        yield key, start, end
+        offset = end
+
+
+# Hex info-hash and name of the torrent in `buffer` (bytes or mmap).
+# Only the `info` dict is looked at: its raw bytes are hashed through a
+# memoryview, and of its keys only the name is decoded.
+def inspect(buffer):
+    span = None
+    for key, start, end in dict_items(buffer, 0):
+        if key == b'info':
+            span = start, end
+    if span is None:
+        raise BadTorrent('no info dictionary')
+    start, end = span
+    with memoryview(buffer) as view:
+        digest = hashlib.sha1(view[start:end]).hexdigest()
+    names = {key: buffer[value:stop] for key, value, stop in
+             dict_items(buffer, start) if key in (b'name', b'name.utf-8')}
+    name = names.get(b'name.utf-8') or names.get(b'name') or b''
+    # Strings are "<length>:<bytes>"
+    name = name[name.find(b':') + 1:].decode('utf-8', 'replace')
+    return digest, name
+
+
+# Safe base name for a .torrent file from an untrusted `name`
+def safe_name(name):
+    name = os.path.basename((name or '').replace('\\', '/'))
+    if name.lower().endswith('.torrent'):
+        name = name[:-len('.torrent')]
+    name = UNSAFE.sub('_', name).strip(' ._')[:MAX_NAME]
+    return name
+
+
+# Index of the info-hashes of torrents already handed to the torrent
+# client, in SQLite, so a torrent sent again (as another file, forwarded,
+# or as a magnet-link) is skipped. Shared by the loop and the resolver
+# threads.
+class TorrentIndex:
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(SCHEMA)
+
+    # Name the torrent was saved as, None for a new one
+    def get(self, info_hash):
+        with self.lock:
+            row = self.db.execute('SELECT name FROM torrents WHERE '
+                                  'info_hash = ?', (info_hash,)).fetchone()
+        return row[0] if row else None
+
+    def add(self, info_hash, name):
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO torrents VALUES '
+                            '(?, ?, ?)', (info_hash, name, time.time()))
+
+
+# Puts .torrent files into `torrent_path` for the torrent client.
+# A file is streamed into a temporary file next to its destination, its
+# info-hash is computed from the mmap of that file, and only a torrent
+# missing from the index is renamed into place; a rename within one
+# directory is atomic, so the client never sees a partial file. Names
+# come from users and torrents and are sanitized; an existing file of the
+# same name gets the info-hash appended instead of being replaced.
+class TorrentIngest:
+
+    def __init__(self, torrent_path, index_path, max_size):
+        self.torrent_path = torrent_path
+        self.max_size = max_size
+        self.index = TorrentIndex(index_path)
+        # Serializes the check-and-rename of commit()
+        self.lock = threading.Lock()
+
+    def temp_file(self):
+        return tempfile.NamedTemporaryFile(
+            dir=self.torrent_path or '.', prefix='.', suffix='.part',
+            delete=False)
+
+    # Save the Telegram file `torrent_file` (from getFile) sent as `name`.
+    # Returns (outcome, text): outcome is 'saved' or 'duplicate'.
+    async def fetch(self, torrent_file, name):
+        if (torrent_file.file_size or 0) > self.max_size:
+            raise BadTorrent(u'файл больше %d байт' % self.max_size)
+        temp = self.temp_file()
+        try:
+            with temp:
+                if torrent_file.file_path and \
+                        '://' in torrent_file.file_path:
+                    await self.stream(torrent_file.file_path, temp)
+                else:
+                    # Local Bot API server: the file is already on disk
+                    await aio.call(torrent_file.download, out=temp)
+            return await aio.call(self.commit, temp.name, name)
+        finally:
+            if os.path.exists(temp.name):
+                os.unlink(temp.name)
+
+    async def stream(self, url, out):
+        size = 0
+        timeout = aiohttp.ClientTimeout(total=Settings.page_timeout)
+        async with links.get_session().get(url, timeout=timeout) as response:
+            response.raise_for_status()
+            async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                size += len(chunk)
+                if size > self.max_size:
+                    raise BadTorrent(u'файл больше %d байт' % self.max_size)
+                out.write(chunk)
+
+    # Save `data`, a whole .torrent made by the magnet resolver. Called
+    # from its threads.
+    def save(self, data, name):
+        with self.temp_file() as temp:
+            temp.write(data)
+        try:
+            return self.commit(temp.name, name)
+        finally:
+            if os.path.exists(temp.name):
+                os.unlink(temp.name)
+
+    def commit(self, temp_path, name):
+        with open(temp_path, 'rb') as f:
+            if not os.fstat(f.fileno()).st_size:
+                raise BadTorrent(u'пустой файл')
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                info_hash, title = inspect(data)
+        with self.lock:
+            saved = self.index.get(info_hash)
+            if saved is not None:
+                torrents_total.inc('duplicate')
+                logger.info(u'Торрент %s уже был добавлен как %s',
+                            info_hash, saved)
+                return 'duplicate', u'%s уже был добавлен раньше.' % saved
+            base = safe_name(name) or safe_name(title) or info_hash
+            path = os.path.join(self.torrent_path, base + '.torrent')
+            if os.path.exists(path):
+                base += '.' + info_hash[:8]
+                path = os.path.join(self.torrent_path, base + '.torrent')
+            os.chmod(temp_path, 0o644)
+            os.replace(temp_path, path)
+            self.index.add(info_hash, base + '.torrent')
+        torrents_total.inc('saved')
+        logger.info(u'Torrent-файл сохранен: %s (%s)', path, info_hash)
+        return 'saved', base + u'.torrent сохранен и передан на закачку.'
+
+    # Save the files of one message or album, `files` being
+    # (torrent_file, name) pairs, at most `concurrency` at a time.
+    # Returns a list of (outcome, text); outcome 'failed' for a file which
+    # is not a torrent and 'error' for one worth trying again.
+    async def fetch_all(self, files, concurrency):
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def one(torrent_file, name):
+            async with semaphore:
+                try:
+                    return await self.fetch(torrent_file, name)
+                except BadTorrent as error:
+                    torrents_total.inc('failed')
+                    logger.warning(u'%s не сохранен: %s', name, error)
+                    return 'failed', u'%s не сохранен: %s' % (name, error)
+                except (aiohttp.ClientError, asyncio.TimeoutError,
+                        OSError) as error:
+                    torrents_total.inc('error')
+                    logger.error(u'Ошибка при сохранении %s: %s', name,
+                                 error)
+                    return 'error', u'Ошибка при сохранении %s.' % name
+        return await asyncio.gather(*(one(*file) for file in files))
+
+
+_ingest = None
+_ingest_lock = threading.Lock()
+
+
+# Shared ingestion, created on first use
+def get_ingest():
+    global _ingest
+    with _ingest_lock:
+        if _ingest is None:
+            _ingest = TorrentIngest(Settings.torrent_path,
+                                    Settings.torrent_index,
+                                    Settings.torrent_max_size)
+        return _ingest
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+
+import hmac
+import logging
+import ssl
+
+from aiohttp import web
+from telegram import Update
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+# Endpoint receiving updates pushed by Telegram, an alternative to the
+# getUpdates long-poll loop. Runs on the bot's event loop and puts every
+# update on the dispatcher's `update_queue`.
+# Requests without the `secret` set by setWebhook are refused. With
+# `cert` and `key` the server speaks HTTPS itself, otherwise it is meant
+# to sit behind a TLS-terminating proxy.
+class WebhookServer:
+
+    def __init__(self, bot, update_queue, listen, port, path, secret,
+                 cert=None, key=None):
+        self.bot = bot
+        self.update_queue = update_queue
+        self.listen = listen
+        self.port = port
+        self.path = path
+        self.secret = secret
+        self.cert = cert
+        self.key = key
+        self.runner = None
+
+    async def start(self):
+        app = web.Application(client_max_size=1024 * 1024)
+        app.router.add_post(self.path, self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        context = None
+        if self.cert:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(self.cert, self.key)
+        site = web.TCPSite(self.runner, self.listen, self.port,
+                           ssl_context=context)
+        await site.start()
+        logger.info(u'Вебхук слушает %s:%s%s', self.listen, self.port,
+                    self.path)
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+    async def handle(self, request):
+        secret = request.headers.get(SECRET_HEADER, '')
+        if not hmac.compare_digest(secret, self.secret):
+            logger.warning(u'Запрос к вебхуку без секрета от %s',
+                           request.remote)
+            return web.Response(status=403)
+        try:
+            data = await request.json()
+            update = Update.de_json(data, self.bot)
+        except (ValueError, TypeError, KeyError) as error:
+            logger.warning(u'Неверное обновление на вебхуке: %s', error)
+            return web.Response(status=400)
+        self.update_queue.put(update)
+        return web.Response()